@@ -0,0 +1,80 @@
+import sys
+sys.path.insert(0, "./common/")
+
+import argparse
+import time
+import numpy as np
+from file_helper import FileHelper
+from melody_generator import MelodyGenerator, INFERENCE_BACKENDS
+
+# Run from the src/ folder like main.py, i.e:
+# python benchmarks/inference_backends.py --instrument FolkLSTM --steps 64 --window 128
+
+
+def time_calls(function, repeats: int) -> np.ndarray:
+    """ Calls the function once to warm it up, then returns the duration of every following call in ms """
+    function()
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return np.array(durations)
+
+
+def describe(name: str, durations: np.ndarray) -> str:
+    return (f"{name:<28} mean {durations.mean():8.3f} ms   p50 {np.percentile(durations, 50):8.3f} ms"
+            f"   p95 {np.percentile(durations, 95):8.3f} ms")
+
+
+def benchmark_backend(backend: str, model_info: dict, file_helper: FileHelper, steps: int, window: int) -> None:
+    start = time.perf_counter()
+    melody_generator = MelodyGenerator(
+        model_info['model_path'],
+        file_helper,
+        model_info['mapping_path'],
+        64,
+        inference_backend=backend
+    )
+    # a backend that can't be set up falls back to function, label the timings with the one that really runs
+    active = melody_generator.active_backend
+    fallback = f" (requested {backend}, fell back)" if active != backend else ""
+    print(f"\n[{active}]{fallback} loaded and set up in {time.perf_counter() - start:.3f}s")
+
+    vocabulary_size = len(melody_generator.vocabulary)
+    symbols = np.random.randint(0, vocabulary_size, size=window)
+    # encoded the way the generator feeds its model, one-hot or plain ids for models that embed the symbols themselves
+    encoded_window = melody_generator._encode(list(symbols))
+
+    # one forward pass over a full window, this is what the windowed decoding pays every step
+    print(describe("windowed step", time_calls(lambda: melody_generator._backend([encoded_window]), steps)))
+
+    if melody_generator._get_step_model() is None:
+        print("model does not support incremental decoding, skipping single step timings")
+        return
+
+    states = melody_generator._initial_states()
+    print(describe("incremental prime", time_calls(lambda: melody_generator._run_step_model(list(symbols), states), steps)))
+    print(describe("incremental step", time_calls(lambda: melody_generator._run_step_model([int(symbols[0])], states), steps)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per step latency of every MelodyGenerator inference backend")
+    parser.add_argument("--instrument", default="FolkLSTM", help="A key of model_info.json")
+    parser.add_argument("--backends", nargs="+", default=list(INFERENCE_BACKENDS.keys()))
+    parser.add_argument("--steps", type=int, default=64, help="How many timed calls per measurement")
+    parser.add_argument("--window", type=int, default=128, help="The max_seq_len used for the windowed/prime calls")
+    args = parser.parse_args()
+
+    file_helper = FileHelper()
+    model_info = file_helper.loadJSON("./model_info.json")[args.instrument]
+
+    for backend in args.backends:
+        try:
+            benchmark_backend(backend, model_info, file_helper, args.steps, args.window)
+        except Exception as e:
+            print(f"\n[{backend}] failed with error: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import sys
+sys.path.insert(0, "./common/")
+
+import argparse
+import random
+import time
+import numpy as np
+import midi_writer
+from render_helper import melody_to_midi_music21
+
+# Run from the src/ folder like main.py, i.e:
+# python benchmarks/midi_writer.py --melodies 200 --length 256
+# Checks that the direct midi writer produces the same bytes as the music21 path and times both
+
+EMOTIONS = list(midi_writer.EMOTION_KEYS.keys())
+
+
+def random_melody(length: int, rng: random.Random) -> list:
+    """ A melody shaped like the generator's output: notes, chords and rests followed by holds """
+    melody = []
+    while len(melody) < length:
+        kind = rng.random()
+        if kind < 0.15:
+            melody.append("r")
+        elif kind < 0.3:
+            root = rng.randint(36, 84)
+            melody.append(".".join(str(root + step) for step in sorted(rng.sample(range(12), rng.randint(2, 4)))))
+        else:
+            melody.append(str(rng.randint(36, 96)))
+        melody += ["_"] * rng.choice([0, 1, 1, 2, 3, 7])
+    return melody[:length]
+
+
+def time_writer(function, melodies: list, emotions: list) -> np.ndarray:
+    durations = []
+    for melody, emotion in zip(melodies, emotions):
+        start = time.perf_counter()
+        function(melody, emotion)
+        durations.append((time.perf_counter() - start) * 1000)
+    return np.array(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parity and speed of midi_writer against the music21 midi path")
+    parser.add_argument("--melodies", type=int, default=200, help="How many random melodies to compare")
+    parser.add_argument("--length", type=int, default=256, help="Symbols per melody")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    melodies = [random_melody(args.length, rng) for _ in range(args.melodies)]
+    # the edge cases: nothing but rests, a single symbol, trailing holds and rests
+    melodies += [["r", "_", "r"], ["60"], ["60", "_", "_"], ["62", "r", "_", "_"], ["60.64.67", "_", "62"]]
+    emotions = [rng.choice(EMOTIONS) for _ in melodies]
+
+    mismatches = 0
+    for melody, emotion in zip(melodies, emotions):
+        if midi_writer.melody_to_midi(melody, emotion) != melody_to_midi_music21(melody, emotion):
+            mismatches += 1
+            print(f"Mismatch for {emotion}: {' '.join(melody[:32])} ...")
+    print(f"{len(melodies) - mismatches}/{len(melodies)} melodies written identically")
+
+    for name, function in (("music21", melody_to_midi_music21), ("direct", midi_writer.melody_to_midi)):
+        durations = time_writer(function, melodies, emotions)
+        print(f"{name:<10} mean {durations.mean():8.3f} ms   p50 {np.percentile(durations, 50):8.3f} ms"
+              f"   p95 {np.percentile(durations, 95):8.3f} ms")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import sys
+sys.path.insert(0, "./common/")
+
+import argparse
+import contextlib
+import cProfile
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import music21 as m21
+import numpy as np
+import song_preprocessing
+from file_helper import FileHelper
+from music_helper import MusicHelper, ACCEPTABLE_DURATIONS
+# create_training_sequence imports it (and tensorflow with it) on first use, that would count against the batched stage
+import training_data
+
+# Run from the src/ folder like main.py, i.e:
+# python benchmarks/pipeline.py --sizes 10 50 200 --workers 4
+# python benchmarks/pipeline.py --dataset ./models/FolkLSTM/data --file-type krn --profile-dir ./profiles --json run.json
+# Times every stage of MusicHelper.song_data_pipeline on growing slices of a dataset (a synthetic one by default).
+# The .prof files open with pstats/snakeviz, to compare against a sampling profiler run the same command under
+# py-spy record -o profile.svg -- python benchmarks/pipeline.py ...
+
+STEP_DURATIONS = [1, 2, 3, 4, 6, 8, 12, 16]  # the acceptable durations in 16th notes
+
+
+def synthetic_dataset(directory: str, songs: int, length: int, seed: int) -> str:
+    """ Writes random single voice songs as musicxml, only acceptable durations and no notes across barlines like a folk song dataset """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(songs):
+        song = m21.stream.Stream()
+        song.append(m21.meter.TimeSignature("4/4"))
+        steps = 0
+        while steps < length:
+            # 16 steps of 16th notes to a measure
+            duration = rng.choice([d for d in STEP_DURATIONS if d <= 16 - steps % 16])
+            if rng.random() < 0.1:
+                song.append(m21.note.Rest(quarterLength=duration / 4))
+            else:
+                song.append(m21.note.Note(rng.randint(55, 84), quarterLength=duration / 4))
+            steps += duration
+        song.write("musicxml", os.path.join(directory, f"song_{i:05d}.musicxml"))
+    return directory
+
+
+class PeakRSS:
+    """
+    Samples the resident memory of this process while a stage runs, ru_maxrss only ever reports the lifetime peak.
+    increase is how far above its starting point the stage took it, what earlier stages left resident doesn't count
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.start = 0
+        self.peak = 0
+        self._stopped = threading.Event()
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def _current(self) -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self._page_size
+        except OSError:
+            # no procfs, fall back to the lifetime peak (kilobytes on linux)
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, self._current())
+
+    def __enter__(self):
+        self.start = self.peak = self._current()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stopped.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._current())
+
+    @property
+    def increase(self) -> int:
+        return self.peak - self.start
+
+
+def run_stage(results: list, name: str, size: int, function, profile_dir: str = None, symbols=None):
+    """
+    Times function() and records its wall time, how much it raised the peak RSS and its throughput
+
+    :param symbols: How many symbols the stage went through, a callable taking the stage's result or an int
+    :return: Whatever function returned
+    """
+    profiler = cProfile.Profile() if profile_dir else None
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        # the pipeline reports its progress, keep it out of the benchmark output
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function()
+        if profiler is not None:
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+
+    if profiler is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f"{name}_{size}.prof"))
+
+    symbol_count = symbols(result) if callable(symbols) else symbols
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    row = {
+        "stage": name,
+        "songs": size,
+        "seconds": round(elapsed, 4),
+        "start_rss_mb": round(rss.start / 2 ** 20, 1),
+        "peak_rss_increase_mb": round(rss.increase / 2 ** 20, 1),
+        "worker_peak_rss_mb": round(children_after / 1024, 1) if children_after > children_before else None,
+        "songs_per_second": round(size / elapsed, 2) if elapsed > 0 else None,
+        "symbols_per_second": round(symbol_count / elapsed, 1) if symbol_count and elapsed > 0 else None
+    }
+    results.append(row)
+    print(f"{name:<22} {size:>6} songs {elapsed:9.3f} s   peak rss +{row['peak_rss_increase_mb']:7.1f} MB"
+          f"   {row['songs_per_second'] or 0:9.2f} songs/s   {row['symbols_per_second'] or 0:12.1f} symbols/s")
+    return result
+
+
+def benchmark_size(results: list, files: list, work_dir: str, args) -> None:
+    size = len(files)
+    music_helper = MusicHelper(FileHelper())
+    profile_dir = args.profile_dir
+
+    # the per song stages on their own, in this process
+    songs = run_stage(results, "parse", size, lambda: [m21.converter.parse(path) for path in files], profile_dir)
+    songs = run_stage(results, "duration_filter", size,
+                      lambda: [song for song in songs if song_preprocessing.has_acceptable_durations(song, ACCEPTABLE_DURATIONS)],
+                      profile_dir)
+    run_stage(results, "key_analysis", len(songs), lambda: [song.analyze("key") for song in songs], profile_dir)
+    songs = run_stage(results, "transpose", len(songs),
+                      lambda: [song_preprocessing.transpose_song(song, args.major_key, args.minor_key) for song in songs],
+                      profile_dir)
+    run_stage(results, "encode", len(songs), lambda: [song_preprocessing.encode_song(song, args.time_step) for song in songs],
+              profile_dir, symbols=lambda encoded: sum(len(song.split()) for song in encoded))
+
+    # the pipeline itself, with its worker pool and the stages after preprocessing
+    dataset_dir = os.path.join(work_dir, f"dataset_{size}")
+    os.makedirs(dataset_dir)
+    for path in files:
+        os.symlink(os.path.abspath(path), os.path.join(dataset_dir, os.path.basename(path)))
+    encoded_dir = os.path.join(work_dir, f"encoded_{size}")
+    os.makedirs(encoded_dir)
+    single_file_dataset = os.path.join(work_dir, f"dataset_{size}.txt")
+    mapping_path = os.path.join(work_dir, f"mapping_{size}.json")
+
+    run_stage(results, "preprocess_songs", size,
+              lambda: music_helper.preprocess_songs(dataset_dir, encoded_dir, args.major_key, args.minor_key, args.file_type,
+                                                    workers=args.workers, time_step=args.time_step, use_cache=False),
+              profile_dir)
+    run_stage(results, "preprocess_cached", size,
+              lambda: music_helper.preprocess_songs(dataset_dir, encoded_dir, args.major_key, args.minor_key, args.file_type,
+                                                    workers=args.workers, time_step=args.time_step),
+              profile_dir)
+    corpus_path = run_stage(results, "create_corpus", size,
+                            lambda: music_helper.create_corpus(encoded_dir, single_file_dataset, mapping_path, args.sequence_length),
+                            profile_dir, symbols=lambda path: len(np.load(path, mmap_mode="r")))
+    corpus_symbols = len(np.load(corpus_path, mmap_mode="r"))
+
+    if not args.skip_one_hot:
+        run_stage(results, "one_hot_sequences", size,
+                  lambda: music_helper.generate_training_sequences(args.sequence_length, single_file_dataset, mapping_path),
+                  profile_dir, symbols=corpus_symbols)
+
+    def iterate_batches():
+        sequence = music_helper.create_training_sequence(args.sequence_length, single_file_dataset, mapping_path, args.batch_size)
+        for i in range(len(sequence)):
+            sequence[i]
+    run_stage(results, "batched_sequences", size, iterate_batches, profile_dir, symbols=corpus_symbols)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wall time, peak memory and throughput of every song_data_pipeline stage")
+    parser.add_argument("--dataset", default=None, help="A folder of songs, a synthetic dataset is generated when missing")
+    parser.add_argument("--file-type", default=None, help="The file type to load, defaults to krn for --dataset and musicxml otherwise")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200], help="How many songs each run uses")
+    parser.add_argument("--workers", type=int, default=0, help="Processes for preprocess_songs, 0 uses one per core")
+    parser.add_argument("--song-length", type=int, default=256, help="Time steps per synthetic song")
+    parser.add_argument("--sequence-length", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--time-step", type=float, default=0.25)
+    parser.add_argument("--major-key", default="C")
+    parser.add_argument("--minor-key", default="A")
+    parser.add_argument("--skip-one-hot", action="store_true", help="Skip the full one-hot expansion, it can run out of memory")
+    parser.add_argument("--profile-dir", default=None, help="Write a cProfile .prof file per stage and size here")
+    parser.add_argument("--json", default=None, help="Write the results here, to compare runs across versions")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="symphony_pipeline_benchmark_")
+    try:
+        if args.dataset is None:
+            args.file_type = args.file_type or "musicxml"
+            dataset = synthetic_dataset(os.path.join(work_dir, "synthetic"), max(args.sizes), args.song_length, args.seed)
+        else:
+            args.file_type = args.file_type or "krn"
+            dataset = args.dataset
+        files = list(song_preprocessing.iter_song_files(dataset, args.file_type))
+        print(f"{len(files)} {args.file_type} files in {dataset}, working in {work_dir}\n")
+
+        results = []
+        for size in args.sizes:
+            if size > len(files):
+                print(f"Skipping {size} songs, the dataset only has {len(files)}")
+                continue
+            benchmark_size(results, files[:size], work_dir, args)
+            print()
+
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump({"arguments": vars(args), "results": results}, f, indent=4)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
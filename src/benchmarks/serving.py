@@ -0,0 +1,236 @@
+import sys
+sys.path.insert(0, "./common/")
+sys.path.insert(0, "./")  # main.py, for the in-process server
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import httpx
+import numpy as np
+from api_helper import EMOTIONS
+from file_helper import FileHelper
+
+# Run from the src/ folder like main.py, i.e:
+# python benchmarks/serving.py --stub --requests 200 --concurrency 1 4 16
+# python benchmarks/serving.py --instruments FolkLSTM --format wav --requests 100 --concurrency 8
+# python benchmarks/serving.py --url http://localhost:8000 --requests 100 --concurrency 8
+# Without --url the app from main.py is served by uvicorn on a thread of this process, --stub swaps the models for
+# generators that emit random symbols so it runs without the .h5 files.
+# The server side stages come from the Server-Timing header of /getSample, the client measures the rest:
+# ttfb is when the headers arrive, render_send is the streamed body (FluidSynth runs while the body is sent)
+
+SERVER_STAGES = ["model", "seed", "generate", "midi"]
+REPORTED_STAGES = SERVER_STAGES + ["queue", "render_send", "total"]
+
+
+class StubGenerator:
+    """ Stands in for a MelodyGenerator: random symbols from the model's mapping, optionally taking step_ms per step """
+
+    def __init__(self, mapping_path: str, file_helper: FileHelper, step_ms: float = 0.0):
+        self.symbols = [symbol for symbol in file_helper.loadJSON(mapping_path) if symbol != "/"]
+        self.step_ms = step_ms
+
+    def generate_melody(self, seed, num_steps: int, max_seq_len: int, temperature: float, rng_seed: int = None, **kwargs):
+        seed = seed.split() if isinstance(seed, str) else list(seed)
+        rng = random.Random(rng_seed)
+        if self.step_ms > 0:
+            time.sleep(self.step_ms * num_steps / 1000)
+        return seed + [rng.choice(self.symbols) for _ in range(num_steps)]
+
+    def generate_melodies(self, seeds, num_steps, max_seq_len, temperature, rng_seeds=None, **kwargs):
+        rng_seeds = rng_seeds if rng_seeds is not None else [None] * len(seeds)
+        return [
+            self.generate_melody(seed, steps, seq_len, temp, rng_seed)
+            for seed, steps, seq_len, temp, rng_seed in zip(seeds, num_steps, max_seq_len, temperature, rng_seeds)
+        ]
+
+    def close(self) -> None:
+        pass
+
+
+def start_local_server(stub: bool, step_ms: float, port: int) -> str:
+    """ Imports main.py, optionally swaps its models for stubs, and serves it on a uvicorn thread """
+    import uvicorn
+    import main
+    from model_registry import ModelRegistry
+
+    if stub:
+        main.model_registry = ModelRegistry(
+            main.model_paths,
+            main.file_helper,
+            max_models=main.model_registry.max_models,
+            loader=lambda info: StubGenerator(info['mapping_path'], main.file_helper, step_ms)
+        )
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="benchmark-uvicorn", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def parse_server_timing(header: str) -> dict:
+    """ model;dur=0.1, generate;dur=84.2, steps;desc="57" -> {"model": 0.1, "generate": 84.2, "steps": 57} """
+    timings = {}
+    for metric in filter(None, (part.strip() for part in header.split(","))):
+        name, *params = [param.strip() for param in metric.split(";")]
+        for param in params:
+            key, _, value = param.partition("=")
+            if key == "dur":
+                timings[name] = float(value)
+            elif key == "desc":
+                timings[name] = float(value.strip('"'))
+    return timings
+
+
+async def timed_request(client: httpx.AsyncClient, url: str, body: dict) -> dict:
+    start = time.perf_counter()
+    async with client.stream("POST", f"{url}/getSample", json=body) as response:
+        ttfb = time.perf_counter()
+        size = 0
+        async for chunk in response.aiter_bytes():
+            size += len(chunk)
+    end = time.perf_counter()
+
+    result = {
+        "instrument": body["instrument_name"],
+        "emotion": body["emotion"],
+        "status": response.status_code,
+        "bytes": size,
+        "ttfb": (ttfb - start) * 1000,
+        "total": (end - start) * 1000,
+        "render_send": (end - ttfb) * 1000,
+        "pool_hit": response.headers.get("X-Sample-Pool") == "hit",
+        "cache_hit": response.headers.get("X-Render-Cache") == "hit"
+    }
+    timings = parse_server_timing(response.headers.get("Server-Timing", ""))
+    result.update(timings)
+    if all(stage in timings for stage in SERVER_STAGES):
+        # whatever the server stages don't account for before the headers: waiting on the pools, routing, the network
+        result["queue"] = max(result["ttfb"] - sum(timings[stage] for stage in SERVER_STAGES), 0.0)
+    return result
+
+
+async def run_load(url: str, combinations: list, requests: int, concurrency: int, audio_format: str, timeout: float):
+    """ concurrency clients send requests back to back, cycling through the instrument/emotion combinations """
+    jobs = itertools.islice(itertools.cycle(combinations), requests)
+    results = []
+
+    async def client_loop(client: httpx.AsyncClient):
+        for instrument_name, emotion in jobs:
+            body = {"instrument_name": instrument_name, "emotion": emotion, "format": audio_format}
+            try:
+                results.append(await timed_request(client, url, body))
+            except httpx.HTTPError as e:
+                results.append({"instrument": instrument_name, "emotion": emotion, "status": None, "error": str(e)})
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[client_loop(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def summarize(results: list, elapsed: float, concurrency: int) -> dict:
+    ok = [result for result in results if result.get("status") == 200]
+    statuses = {}
+    for result in results:
+        statuses[str(result.get("status"))] = statuses.get(str(result.get("status")), 0) + 1
+
+    stages = {}
+    for stage in REPORTED_STAGES:
+        values = np.array([result[stage] for result in ok if stage in result])
+        if len(values):
+            stages[stage] = {
+                "p50": round(float(np.percentile(values, 50)), 3),
+                "p95": round(float(np.percentile(values, 95)), 3),
+                "p99": round(float(np.percentile(values, 99)), 3)
+            }
+
+    steps = sum(result.get("steps", 0) for result in ok)
+    generate_seconds = sum(result.get("generate", 0.0) for result in ok) / 1000
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "statuses": statuses,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(ok) / elapsed, 2) if elapsed > 0 else None,
+        "pool_hits": sum(result["pool_hit"] for result in ok),
+        "cache_hits": sum(result["cache_hit"] for result in ok),
+        "steps_per_second": round(steps / generate_seconds, 1) if generate_seconds > 0 else None,
+        "stages_ms": stages
+    }
+
+
+def print_summary(summary: dict) -> None:
+    print(f"\nconcurrency {summary['concurrency']}: {summary['requests']} requests in {summary['seconds']}s, "
+          f"{summary['requests_per_second']} req/s, statuses {summary['statuses']}, "
+          f"{summary['pool_hits']} pool hits, {summary['cache_hits']} cache hits, "
+          f"{summary['steps_per_second']} generated steps/s")
+    for stage in REPORTED_STAGES:
+        if stage in summary["stages_ms"]:
+            values = summary["stages_ms"][stage]
+            print(f"  {stage:<12} p50 {values['p50']:10.3f} ms   p95 {values['p95']:10.3f} ms   p99 {values['p99']:10.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency breakdown and throughput of /getSample")
+    parser.add_argument("--url", default=None, help="A running server, by default main.py is served on a thread of this process")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the in-process server")
+    parser.add_argument("--stub", action="store_true", help="Replace the models with random symbol generators (in-process only)")
+    parser.add_argument("--stub-step-ms", type=float, default=0.0, help="How long a stub generation step takes")
+    parser.add_argument("--instruments", nargs="+", default=None, help="Keys of model_info.json, all of them by default")
+    parser.add_argument("--emotions", nargs="+", default=EMOTIONS)
+    parser.add_argument("--format", default="wav", help="The audio format to request, midi skips FluidSynth")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--warmup", type=int, default=None, help="Untimed requests first, one per instrument by default")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", default=None, help="Write the summaries and every request here")
+    args = parser.parse_args()
+
+    file_helper = FileHelper()
+    model_info = file_helper.loadJSON("./model_info.json")
+    instruments = args.instruments or list(model_info.keys())
+    if not args.stub and args.url is None:
+        # without the model files these would only measure the 500s
+        missing = [name for name in instruments if not os.path.exists(model_info[name]['model_path'])]
+        if missing:
+            print(f"Skipping instruments without a model file (use --stub to include them): {', '.join(missing)}")
+        instruments = [name for name in instruments if name not in missing]
+    if not instruments:
+        sys.exit("No instruments to benchmark")
+    if args.stub and args.url is not None:
+        sys.exit("--stub only works with the in-process server")
+
+    url = args.url or start_local_server(args.stub, args.stub_step_ms, args.port)
+    combinations = [(instrument_name, emotion) for instrument_name in instruments for emotion in args.emotions]
+    print(f"Benchmarking {url}/getSample with {len(instruments)} instruments x {len(args.emotions)} emotions as {args.format}")
+
+    # the first request per instrument pays for loading its model, keep that out of the numbers
+    warmup = args.warmup if args.warmup is not None else len(instruments)
+    if warmup > 0:
+        asyncio.run(run_load(url, [(name, args.emotions[0]) for name in instruments], warmup, 1, args.format, args.timeout))
+
+    summaries = []
+    all_results = []
+    for concurrency in args.concurrency:
+        results, elapsed = asyncio.run(run_load(url, combinations, args.requests, concurrency, args.format, args.timeout))
+        summary = summarize(results, elapsed, concurrency)
+        print_summary(summary)
+        summaries.append(summary)
+        all_results.append({"concurrency": concurrency, "results": results})
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"arguments": vars(args), "summaries": summaries, "requests": all_results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
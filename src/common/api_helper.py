@@ -1,27 +1,45 @@
+import os
 import random
+import threading
 
-def delete_files(file):
-    if file.endswith(".wav") or file.endswith(".mid"):
-        return True
-    else:
-        return False
+# the emotions determine_metaparameters has settings for
+EMOTIONS = ["happy", "calm", "melancholy", "surprised"]
+
+# the symbols of every mapping determine_seed has read, keyed by path and checked against the file's mtime/size so
+# a retrained model's mapping is picked up without a restart
+_seed_symbols = {}
+_seed_symbols_lock = threading.Lock()
+
+def load_seed_symbols(mappings_path: str, file_helper) -> list:
+    """ The symbols of a mapping file, only parsed again when the file changes. Called at startup to pre-parse them """
+    stat = os.stat(mappings_path)
+    signature = (stat.st_mtime, stat.st_size)
+    with _seed_symbols_lock:
+        cached = _seed_symbols.get(mappings_path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    symbols = list(file_helper.loadJSON(mappings_path).keys())
+    with _seed_symbols_lock:
+        _seed_symbols[mappings_path] = (signature, symbols)
+    return symbols
 
-def determine_seed(mappings_path: str, file_helper):
-    note_mappings = file_helper.loadJSON(mappings_path)
+# both take an rng so a request with an rng_seed can pass its own random.Random and always get the same values
+def determine_seed(mappings_path: str, file_helper, rng=random):
     note_hold = "_"
     rest = "r"
     song_end = "/"
 
     seed = []
 
-    seed_range = random.randint(2, 6)
-    note_mappings = list(note_mappings.keys())
+    seed_range = rng.randint(2, 6)
+    note_mappings = load_seed_symbols(mappings_path, file_helper)
     for i in range(seed_range):
 
         # make sure we dont generate a hold or rest at the beginning
         valid_note = False
         while not valid_note:
-            new_note = random.choice(note_mappings)
+            new_note = rng.choice(note_mappings)
 
             if new_note == rest and i >= 1:
                 valid_note = True 
@@ -32,33 +50,33 @@ def determine_seed(mappings_path: str, file_helper):
         seed.append(new_note)
 
         # generate a random duration
-        note_duration = random.randint(1, 4)
+        note_duration = rng.randint(1, 4)
         for _ in range(note_duration):
             seed.append(note_hold)
 
     return seed
 
-def determine_metaparameters(emotion: str):
+def determine_metaparameters(emotion: str, rng=random):
     if emotion == "happy":
-        num_steps = random.randint(8, 32)
-        max_seq_len = random.randint(num_steps, (num_steps*2))
-        temperature = round(random.uniform(0.3, 1.5), 2)
+        num_steps = rng.randint(8, 32)
+        max_seq_len = rng.randint(num_steps, (num_steps*2))
+        temperature = round(rng.uniform(0.3, 1.5), 2)
     elif emotion == "calm":
-        num_steps = random.randint(32, 64)
-        max_seq_len = random.randint(num_steps, (num_steps*2))
-        temperature = round(random.uniform(0.2, 0.8), 2)
+        num_steps = rng.randint(32, 64)
+        max_seq_len = rng.randint(num_steps, (num_steps*2))
+        temperature = round(rng.uniform(0.2, 0.8), 2)
     elif emotion == "melancholy":
-        num_steps = random.randint(8, 42)
-        max_seq_len = random.randint(num_steps, (num_steps*2))
-        temperature = round(random.uniform(0.3, 1.0), 2)
+        num_steps = rng.randint(8, 42)
+        max_seq_len = rng.randint(num_steps, (num_steps*2))
+        temperature = round(rng.uniform(0.3, 1.0), 2)
     elif emotion == "surprised":
-        num_steps = random.randint(8, 32)
-        max_seq_len = random.randint(num_steps, (num_steps*2))
-        temperature = round(random.uniform(0.8, 2.0), 2)
+        num_steps = rng.randint(8, 32)
+        max_seq_len = rng.randint(num_steps, (num_steps*2))
+        temperature = round(rng.uniform(0.8, 2.0), 2)
     else:
         print("No emotion found... setting random variables")
-        num_steps = random.randint(8, 64)
-        max_seq_len = random.randint(num_steps, (num_steps*2))
-        temperature = round(random.uniform(0.3, 2.5), 2)
+        num_steps = rng.randint(8, 64)
+        max_seq_len = rng.randint(num_steps, (num_steps*2))
+        temperature = round(rng.uniform(0.3, 2.5), 2)
 
     return num_steps, max_seq_len, temperature
\ No newline at end of file
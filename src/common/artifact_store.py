@@ -0,0 +1,229 @@
+import os
+import time
+import uuid
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+
+class Artifact:
+    def __init__(self, artifact_id: str, size: int, path: str = None):
+        self.id = artifact_id
+        self.size = size
+        self.path = path
+        self.created = time.time()
+        self.refs = 1
+
+
+class ArtifactStore(ABC):
+    """
+    Holds the short lived files a request produces (i.e: the midi FluidSynth reads) until nothing uses them anymore.
+    put hands back an artifact with one reference, whoever is done with it calls release and the last release
+    deletes it. A janitor thread removes artifacts older than ttl, even referenced ones, so a response that never
+    finishes can't leak them, and drops the oldest artifacts when the store grows past max_bytes. Readers like
+    FluidSynth load the file when they start, so removing a referenced artifact doesn't break a running render
+    """
+    name = "base"
+
+    def __init__(self, ttl: float = 600.0, max_bytes: int = 256 * 1024 * 1024, janitor_interval: float = 30.0):
+        """
+        :param ttl (float): Seconds after which an artifact is removed no matter what
+        :param max_bytes (int): Upper bound on the summed size of the artifacts, 0 means unbounded
+        :param janitor_interval (float): Seconds between two janitor passes
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.janitor_interval = janitor_interval
+
+        self._artifacts = OrderedDict()  # oldest first
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.created = 0
+        self.released = 0
+        self.expired = 0
+        self.evicted = 0
+
+        self._stopped = threading.Event()
+        self._janitor = threading.Thread(target=self._janitor_loop, name=f"artifact-janitor-{self.name}", daemon=True)
+        self._janitor.start()
+
+    @abstractmethod
+    def _write(self, artifact_id: str, data: bytes, suffix: str) -> str:
+        """ Stores the bytes, returns the path they can be read from or None when they don't live on disk """
+
+    @abstractmethod
+    def _delete(self, artifact: Artifact) -> None:
+        pass
+
+    @abstractmethod
+    def read(self, artifact: Artifact) -> bytes:
+        pass
+
+    def put(self, data: bytes, suffix: str = "") -> Artifact:
+        """
+        :param data (bytes): The contents of the artifact
+        :param suffix (str): i.e: ".mid", tools like FluidSynth go by the extension
+        :return (Artifact): Holding one reference, release it when done
+        """
+        artifact_id = uuid.uuid4().hex
+        path = self._write(artifact_id, data, suffix)
+        artifact = Artifact(artifact_id, len(data), path)
+
+        with self._lock:
+            self._artifacts[artifact_id] = artifact
+            self._size += artifact.size
+            self.created += 1
+        return artifact
+
+    def acquire(self, artifact: Artifact) -> None:
+        with self._lock:
+            artifact.refs += 1
+
+    def release(self, artifact: Artifact) -> None:
+        """ Drops a reference, the artifact is deleted with the last one """
+        with self._lock:
+            artifact.refs -= 1
+            if artifact.refs > 0 or self._artifacts.pop(artifact.id, None) is None:
+                return
+            self._size -= artifact.size
+            self.released += 1
+        self._delete(artifact)
+
+    def _collect(self) -> None:
+        """ One janitor pass """
+        now = time.time()
+        doomed = []
+        with self._lock:
+            for artifact in list(self._artifacts.values()):
+                if now - artifact.created > self.ttl:
+                    doomed.append(self._artifacts.pop(artifact.id))
+                    self._size -= artifact.size
+                    self.expired += 1
+
+            if self.max_bytes > 0:
+                while self._size > self.max_bytes and self._artifacts:
+                    _, artifact = self._artifacts.popitem(last=False)
+                    doomed.append(artifact)
+                    self._size -= artifact.size
+                    self.evicted += 1
+
+        for artifact in doomed:
+            self._delete(artifact)
+
+    def _janitor_loop(self) -> None:
+        while not self._stopped.wait(self.janitor_interval):
+            try:
+                self._collect()
+            except Exception as e:
+                print(f"The artifact janitor failed with error: {e}")
+
+    def close(self) -> None:
+        """ Stops the janitor and deletes everything that is left """
+        self._stopped.set()
+        with self._lock:
+            leftovers = list(self._artifacts.values())
+            self._artifacts.clear()
+            self._size = 0
+        for artifact in leftovers:
+            self._delete(artifact)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.name,
+                "artifacts": len(self._artifacts),
+                "size_bytes": self._size,
+                "created": self.created,
+                "released": self.released,
+                "expired": self.expired,
+                "evicted": self.evicted
+            }
+
+
+class DiskArtifactStore(ArtifactStore):
+    """ Every artifact is its own file, by default in shared memory so nothing touches the disk """
+    name = "disk"
+
+    def __init__(self, directory: str = None, **kwargs):
+        """
+        :param directory (str): Where the files go, defaults to a folder in /dev/shm (or the temp dir without it)
+        """
+        if directory is None:
+            shm = os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK)
+            directory = os.path.join("/dev/shm" if shm else tempfile.gettempdir(), "symphony_artifacts")
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(**kwargs)
+
+    def _collect(self) -> None:
+        """ Also removes files nobody tracks anymore once they are older than ttl, i.e: left behind by a crash """
+        super()._collect()
+
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            tracked = {os.path.basename(artifact.path) for artifact in self._artifacts.values()}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name not in tracked and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    self.expired += 1
+            except OSError:
+                pass
+
+    def _write(self, artifact_id: str, data: bytes, suffix: str) -> str:
+        path = os.path.join(self.directory, artifact_id + suffix)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def _delete(self, artifact: Artifact) -> None:
+        try:
+            os.remove(artifact.path)
+        except OSError:
+            pass
+
+    def read(self, artifact: Artifact) -> bytes:
+        with open(artifact.path, "rb") as f:
+            return f.read()
+
+
+class MemoryArtifactStore(ArtifactStore):
+    """
+    Keeps the bytes in memory. Artifacts have no path, and FluidSynth can only read a midi from a file, so renders
+    still write the midi to a temp file of their own (in SYMPHONY_TMP_DIR)
+    """
+    name = "memory"
+
+    def __init__(self, **kwargs):
+        self._data = {}
+        super().__init__(**kwargs)
+
+    def _write(self, artifact_id: str, data: bytes, suffix: str) -> str:
+        self._data[artifact_id] = data
+        return None
+
+    def _delete(self, artifact: Artifact) -> None:
+        self._data.pop(artifact.id, None)
+
+    def read(self, artifact: Artifact) -> bytes:
+        return self._data[artifact.id]
+
+
+ARTIFACT_STORES = {
+    DiskArtifactStore.name: DiskArtifactStore,
+    MemoryArtifactStore.name: MemoryArtifactStore
+}
+
+
+def create_artifact_store(name: str, **kwargs) -> ArtifactStore:
+    """
+    :param name (str): "disk" or "memory"
+    :param kwargs: Passed to the store, see ArtifactStore and DiskArtifactStore
+    :return (ArtifactStore):
+    """
+    if name not in ARTIFACT_STORES:
+        raise ValueError(f"Unknown artifact store {name}, expected one of {list(ARTIFACT_STORES.keys())}")
+    return ARTIFACT_STORES[name](**kwargs)
@@ -0,0 +1,145 @@
+import shutil
+import tempfile
+import threading
+import subprocess
+from typing import Iterator
+
+# The formats a client can ask for. "ffmpeg" holds the output arguments used to encode the rendered PCM,
+# wav and midi need no encoder at all
+AUDIO_FORMATS = {
+    "wav": {"media_type": "audio/wav", "extension": "wav"},
+    "midi": {"media_type": "audio/midi", "extension": "mid"},
+    "flac": {"media_type": "audio/flac", "extension": "flac", "encoder": "flac", "ffmpeg": ["-c:a", "flac", "-f", "flac"]},
+    "ogg": {"media_type": "audio/ogg", "extension": "ogg", "encoder": "libvorbis", "ffmpeg": ["-c:a", "libvorbis", "-f", "ogg"]},
+    # opus only supports 48kHz among the usual rates, so it gets resampled
+    "opus": {"media_type": "audio/ogg", "extension": "opus", "encoder": "libopus", "ffmpeg": ["-c:a", "libopus", "-ar", "48000", "-f", "ogg"]},
+    "mp3": {"media_type": "audio/mpeg", "extension": "mp3", "encoder": "libmp3lame", "ffmpeg": ["-c:a", "libmp3lame", "-f", "mp3"]}
+}
+
+# Used for instruments that don't list their own "audio_formats" in model_info.json
+DEFAULT_INSTRUMENT_FORMATS = {
+    "wav": {},
+    "midi": {},
+    "flac": {},
+    "ogg": {"bitrate": "128k"},
+    "opus": {"bitrate": "96k"},
+    "mp3": {"bitrate": "128k"}
+}
+
+_encoders = None
+_encoders_lock = threading.Lock()
+
+
+def available_encoders() -> set:
+    """ The audio encoders the local ffmpeg was built with, asked for once and then cached """
+    global _encoders
+    with _encoders_lock:
+        if _encoders is None:
+            _encoders = set()
+            if shutil.which("ffmpeg") is not None:
+                try:
+                    output = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=10).stdout
+                    for line in output.splitlines():
+                        parts = line.split()
+                        # i.e: " A..... libopus   libopus Opus", only audio encoders start with an A flag
+                        if len(parts) >= 2 and parts[0].startswith("A"):
+                            _encoders.add(parts[1])
+                except Exception as e:
+                    print(f"Could not list the ffmpeg encoders: {e}")
+        return _encoders
+
+
+def is_format_available(audio_format: str) -> bool:
+    if audio_format not in AUDIO_FORMATS:
+        return False
+    encoder = AUDIO_FORMATS[audio_format].get("encoder")
+    return encoder is None or encoder in available_encoders()
+
+
+def instrument_formats(model_info: dict) -> dict:
+    """
+    :param model_info (dict): One entry of model_info.json
+    :return (dict): format -> settings (i.e: {"bitrate": "96k"}) the instrument can be served in
+    """
+    return model_info.get("audio_formats", DEFAULT_INSTRUMENT_FORMATS)
+
+
+def encode_pcm_stream(pcm_chunks: Iterator[bytes], audio_format: str, bitrate: str = None, sample_rate: int = 44100,
+                      channels: int = 2, chunk_size: int = 16 * 1024) -> Iterator[bytes]:
+    """
+    Pipes 16 bit PCM chunks through ffmpeg and yields the encoded bytes as they come out. A feeder thread writes the
+    PCM into ffmpeg while this generator reads its output, so encoding runs alongside synthesis. Once the output is
+    drained it raises whatever the PCM source raised, or a RuntimeError when ffmpeg failed, so a broken encode never
+    passes for a complete file
+
+    :param pcm_chunks (Iterator[bytes]): i.e: render_helper.stream_pcm
+    :param audio_format (str): One of AUDIO_FORMATS that has an "ffmpeg" entry
+    :param bitrate (str): i.e: "96k", None lets the encoder decide
+    :param sample_rate (int): The rate of the incoming PCM
+    :param channels (int): The channel count of the incoming PCM
+    :param chunk_size (int): How many bytes are read from ffmpeg at a time
+    :return (Iterator[bytes]):
+    """
+    command = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0"
+    ]
+    command += AUDIO_FORMATS[audio_format]["ffmpeg"]
+    if bitrate is not None:
+        command += ["-b:a", bitrate]
+    command.append("pipe:1")
+
+    # ffmpeg's errors go to a file rather than a pipe, nobody reads them while it runs and a full pipe would stall it
+    stderr = tempfile.TemporaryFile()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+    feed_errors = []
+
+    def feed():
+        try:
+            for chunk in pcm_chunks:
+                process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            # ffmpeg went away (or got killed because the client left), nothing left to feed
+            pass
+        except Exception as e:
+            # i.e: the renderer failed, ffmpeg would otherwise finish a truncated file as if nothing happened
+            feed_errors.append(e)
+        finally:
+            try:
+                process.stdin.close()
+            except (BrokenPipeError, ValueError):
+                pass
+
+            # stops the upstream renderer if we finished early, done here since the generator belongs to this thread
+            if hasattr(pcm_chunks, "close"):
+                pcm_chunks.close()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        while True:
+            chunk = process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+        process.wait()
+        feeder.join()
+        if feed_errors:
+            raise feed_errors[0]
+        if process.returncode != 0:
+            stderr.seek(0)
+            message = stderr.read().decode("utf-8", errors="replace").strip()
+            raise RuntimeError(f"ffmpeg exited with code {process.returncode} while encoding {audio_format}: {message}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        feeder.join()
+        stderr.close()
+
+
+def encode_pcm(pcm: bytes, audio_format: str, bitrate: str = None, sample_rate: int = 44100, channels: int = 2) -> bytes:
+    """ encode_pcm_stream for audio that is already fully rendered """
+    return b"".join(encode_pcm_stream(iter([pcm]), audio_format, bitrate, sample_rate, channels))
@@ -0,0 +1,156 @@
+import time
+import queue
+import threading
+import numpy as np
+from typing import Callable, List
+
+
+class _PendingCall:
+    def __init__(self, inputs: List[np.ndarray]):
+        self.inputs = inputs
+        self.outputs = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchScheduler:
+    def __init__(self, run_batch: Callable, max_batch_size: int = 16, max_wait: float = 0.002, name: str = "",
+                 call_timeout: float = 60.0):
+        """
+        Collects the model calls that concurrent requests make within a small time window and runs them as one
+        batched call, every caller then gets back its own rows of the outputs.
+        Calls are only batched together when their inputs have the same shape past the batch dimension
+
+        :param run_batch (Callable): Takes a list of batched numpy inputs and returns a list of batched numpy outputs
+        :param max_batch_size (int): The most calls that are merged into one batch
+        :param max_wait (float): How long in seconds the first call of a batch waits for others to join it
+        :param name (str): Used to name the worker thread
+        :param call_timeout (float): How long in seconds submit waits for its batch before giving up, None waits forever
+        """
+        self._run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.call_timeout = call_timeout
+
+        self.batches = 0
+        self.calls = 0
+
+        self._queue = queue.Queue()
+        self._stopped = False
+        # stop can't slip in between submit's check and its put, so nothing is ever queued behind the stop signal
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._work, name=f"batch-scheduler-{name}", daemon=True)
+        self._worker.start()
+
+    def submit(self, inputs: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Blocks until the batch containing these inputs has been run
+
+        :param inputs (List[np.ndarray]): The model inputs for this call, each with a leading batch dimension
+        :return (List[np.ndarray]): The model outputs for this call only
+        """
+        pending = _PendingCall(inputs)
+        with self._lock:
+            if self._stopped:
+                raise Exception("BatchScheduler has been stopped")
+            self._queue.put(pending)
+
+        if not pending.done.wait(self.call_timeout):
+            raise TimeoutError(f"The batch was not run within {self.call_timeout}s")
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.outputs
+
+    def stop(self) -> None:
+        """ Lets the worker thread exit once it has finished the calls already queued """
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._queue.put(None)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "calls": self.calls,
+            "average_batch_size": round(self.calls / self.batches, 2) if self.batches else 0.0,
+            "queue_depth": self.queue_depth()
+        }
+
+    def _collect(self) -> List[_PendingCall]:
+        """ Waits for a first call, then gathers whatever else arrives before max_wait runs out or the batch is full """
+        first = self._queue.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                pending = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if pending is None:
+                # keep the stop signal for the next loop, this batch still has to run
+                self._queue.put(None)
+                break
+            batch.append(pending)
+        return batch
+
+    def _work(self) -> None:
+        try:
+            while True:
+                batch = self._collect()
+                if batch is None:
+                    return
+
+                # group the calls by input shape, i.e: single step calls vs longer ones
+                groups = {}
+                for pending in batch:
+                    key = tuple(x.shape[1:] for x in pending.inputs)
+                    groups.setdefault(key, []).append(pending)
+
+                for group in groups.values():
+                    self._run_group(group)
+        finally:
+            self._drain()
+
+    def _drain(self) -> None:
+        """ Fails whatever is still queued once the worker exits, so no caller is left waiting on a batch that never runs """
+        with self._lock:
+            self._stopped = True
+        while True:
+            try:
+                pending = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if pending is not None:
+                pending.error = Exception("BatchScheduler has been stopped")
+                pending.done.set()
+
+    def _run_group(self, group: List[_PendingCall]) -> None:
+        try:
+            num_inputs = len(group[0].inputs)
+            inputs = [np.concatenate([pending.inputs[i] for pending in group]) for i in range(num_inputs)]
+            outputs = self._run_batch(inputs)
+
+            # hand every caller back its own rows
+            offset = 0
+            for pending in group:
+                rows = pending.inputs[0].shape[0]
+                pending.outputs = [output[offset:offset + rows] for output in outputs]
+                offset += rows
+        except Exception as e:
+            for pending in group:
+                pending.error = e
+        finally:
+            self.batches += 1
+            self.calls += len(group)
+            for pending in group:
+                pending.done.set()
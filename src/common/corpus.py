@@ -0,0 +1,106 @@
+import os
+import json
+import numpy as np
+from array import array
+from typing import Iterable
+
+# The training corpus in two forms, written in a single pass over the encoded songs:
+# - the text file the pipeline always made (songs separated by sequence_length "/" symbols)
+# - the same symbols mapped to ints as a uint16 .npy, which is what training actually reads
+CORPUS_DTYPE = np.uint16
+SONG_DELIMITER = "/"
+
+
+def corpus_path_for(single_file_dataset_path: str) -> str:
+    """ Where the int corpus of a single file dataset goes, i.e: massive_song_file_data.txt -> massive_song_file_data.npy """
+    return os.path.splitext(single_file_dataset_path)[0] + ".npy"
+
+
+def load_mapping(mapping_path: str) -> dict:
+    if not os.path.exists(mapping_path):
+        return {}
+    with open(mapping_path) as f:
+        return json.load(f)
+
+
+def write_corpus(song_paths: Iterable[str], file_dataset_path: str, corpus_path: str, mapping_path: str,
+                 sequence_length: int, chunk_size: int = 1 << 20, extend_mapping: bool = False) -> dict:
+    """
+    Streams the encoded songs into the text dataset and the int corpus and builds the mapping from the symbols it
+    finds on the way. Only one song is held in memory at a time. The ints of the symbols are only known once every
+    song has been seen (they are given in sorted order, see MusicHelper.create_mapping), so the ints go to a
+    temporary file first and are remapped chunk by chunk into the .npy
+
+    :param song_paths (Iterable[str]): The encoded song files, in corpus order
+    :param file_dataset_path (str): The text dataset to write
+    :param corpus_path (str): The .npy int corpus to write
+    :param mapping_path (str): The mapping to write
+    :param sequence_length (int): How many delimiter symbols separate two songs
+    :param chunk_size (int): How many ints are remapped at a time
+    :param extend_mapping (bool): Keep the existing mapping and only add the new symbols, see MusicHelper.create_mapping.
+        By default the mapping is rebuilt from these songs alone
+    :return (dict): The updated mapping
+    """
+    mappings = load_mapping(mapping_path) if extend_mapping else {}
+    provisional = dict(mappings)
+    new_symbols = []
+
+    def to_int(symbol: str) -> int:
+        value = provisional.get(symbol)
+        if value is None:
+            value = len(provisional)
+            provisional[symbol] = value
+            new_symbols.append(symbol)
+        return value
+
+    delimiter = " ".join([SONG_DELIMITER] * sequence_length)
+    delimiter_ints = array("H", [to_int(SONG_DELIMITER)] * sequence_length) if sequence_length > 0 else array("H")
+
+    tmp_path = corpus_path + ".tmp"
+    length = 0
+    with open(file_dataset_path, "w") as text_file, open(tmp_path, "wb") as int_file:
+        first = True
+        for song_path in song_paths:
+            with open(song_path) as f:
+                song = f.read().strip()
+            symbols = song.split()
+
+            # same layout as joining "song /.../" pieces with spaces
+            if not first:
+                text_file.write(" ")
+            text_file.write(f"{song} {delimiter}" if sequence_length > 0 else song)
+            first = False
+
+            ints = array("H", [to_int(symbol) for symbol in symbols])
+            ints.tofile(int_file)
+            delimiter_ints.tofile(int_file)
+            length += len(ints) + len(delimiter_ints)
+
+            if len(provisional) > np.iinfo(CORPUS_DTYPE).max:
+                raise ValueError(f"The vocabulary has more than {np.iinfo(CORPUS_DTYPE).max} symbols, too many for {CORPUS_DTYPE.__name__}")
+
+    # new symbols get their final ints in sorted order after the ones the mapping already had
+    for i, symbol in enumerate(sorted(new_symbols), start=len(mappings)):
+        mappings[symbol] = i
+    lookup = np.arange(len(provisional), dtype=CORPUS_DTYPE)
+    for symbol in new_symbols:
+        lookup[provisional[symbol]] = mappings[symbol]
+
+    corpus = np.lib.format.open_memmap(corpus_path, mode="w+", dtype=CORPUS_DTYPE, shape=(length,))
+    if length > 0:
+        source = np.memmap(tmp_path, dtype=CORPUS_DTYPE, mode="r", shape=(length,))
+        for start in range(0, length, chunk_size):
+            corpus[start:start + chunk_size] = lookup[source[start:start + chunk_size]]
+        del source
+    corpus.flush()
+    del corpus
+    os.remove(tmp_path)
+
+    with open(mapping_path, "w+") as f:
+        json.dump(mappings, f, indent=4)
+    return mappings
+
+
+def load_corpus(corpus_path: str) -> np.ndarray:
+    """ The int corpus, memory mapped so it is paged in as it is read instead of loaded whole """
+    return np.load(corpus_path, mmap_mode="r")
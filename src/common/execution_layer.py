@@ -0,0 +1,237 @@
+import os
+import asyncio
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Callable
+
+
+class ExecutorSaturatedError(Exception):
+    """ Raised instead of queueing more work once a pool already has max_pending tasks in flight """
+    def __init__(self, pool_name: str, max_pending: int):
+        super().__init__(f"The {pool_name} pool is saturated ({max_pending} tasks in flight)")
+        self.pool_name = pool_name
+        self.max_pending = max_pending
+
+
+class Reservation:
+    def __init__(self, executor: "BoundedExecutor", count: int):
+        """
+        Slots taken on a BoundedExecutor ahead of the work that is going to use them (see BoundedExecutor.reserve),
+        so a request that got in can't be turned away halfway through. Every run uses up one of them and gives it back
+        once its task is done, release gives back the ones that were never used
+        """
+        self._executor = executor
+        self.remaining = count
+        self._lock = threading.Lock()
+
+    async def run(self, function: Callable, *args, **kwargs):
+        """ Like BoundedExecutor.run, on one of the reserved slots """
+        with self._lock:
+            if self.remaining <= 0:
+                raise RuntimeError(f"Every slot reserved on the {self._executor.name} pool has been used")
+            self.remaining -= 1
+        return await self._executor._submit(function, *args, **kwargs)
+
+    def release(self, completed: bool = False) -> None:
+        """
+        Gives back the slots that are left, calling it again does nothing
+
+        :param completed (bool): Count them as finished tasks, i.e: the slot was held by work done outside the pool
+        """
+        with self._lock:
+            count, self.remaining = self.remaining, 0
+        if count:
+            self._executor._release(count, completed=count if completed else 0)
+
+
+class RequestReservation:
+    def __init__(self, inference: Reservation, render: Reservation):
+        """ What ExecutionLayer.reserve took on both pools for one request, release gives back whatever is unused """
+        self.inference = inference
+        self.render = render
+
+    def release(self) -> None:
+        self.inference.release()
+        self.render.release()
+
+    def __enter__(self) -> "RequestReservation":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class BoundedExecutor:
+    def __init__(self, executor: Executor, max_pending: int, name: str):
+        """
+        Wraps a concurrent.futures executor so the event loop can await work on it, while refusing new work
+        once max_pending tasks are running or queued. A task counts as pending until the pool is done with it, even
+        when the request awaiting it has been cancelled in the meantime
+
+        :param executor (Executor): The thread or process pool that runs the work
+        :param max_pending (int): The most tasks that can be running or waiting at once
+        :param name (str): Used in errors and stats
+        """
+        self._executor = executor
+        self.max_pending = max_pending
+        self.name = name
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.deferred = 0
+        # slots are given back from the pool's threads and from the ones streaming responses
+        self._lock = threading.Lock()
+
+    def saturated(self) -> bool:
+        return self.pending >= self.max_pending
+
+    def _acquire(self, count: int = 1, limit: int = None) -> None:
+        """ limit is for background work, it gets a slot only while fewer tasks are in flight and counts as deferred """
+        with self._lock:
+            if limit is not None and self.pending + count > min(limit, self.max_pending):
+                self.deferred += 1
+                raise ExecutorSaturatedError(self.name, min(limit, self.max_pending))
+            if self.pending + count > self.max_pending:
+                self.rejected += 1
+                raise ExecutorSaturatedError(self.name, self.max_pending)
+            self.pending += count
+
+    def _release(self, count: int = 1, completed: int = 0) -> None:
+        with self._lock:
+            self.pending -= count
+            self.completed += completed
+
+    def reserve(self, count: int = 1) -> Reservation:
+        """
+        Takes count slots now for tasks that are going to be run later through the reservation, or for work that runs
+        outside the pool but has to count against it (i.e: audio that is synthesized while it streams from the API
+        process). The slots stay taken until they are used or released
+
+        :raises ExecutorSaturatedError: When fewer than count slots are free
+        """
+        self._acquire(count)
+        return Reservation(self, count)
+
+    async def run(self, function: Callable, *args, **kwargs):
+        """
+        Runs the function on the pool and waits for its result without blocking the event loop
+
+        :raises ExecutorSaturatedError: When max_pending tasks are already in flight
+        """
+        self._acquire()
+        return await self._submit(function, *args, **kwargs)
+
+    def call(self, function: Callable, *args, limit: int = None, **kwargs):
+        """
+        Like run, for threads outside the event loop: blocks until the pool is done with the function. Background work
+        (i.e: refilling the sample pool) passes a limit so it only takes a slot while fewer than limit tasks are in
+        flight, it never queues up in front of the requests that admission control lets in
+
+        :raises ExecutorSaturatedError: When the pool is saturated, or has limit tasks in flight
+        """
+        self._acquire(limit=limit)
+        return self._submit_future(function, *args, **kwargs).result()
+
+    async def _submit(self, function: Callable, *args, **kwargs):
+        """ Runs the function on a slot that has already been taken, see _submit_future """
+        return await asyncio.wrap_future(self._submit_future(function, *args, **kwargs))
+
+    def _submit_future(self, function: Callable, *args, **kwargs) -> Future:
+        """
+        Hands the function to the pool on a slot that has already been taken. The slot is given back when the pool is
+        done with the task rather than when whoever waits on it is, a cancelled request's task may well still be running
+        """
+        try:
+            future = self._executor.submit(functools.partial(function, *args, **kwargs))
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release(completed=1))
+        return future
+
+    def warm_up(self, function: Callable, *args, count: int = 1) -> None:
+        """
+        Runs the function count times at once straight on the pool and waits for it, so a process pool has its
+        workers started and their modules imported before the first request. Not counted in the stats
+        """
+        futures = [self._executor.submit(function, *args) for _ in range(count)]
+        for future in futures:
+            future.result()
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "deferred": self.deferred
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+class ExecutionLayer:
+    def __init__(self, inference_workers: int = 16, render_workers: int = 0, inference_queue: int = 32,
+                 render_queue: int = 32, render_processes: bool = True, render_initializer: Callable = None,
+                 render_initargs: tuple = ()):
+        """
+        Keeps the blocking parts of a request off the event loop. TF inference runs on a thread pool (TF releases
+        the GIL and the models have to be shared with the registry), music21/FluidSynth work runs on a process pool
+        so it can use every core
+
+        :param inference_workers (int): Threads used for model loading and generation
+        :param render_workers (int): Workers used for midi writing and audio rendering, 0 uses one per core
+        :param inference_queue (int): How many generations can wait for a free thread before requests get rejected
+        :param render_queue (int): How many renders can wait for a free worker before requests get rejected
+        :param render_processes (bool): Render in processes, False renders in threads (useful for debugging)
+        :param render_initializer (Callable): Runs in every render worker before its first task, i.e: to set up its synths
+        :param render_initargs (tuple): The arguments of render_initializer
+        """
+        render_workers = render_workers if render_workers > 0 else (os.cpu_count() or 1)
+        self.inference_workers = inference_workers
+        self.render_workers = render_workers
+
+        self.inference = BoundedExecutor(
+            ThreadPoolExecutor(max_workers=inference_workers, thread_name_prefix="inference"),
+            inference_workers + inference_queue,
+            "inference"
+        )
+
+        if render_processes:
+            # spawn so the workers don't inherit a forked copy of the TF runtime from the API process
+            render_executor = ProcessPoolExecutor(max_workers=render_workers, mp_context=multiprocessing.get_context("spawn"),
+                                                  initializer=render_initializer, initargs=render_initargs)
+        else:
+            render_executor = ThreadPoolExecutor(max_workers=render_workers, thread_name_prefix="render",
+                                                 initializer=render_initializer, initargs=render_initargs)
+        self.render = BoundedExecutor(render_executor, render_workers + render_queue, "render")
+
+    def reserve(self, render_tasks: int = 1, inference_tasks: int = 1) -> RequestReservation:
+        """
+        Takes every slot a request is going to need on both pools up front, so we never generate a melody we can't
+        render. The request runs its work through the reservation and releases it once it is done
+
+        :param render_tasks (int): How many render tasks the request is going to need
+        :param inference_tasks (int): How many generations the request runs at once
+        :raises ExecutorSaturatedError: When either pool doesn't have that many free slots, nothing is taken then
+        """
+        inference = self.inference.reserve(inference_tasks)
+        try:
+            render = self.render.reserve(render_tasks)
+        except ExecutorSaturatedError:
+            inference.release()
+            raise
+        return RequestReservation(inference, render)
+
+    def stats(self) -> dict:
+        return {
+            "inference": self.inference.stats(),
+            "render": self.render.stats()
+        }
+
+    def shutdown(self) -> None:
+        self.inference.shutdown()
+        self.render.shutdown()
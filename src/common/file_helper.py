@@ -20,6 +20,10 @@ class FileHelper:
         except Exception:
             raise Exception(f"Error reading file at: {file_path}")
 
+    def load_file_as_str(self, file_path: str) -> str:
+        """ Same as loadFile, the name MusicHelper uses """
+        return self.loadFile(file_path)
+
     def loadJSON(self, file_path) -> dict:
         try:
             with open(file_path) as json_data:
@@ -40,4 +44,11 @@ class FileHelper:
             with open(save_path, "w+") as fp:
                 fp.write(data)
         except Exception:
-            raise Exception(f"Error with trying to save file at: {save_path}")
\ No newline at end of file
+            raise Exception(f"Error with trying to save file at: {save_path}")
+
+    def saveBytes(self, data: bytes, save_path) -> None:
+        try:
+            with open(save_path, "wb+") as fp:
+                fp.write(data)
+        except Exception:
+            raise Exception(f"Error with trying to save file at: {save_path}")
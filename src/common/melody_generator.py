@@ -1,14 +1,123 @@
 import tensorflow.keras as keras
 import tensorflow as tf
-import json
+import os
+import tempfile
+import threading
+import time
 import numpy as np
-import music21 as m21
 from typing import List
 from file_helper import FileHelper
+from batch_scheduler import BatchScheduler
+from vocabulary import Vocabulary
+from sampling import Sampler
+from metrics import REGISTRY
+import render_helper
+
+GENERATION_STEPS = REGISTRY.counter("symphony_generation_steps_total", "Symbols generated", ["model", "decoding"])
+GENERATION_SECONDS = REGISTRY.histogram("symphony_generation_seconds", "Time spent generating a melody (or a batch of them)",
+                                        ["model", "decoding"])
+SAVE_SECONDS = REGISTRY.histogram("symphony_save_melody_seconds", "Time spent writing a melody to a file", ["model", "format"])
+
+
+class InferenceBackend:
+    """
+    Runs a keras model on a list of numpy inputs and returns a list of numpy outputs.
+    This base backend is the original keras model.predict call, the others avoid its per call setup cost
+    """
+    name = "predict"
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, inputs: List[np.ndarray]) -> List[np.ndarray]:
+        outputs = self.model.predict(inputs if len(inputs) > 1 else inputs[0])
+        return outputs if isinstance(outputs, list) else [outputs]
+
+
+class FunctionBackend(InferenceBackend):
+    """ Calls the model directly inside a tf.function traced once for a fixed input signature """
+    name = "function"
+
+    def __init__(self, model):
+        super().__init__(model)
+
+        # the batch and time dimensions are left as None so one trace covers every seed length
+        signature = [[tf.TensorSpec(shape=tensor.shape, dtype=tensor.dtype) for tensor in model.inputs]]
+        self._function = tf.function(lambda inputs: _as_list(model(inputs if len(inputs) > 1 else inputs[0], training=False)),
+                                     input_signature=signature)
+
+    def __call__(self, inputs: List[np.ndarray]) -> List[np.ndarray]:
+        return [output.numpy() for output in self._function(list(inputs))]
+
+
+class SavedModelBackend(InferenceBackend):
+    """ Exports the model as a SavedModel with a named serving signature and serves it from the reloaded graph """
+    name = "saved_model"
+
+    def __init__(self, model, export_dir: str = None):
+        super().__init__(model)
+        self.export_dir = _export_saved_model(model, export_dir)
+        self._signature = tf.saved_model.load(self.export_dir).signatures["serving_default"]
+        self._num_outputs = len(_as_list(model.outputs))
+
+    def __call__(self, inputs: List[np.ndarray]) -> List[np.ndarray]:
+        outputs = self._signature(**{f"input_{i:02d}": tf.constant(x) for i, x in enumerate(inputs)})
+        return [outputs[f"output_{i:02d}"].numpy() for i in range(self._num_outputs)]
+
+
+INFERENCE_BACKENDS = {
+    backend.name: backend for backend in [InferenceBackend, FunctionBackend, SavedModelBackend]
+}
+
+
+def create_inference_backend(name: str, model, export_dir: str = None) -> InferenceBackend:
+    """
+    :param name (str): One of INFERENCE_BACKENDS, i.e: "function"
+    :param model (keras.Model): The model the backend runs
+    :param export_dir (str): Where the saved_model backend exports to, a temporary directory when None
+    :return (InferenceBackend):
+    """
+    if name not in INFERENCE_BACKENDS:
+        raise Exception(f"Unknown inference backend: {name}, expected one of {list(INFERENCE_BACKENDS.keys())}")
+
+    if name == "saved_model":
+        # the export depends on what the installed TF can save, the direct call always works
+        try:
+            return INFERENCE_BACKENDS[name](model, export_dir)
+        except Exception as e:
+            print(f"Could not set up the {name} inference backend, falling back to function: {e}")
+            return FunctionBackend(model)
+    return INFERENCE_BACKENDS[name](model)
+
+
+def _as_list(outputs) -> list:
+    return list(outputs) if isinstance(outputs, (list, tuple)) else [outputs]
+
+
+def _export_saved_model(model, export_dir: str = None) -> str:
+    """ Saves the model with named inputs (input_00, ...) and outputs (output_00, ...) so they can be fed by name """
+    if export_dir is None:
+        export_dir = tempfile.mkdtemp(prefix="symphony_export_")
+
+    signature = [[
+        tf.TensorSpec(shape=tensor.shape, dtype=tensor.dtype, name=f"input_{i:02d}")
+        for i, tensor in enumerate(model.inputs)
+    ]]
+
+    @tf.function(input_signature=signature)
+    def serve(inputs):
+        outputs = _as_list(model(inputs if len(inputs) > 1 else inputs[0], training=False))
+        return {f"output_{i:02d}": output for i, output in enumerate(outputs)}
+
+    module = tf.Module()
+    module.model = model
+    tf.saved_model.save(module, export_dir, signatures={"serving_default": serve.get_concrete_function()})
+    return export_dir
 
 
 class MelodyGenerator:
-    def __init__(self, model_path: str, file_helper: FileHelper, mapping_path: str, sequence_length: int, cpu = True):
+    def __init__(self, model_path: str, file_helper: FileHelper, mapping_path: str, sequence_length: int, cpu = True,
+                 inference_backend: str = "function", export_dir: str = None, name: str = None):
         """
         Our constructor for the MelodyGenerator class
 
@@ -16,7 +125,11 @@ class MelodyGenerator:
         :param file_helper (FileHelper):
         :param mapping_path (str): Where are the mappings for the model being stored?
         :param sequence_length(int):
+        :param inference_backend (str): How the model is run every step, one of INFERENCE_BACKENDS
+        :param export_dir (str): Where the saved_model backend exports the model to, a temporary directory when None
+        :param name (str): The model label of the generation metrics, the model file name when None
         """
+        self.name = name if name is not None else os.path.splitext(os.path.basename(model_path))[0]
 
         # The CPU is normally fast enough to do inference, and this makes local development easier
         if cpu:
@@ -28,9 +141,75 @@ class MelodyGenerator:
         self._file_helper = file_helper
         self._start_symbols = ["/"] * sequence_length # This acts as our song delimtter 
         self._mappings = self._file_helper.loadJSON(mapping_path)
+        self.vocabulary = Vocabulary(self._mappings)
+
+        # models with an Embedding take the mapped ints as they are, (batch, time) instead of (batch, time, vocabulary)
+        self.token_input = len(self.model.input_shape) == 2
+
+        self.inference_backend = inference_backend
+        self._export_dir = export_dir
+        self._backend = create_inference_backend(inference_backend, self.model, self._export_subdir("full"))
+
+        # used for incremental decoding, see _build_step_model
+        self._step_model = None
+        self._step_backend = None
+        self._step_model_built = False
+        self._step_model_lock = threading.Lock()
+        self._state_sizes = []
+
+        # single timestep calls from concurrent generations can be merged, see enable_batching
+        self._max_batch_size = 1
+        self._max_batch_wait = 0.0
+        self._step_scheduler = None
+
+    def enable_batching(self, max_batch_size: int = 16, max_wait: float = 0.002) -> None:
+        """
+        Runs the single timestep calls of concurrent incremental generations as one batched call.
+        Only useful when generate_melody is called from several threads at once
 
-    
-    def generate_melody(self, seed: str, num_steps: int, max_seq_len: int, temperature: float) -> List[str]:
+        :param max_batch_size (int): The most generation steps merged into one call
+        :param max_wait (float): How long in seconds a step waits for others to join its batch
+        :return (None):
+        """
+        with self._step_model_lock:
+            self._max_batch_size = max_batch_size
+            self._max_batch_wait = max_wait
+            if self._step_scheduler is not None:
+                self._step_scheduler.max_batch_size = max_batch_size
+                self._step_scheduler.max_wait = max_wait
+            elif self._step_backend is not None and max_batch_size > 1:
+                self._step_scheduler = BatchScheduler(self._step_backend, max_batch_size, max_wait, name=self.inference_backend)
+
+    @property
+    def active_backend(self) -> str:
+        """ The backend generation really runs on, a saved_model backend that could not be set up runs on function """
+        return type(self._backend).name
+
+    def batching_stats(self) -> dict:
+        return self._step_scheduler.stats() if self._step_scheduler is not None else {}
+
+    def close(self) -> None:
+        """ Stops the batching worker thread, the generator should not be used after this """
+        if self._step_scheduler is not None:
+            self._step_scheduler.stop()
+
+    def warm_up(self, num_steps: int = 8) -> None:
+        """
+        Runs a throwaway generation through every path a request can take (the step model, the batching scheduler
+        and the batched priming pass) so their graphs are built and traced before the first real request
+
+        :param num_steps (int): How many symbols each dummy generation produces
+        :return (None):
+        """
+        symbol = next((s for s in self._mappings if s not in ("/", "_", "r")), None)
+        if symbol is None:
+            return
+        seed = [symbol, "_"]
+        self.generate_melody(list(seed), num_steps, num_steps * 2, 1.0)
+        self.generate_melodies([list(seed), list(seed)], [num_steps] * 2, [num_steps * 2] * 2, [1.0] * 2)
+
+    def generate_melody(self, seed: str, num_steps: int, max_seq_len: int, temperature: float, decoding: str = "incremental",
+                        top_k: int = 0, top_p: float = 1.0, rng_seed: int = None) -> List[str]:
         """ 
         Generates a melody from a starting seed and returns a list of symbols that can undergo
         additional processing
@@ -39,6 +218,12 @@ class MelodyGenerator:
         :param num_steps (int): How far we want the network to predict
         :param max_seq_len (int): ow many steps of the seeds do we want to consider for the network (the seed will grow large)
         :param temperature (float): How creative we want our model to be
+        :param decoding (str): "incremental" carries the LSTM state between steps, "windowed" re-runs the model over the
+            last max_seq_len symbols every step. Incremental falls back to windowed for models it can't rebuild
+        :param top_k (int): Only sample from the k most likely symbols, 0 keeps them all
+        :param top_p (float): Only sample from the most likely symbols adding up to this probability, 1.0 keeps them all
+        :param rng_seed (int): Seeds the sampler so the same inputs always give the same melody. These steps skip the
+            batching scheduler, batched calls can round differently depending on who else is in the batch
         :return (List[str]):
         """
 
@@ -52,30 +237,35 @@ class MelodyGenerator:
         seed = self._start_symbols + seed
 
         # map seed to int
-        seed = [self._mappings[symbol] for symbol in seed]
+        seed = self.vocabulary.encode(seed)
+        sampler = Sampler(len(self.vocabulary), seed=rng_seed, top_k=top_k, top_p=top_p)
+        start = time.perf_counter()
+        seed_length = len(melody)
+
+        if decoding == "incremental" and self._get_step_model() is not None:
+            melody = self._generate_incremental(melody, seed, num_steps, max_seq_len, temperature, sampler,
+                                                batched=rng_seed is None)
+            self._record_generation("incremental", start, len(melody) - seed_length)
+            return melody
 
         for _ in range(num_steps):
             # limit the seed to max_seq_len
             seed = seed[-max_seq_len:] 
 
-            # one-hot encode the seed
-            # The mappings is the "vocabulary" of the object
-            onehot_seed = keras.utils.to_categorical(seed, num_classes=len(self._mappings))
-
-            # Keras expects 3-dimensions for predict so we use numpy to add that
-            # (1, max_seq_len, len(mappings))
-            onehot_seed = onehot_seed[np.newaxis, ...]
+            # one-hot encode the seed, keras expects 3-dimensions
+            # (1, max_seq_len, len(mappings)), or (1, max_seq_len) for embedding models
+            encoded_seed = self._encode(seed)
 
             # inference stage, this will result in a distribution of probabilities, but we just want the first/most likely one
             # i.e: [0.]
-            probabilities = self.model.predict(onehot_seed)[0]
-            output_int = self._sample_with_temperature(probabilities, temperature)
+            probabilities = self._backend([encoded_seed])[0][0]
+            output_int = sampler.sample(probabilities, temperature)
 
             # update seed
             seed.append(output_int)
 
             # map int to our encoding
-            output_symbol = [k for k, v in self._mappings.items() if v == output_int][0]
+            output_symbol = self.vocabulary.decode(output_int)
 
             # check whether we're at the end of a melody
             if output_symbol == "/":
@@ -84,112 +274,271 @@ class MelodyGenerator:
             # update the melody
             melody.append(output_symbol)
 
+        self._record_generation("windowed", start, len(melody) - seed_length)
         return melody
 
+    def _record_generation(self, decoding: str, start: float, steps: int) -> None:
+        GENERATION_SECONDS.observe(time.perf_counter() - start, model=self.name, decoding=decoding)
+        GENERATION_STEPS.inc(steps, model=self.name, decoding=decoding)
 
-    def _sample_with_temperature(self, probabilities: List[float], temperature: float) -> int:
-        """ 
-        Uses some clever math to pick an encoding based on model output probabilities
-        
-        :param probabilities (List[float]): The output of the model associated with probabilites
+    def generate_melodies(self, seeds: List[List[str]], num_steps: List[int], max_seq_len: List[int], temperature: List[float],
+                          top_k: int = 0, top_p: float = 1.0, rng_seeds: List[int] = None) -> List[List[str]]:
+        """
+        Generates one melody per seed, running every step of all the melodies as one batched forward pass.
+        Each melody keeps its own metaparameters and drops out of the batch when it ends or runs out of steps.
+        Models without incremental decoding generate the melodies one after the other
+
+        :param seeds (List[List[str]]): One seed per melody
+        :param num_steps (List[int]): How far we want the network to predict, per melody
+        :param max_seq_len (List[int]): How many symbols of each seed are used to prime the network
+        :param temperature (List[float]): How creative we want our model to be, per melody
+        :param top_k (int): Only sample from the k most likely symbols, 0 keeps them all
+        :param top_p (float): Only sample from the most likely symbols adding up to this probability, 1.0 keeps them all
+        :param rng_seeds (List[int]): One sampler seed per melody, see generate_melody. The same request always runs
+            the same batches, so seeded melodies come out the same every time
+        :return (List[List[str]]): The melodies in the same order as the seeds
+        """
+        seeds = [seed.split() if isinstance(seed, str) else seed for seed in seeds]
+        rng_seeds = rng_seeds if rng_seeds is not None else [None] * len(seeds)
+
+        if self._get_step_model() is None:
+            return [
+                self.generate_melody(seed, steps, seq_len, temp, decoding="windowed", top_k=top_k, top_p=top_p, rng_seed=rng_seed)
+                for seed, steps, seq_len, temp, rng_seed in zip(seeds, num_steps, max_seq_len, temperature, rng_seeds)
+            ]
+
+        start = time.perf_counter()
+        melodies = [list(seed) for seed in seeds]
+        windows = [self.vocabulary.encode(self._start_symbols + seed)[-seq_len:] for seed, seq_len in zip(seeds, max_seq_len)]
+        samplers = [Sampler(len(self.vocabulary), seed=rng_seed, top_k=top_k, top_p=top_p) for rng_seed in rng_seeds]
+
+        # prime every melody, seeds with the same window length share a call
+        probabilities, states = self._prime_batch(windows)
+
+        # the melodies still generating, in the same order as the rows of probabilities/states
+        active = list(range(len(seeds)))
+        for step in range(max(num_steps)):
+            continuing_rows = []
+            continuing = []
+            next_symbols = []
+            for row, index in enumerate(active):
+                output_int = samplers[index].sample(probabilities[row], temperature[index])
+                output_symbol = self.vocabulary.decode(output_int)
+
+                # check whether we're at the end of this melody
+                if output_symbol == "/":
+                    continue
+                melodies[index].append(output_symbol)
+
+                if step + 1 < num_steps[index]:
+                    continuing_rows.append(row)
+                    continuing.append(index)
+                    next_symbols.append([output_int])
+
+            if not continuing:
+                break
+
+            states = [state[continuing_rows] for state in states]
+            probabilities, states = self._run_step_batch(self._encode_batch(next_symbols), states)
+            active = continuing
+
+        self._record_generation("batched", start, sum(len(melody) - len(seed) for melody, seed in zip(melodies, seeds)))
+        return melodies
+
+    def _prime_batch(self, windows: List[List[int]]):
+        """
+        :param windows (List[List[int]]): The mapped seed window of every melody
+        :return probabilities, states: One row per window, in the same order as the windows
+        """
+        by_length = {}
+        for index, window in enumerate(windows):
+            by_length.setdefault(len(window), []).append(index)
+
+        probabilities = [None] * len(windows)
+        states = [[None] * len(windows) for _ in self._state_sizes]
+        for indexes in by_length.values():
+            initial_states = [np.zeros((len(indexes), size), dtype=np.float32) for size in self._state_sizes]
+            group_probabilities, group_states = self._run_step_batch(
+                self._encode_batch([windows[index] for index in indexes]),
+                initial_states
+            )
+            for row, index in enumerate(indexes):
+                probabilities[index] = group_probabilities[row]
+                for state, group_state in zip(states, group_states):
+                    state[index] = group_state[row]
+
+        return np.stack(probabilities), [np.stack(state) for state in states]
+
+    def _generate_incremental(self, melody: List[str], seed: List[int], num_steps: int, max_seq_len: int, temperature: float,
+                              sampler: Sampler, batched: bool = True) -> List[str]:
+        """
+        Runs the recurrent layers over the seed window once, then feeds only the newly sampled symbol every step
+        while carrying the hidden/cell state forward. The first step sees exactly the same window as the windowed mode,
+        later steps keep the whole generated history instead of dropping the oldest symbol out of the window
+
+        :param melody (List[str]): The seed symbols, the generated symbols are appended to it
+        :param seed (List[int]): The seed mapped to ints, including the start symbols
+        :param num_steps (int): How far we want the network to predict
+        :param max_seq_len (int): How many symbols of the seed are used to prime the network
         :param temperature (float): How creative we want our model to be
-        :return (int):
+        :param sampler (Sampler): Picks the next symbol from the model output
+        :param batched (bool): Let the single timestep calls join other requests' batches when batching is enabled
+        :return (List[str]):
         """
 
-        predicitions = np.log(probabilities) / temperature
-        probabilities =  np.exp(predicitions) / np.sum(np.exp(predicitions))
+        # prime the recurrent state on the seed window, this is the only full length forward pass
+        probabilities, states = self._run_step_model(seed[-max_seq_len:], self._initial_states())
 
-        choices = range(len(probabilities))
-        index = np.random.choice(choices, p=probabilities)
+        for step in range(num_steps):
+            output_int = sampler.sample(probabilities, temperature)
 
-        return index
+            # map int to our encoding
+            output_symbol = self.vocabulary.decode(output_int)
 
-    def _transpose_song(self, song, emotion: str):
-        key = song.analyze("key")
-        major_key = "C"
-        minor_key = "A"
-
-        if emotion == "happy":
-            major_key = "C"
-            minor_key = "A"
-        elif emotion == "calm":
-            major_key = "D"
-            minor_key = "B"
-        elif emotion == "melancholy":
-            major_key = "G"
-            minor_key = "F"
-        elif emotion == "surprised":
-            major_key = "E"
-            minor_key = "C"
-        
-        # get interval for transposition. E.g., Bmaj -> Cmaj
-        if key.mode == "major":
-            interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch(major_key))
-        elif key.mode == "minor":
-            interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch(minor_key))
+            # check whether we're at the end of a melody
+            if output_symbol == "/":
+                break
+
+            # update the melody
+            melody.append(output_symbol)
+
+            # a single timestep call to get the distribution for the next symbol
+            if step + 1 < num_steps:
+                probabilities, states = self._run_step_model([output_int], states, batched=batched)
+
+        return melody
+
+    def _export_subdir(self, name: str):
+        return os.path.join(self._export_dir, name) if self._export_dir is not None else None
+
+    def _encode(self, ints: List[int]) -> np.ndarray:
+        """ A single sequence in the form the model takes, one-hot or plain ints """
+        return self.vocabulary.ids(ints) if self.token_input else self.vocabulary.one_hot(ints)
 
-        # transpose song by calculated interval
-        return song.transpose(interval)
+    def _encode_batch(self, rows: List[List[int]]) -> np.ndarray:
+        return self.vocabulary.ids_batch(rows) if self.token_input else self.vocabulary.one_hot_batch(rows)
 
-    def save_melody(self, melody: List[str], file_name: str, emotion: str, format="mid", step_duration=0.25):
+    def _initial_states(self) -> List[np.ndarray]:
+        """ Keras LSTMs start from zeroed states when none are given, so priming from zeros matches the full model """
+        return [np.zeros((1, size), dtype=np.float32) for size in self._state_sizes]
+
+    def _run_step_model(self, symbols: List[int], states: List[np.ndarray], batched: bool = False):
+        """
+        :param symbols (List[int]): The symbols to feed to the network, the whole seed window when priming and a single symbol after that
+        :param states (List[np.ndarray]): The recurrent states left behind by the previous call
+        :param batched (bool): Go through the batching scheduler when batching is enabled
+        :return probabilities, states: The distribution for the next symbol and the new recurrent states
+        """
+        encoded_symbols = self._encode(symbols)
+        if batched and self._step_scheduler is not None:
+            outputs = self._step_scheduler.submit([encoded_symbols] + states)
+        else:
+            outputs = self._step_backend([encoded_symbols] + states)
+        probabilities, states = self._split_step_outputs(outputs)
+        return probabilities[0], states
+
+    def _run_step_batch(self, encoded_symbols: np.ndarray, states: List[np.ndarray]):
+        """
+        :param encoded_symbols (np.ndarray): (batch, timesteps, vocabulary size), or (batch, timesteps) for embedding models
+        :param states (List[np.ndarray]): The recurrent states of every row in the batch
+        :return probabilities, states: One row per batch entry
+        """
+        return self._split_step_outputs(self._step_backend([encoded_symbols] + states))
+
+    def _split_step_outputs(self, outputs: List[np.ndarray]):
+        probabilities = outputs[0]
+        if probabilities.ndim == 3:
+            probabilities = probabilities[:, -1]
+        return probabilities, list(outputs[1:])
+
+    def _get_step_model(self):
+        """ The step model is built lazily the first time incremental decoding is used, None if the model doesn't support it """
+        if not self._step_model_built:
+            with self._step_model_lock:
+                if not self._step_model_built:
+                    try:
+                        self._step_model = self._build_step_model()
+                        if self._step_model is not None:
+                            self._step_backend = create_inference_backend(self.inference_backend, self._step_model,
+                                                                          self._export_subdir("step"))
+                            if self._max_batch_size > 1:
+                                self._step_scheduler = BatchScheduler(self._step_backend, self._max_batch_size,
+                                                                      self._max_batch_wait, name=self.inference_backend)
+                    except Exception as e:
+                        print(f"Could not build a step model, falling back to windowed decoding: {e}")
+                        self._step_model = None
+                        self._step_backend = None
+                    self._step_model_built = True
+        return self._step_model
+
+    def _build_step_model(self):
+        """
+        Rebuilds the loaded model with every LSTM taking its hidden/cell state as an input and returning the updated state
+        next to the model output. The weights are copied over so both models compute the same thing.
+        Only chains of layers are supported (Input -> Embedding -> LSTM(s) -> Dropout/Dense...), anything else returns None
+
+        :return (keras.Model): inputs [symbols, h0, c0, h1, c1, ...], outputs [probabilities, h0, c0, h1, c1, ...]
+        """
+        if len(self.model.inputs) != 1:
+            return None
+
+        layers = [layer for layer in self.model.layers if not isinstance(layer, keras.layers.InputLayer)]
+        symbol_input = keras.layers.Input(shape=self.model.input_shape[1:], dtype=self.model.inputs[0].dtype)
+        state_inputs = []
+        state_outputs = []
+        state_sizes = []
+
+        x = symbol_input
+        previous_output = self.model.inputs[0]
+        for layer in layers:
+            # make sure the model really is a chain, otherwise re-wiring it like this would change what it computes
+            if layer.input is not previous_output:
+                return None
+            previous_output = layer.output
+
+            if isinstance(layer, keras.layers.LSTM):
+                layer_config = layer.get_config()
+                layer_config['return_state'] = True
+                layer_config['stateful'] = False
+                layer_config['name'] = f"{layer.name}_step"
+                step_layer = keras.layers.LSTM.from_config(layer_config)
+
+                hidden_state = keras.layers.Input(shape=(layer.units,))
+                cell_state = keras.layers.Input(shape=(layer.units,))
+                x, hidden_out, cell_out = step_layer(x, initial_state=[hidden_state, cell_state])
+                step_layer.set_weights(layer.get_weights())
+
+                state_inputs += [hidden_state, cell_state]
+                state_outputs += [hidden_out, cell_out]
+                state_sizes += [layer.units, layer.units]
+            elif isinstance(layer, (keras.layers.RNN, keras.layers.Bidirectional)):
+                # GRUs/bidirectional layers would need their own state plumbing
+                return None
+            else:
+                # the remaining layers are shared with the original model, so they keep its weights
+                x = layer(x)
+
+        if not state_inputs:
+            return None
+
+        self._state_sizes = state_sizes
+        return keras.Model([symbol_input] + state_inputs, [x] + state_outputs)
+
+
+    def _transpose_song(self, song, emotion: str):
+        return render_helper.transpose_song(song, emotion)
+
+    def save_melody(self, melody: List[str], file_name: str, emotion: str, format="mid", step_duration=0.25, writer="direct"):
         """ 
-        Converts our list to a m21 stream and saves the melody to the desired file format
+        Saves the melody to the desired file format, see render_helper.save_melody
 
         :param melody (List[str]): Our melody list to be saved on disk
         :param file_name (str): The name of the file we want to save including model path
         :param format (str): The music file format you want to save to, music21 supports very little so this should always be midi
         :param step_duration (float): Music theory stuff, the smallest note used, make sure this matches what you trained the model with
+        :param writer (str): "direct" or "music21", see render_helper.melody_to_midi
         :return (None): This function returns nothing, it saves to disk
         """
-
-        # create a music21 stream
-        stream = m21.stream.Stream()
-
-        # parse all the symbols in the melody and create note/rest objects
-        # i.e: 60 _ _ _ r _ 62 _ ....
-        start_symbol = None
-        step_counter = 1
-
-        for i, symbol in enumerate(melody):
-            # handle case in which we have a note/rest
-            # else handle case in which we have a prolongation sign "_"
-            if symbol != "_" or (i + 1) == len(melody):
-                # ensure we're dealing with notes/rests beyond the first symbol
-                if start_symbol is not None:
-                    quarter_length_duration = step_duration * step_counter # converts to the time scale of a note
-    
-                    # Handle rest
-                    # Else Handle note
-                    if start_symbol == "r":
-                        m21_event = m21.note.Rest(quarterLength=quarter_length_duration)
-                    elif '.' in start_symbol:
-                        #print(f"Chord found is {start_symbol}")
-                        notes_in_chord = start_symbol.split('.')
-                        notes = []
-                        for current_note in notes_in_chord:
-                            new_note = m21.note.Note(int(current_note))
-                            #new_note.storedInstrument = self.instrument
-                            notes.append(new_note)
-                        m21_event = m21.chord.Chord(notes, quarterLength=quarter_length_duration)
-                    else:
-                        m21_event = m21.note.Note(int(start_symbol), quarterLength=quarter_length_duration)
-                    stream.append(m21_event)
-                    
-                    # reset to the other note
-                    step_counter = 1
-                start_symbol = symbol
-            else:
-                step_counter += 1
-
-        # We first try to transpose the song according to its emotion
-        # if that fails we just save the original song/stream to disk
-        try:
-            new_stream = self._transpose_song(stream, emotion)
-            new_stream.write(format, file_name)
-        except Exception as e:
-            print(f"Exception when trying to write transposed song: {file_name} with error: {e}")
-            try:
-                print("Attempting to write original m21 stream instead")
-                stream.write(format, file_name)
-            except Exception as e:
-                print(f"Exception when trying to write file: {file_name} with error: {e}")        
\ No newline at end of file
+        start = time.perf_counter()
+        render_helper.save_melody(melody, file_name, emotion, format=format, step_duration=step_duration, writer=writer)
+        SAVE_SECONDS.observe(time.perf_counter() - start, model=self.name, format=format)
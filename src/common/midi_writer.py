@@ -0,0 +1,251 @@
+import struct
+from typing import List, Tuple
+
+# Writes our symbol lists straight to a standard midi file, without building a music21 stream first.
+# The output is meant to be byte for byte what render_helper's music21 path (melody_to_stream, transpose_song,
+# streamToMidiFile) writes, so the two can be swapped freely. This module must not import music21
+
+# The keys every emotion gets transposed to as (major key, minor key)
+EMOTION_KEYS = {
+    "happy": ("C", "A"),
+    "calm": ("D", "B"),
+    "melancholy": ("G", "F"),
+    "surprised": ("E", "C")
+}
+DEFAULT_KEYS = ("C", "A")
+
+PITCH_CLASSES = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+
+# The profiles music21 uses for stream.analyze("key") (analysis.discrete.AardenEssen)
+MAJOR_PROFILE = [17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587, 0.291248, 22.062, 0.145624, 8.15494, 0.232998, 4.95122]
+MINOR_PROFILE = [18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362, 0.702494, 18.6161, 4.56621, 1.93186, 7.37619, 1.75623]
+
+# music21's defaults, a tempo of 120 bpm in 4/4 at 10080 ticks per quarter note
+TICKS_PER_QUARTER = 10080
+MICROSECONDS_PER_QUARTER = 500000
+VELOCITY = 90
+# General MIDI plays channel 10 (9 counting from 0) as percussion
+DRUM_CHANNEL = 9
+
+
+def melody_to_events(melody: List[str]) -> List[Tuple[tuple, int]]:
+    """
+    Groups the symbols into events the same way render_helper.melody_to_stream does, quirks included
+
+    :param melody (List[str]): i.e: ["60", "_", "_", "r", "5.8.10", "_"]
+    :return (List[Tuple[tuple, int]]): (pitches, steps) pairs, rests have no pitches, i.e: [((60,), 3), ((), 1)]
+    """
+    events = []
+    start_symbol = None
+    step_counter = 1
+
+    for i, symbol in enumerate(melody):
+        if symbol != "_" or (i + 1) == len(melody):
+            if start_symbol is not None:
+                if start_symbol == "r":
+                    pitches = ()
+                else:
+                    pitches = tuple(int(p) for p in start_symbol.split('.'))
+                events.append((pitches, step_counter))
+                step_counter = 1
+            start_symbol = symbol
+        else:
+            step_counter += 1
+
+    return events
+
+
+def estimate_key(events: List[Tuple[tuple, int]], step_duration: float = 0.25):
+    """
+    Correlates the duration weighted pitch class histogram with every major and minor key profile and keeps the best
+    one, this is the Krumhansl-Schmuckler algorithm as music21 implements it, tie breaks included
+
+    :param events (List[Tuple[tuple, int]]): The output of melody_to_events
+    :param step_duration (float): The quarter length of a single step
+    :return (Tuple[int, str]): The tonic's pitch class and "major"/"minor", None when there are no notes
+    """
+    histogram = [0] * 12
+    has_notes = False
+    for pitches, steps in events:
+        if pitches:
+            has_notes = True
+            length = step_duration * steps
+            for p in pitches:
+                histogram[p % 12] += length
+    if not has_notes:
+        return None
+
+    histogram_average = sum(histogram) / 12
+    candidates = []
+    for mode, profile in (("major", MAJOR_PROFILE), ("minor", MINOR_PROFILE)):
+        profile_average = sum(profile) / 12
+        for tonic in range(12):
+            top = 0.0
+            bottom_right = 0.0
+            bottom_left = 0.0
+            for j in range(12):
+                weight = profile[(j - tonic) % 12] - profile_average
+                value = histogram[j] - histogram_average
+                top += weight * value
+                bottom_right += weight ** 2
+                bottom_left += value ** 2
+
+            correlation = 0.0 if bottom_right == 0 or bottom_left == 0 else float(top / ((bottom_right * bottom_left) ** 0.5))
+            candidates.append((correlation, tonic, mode))
+
+    # highest correlation wins, then the higher tonic, then minor over major, like music21's reversed sort
+    correlation, tonic, mode = max(candidates)
+    return tonic, mode
+
+
+def transposition_offset(events: List[Tuple[tuple, int]], emotion: str, step_duration: float = 0.25) -> int:
+    """
+    The semitones that move the melody from its estimated key to the key of the emotion, both tonics are taken in
+    the same octave so the offset is between -11 and 11. E.g., B major -> C major is -11
+
+    :return (int): 0 when the key could not be estimated
+    """
+    key = estimate_key(events, step_duration)
+    if key is None:
+        return 0
+
+    tonic, mode = key
+    major_key, minor_key = EMOTION_KEYS.get(emotion, DEFAULT_KEYS)
+    target = PITCH_CLASSES[major_key] if mode == "major" else PITCH_CLASSES[minor_key]
+    return target - tonic
+
+
+def _variable_length(value: int) -> bytes:
+    """ Midi's variable length quantity, 7 bits per byte with the high bit set on all but the last byte """
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(data))
+
+
+def _track(data: bytes) -> bytes:
+    return b"MTrk" + struct.pack(">I", len(data)) + data
+
+
+def _conductor_track() -> bytes:
+    """ The tempo and time signature, music21 writes them to a track of their own """
+    conductor = bytearray()
+    conductor += b"\x00\xff\x51\x03" + MICROSECONDS_PER_QUARTER.to_bytes(3, "big")
+    conductor += b"\x00\xff\x58\x04\x04\x02\x18\x08"
+    conductor += _variable_length(TICKS_PER_QUARTER) + b"\xff\x2f\x00"
+    return _track(bytes(conductor))
+
+
+def _notes_track(events: List[Tuple[tuple, int]], offset: int, ticks_per_step: int, velocity: int, channel: int = 0,
+                 program: int = None) -> bytes:
+    """ One track with the notes of the events on a channel, a program change first when program is given """
+    notes = bytearray(b"\x00\xff\x03\x00")
+    if program is not None:
+        notes += b"\x00" + bytes((0xC0 | channel, program))
+    if any(pitches for pitches, _ in events):
+        # music21 resets the pitch bend of every channel it uses
+        notes += b"\x00" + bytes((0xE0 | channel, 0x00, 0x40))
+
+    delta = 0
+    for pitches, steps in events:
+        ticks = ticks_per_step * steps
+        if not pitches:
+            # rests only push the next event back
+            delta += ticks
+            continue
+
+        pitches = [p + offset for p in pitches]
+        for p in pitches:
+            notes += _variable_length(delta) + bytes((0x90 | channel, p, velocity))
+            delta = 0
+        delta = ticks
+        for p in pitches:
+            notes += _variable_length(delta) + bytes((0x80 | channel, p, 0))
+            delta = 0
+
+    # trailing rests are dropped, the track ends a quarter note after the last note
+    notes += _variable_length(TICKS_PER_QUARTER) + b"\xff\x2f\x00"
+    return _track(bytes(notes))
+
+
+def _header(tracks: int) -> bytes:
+    return b"MThd" + struct.pack(">IHHH", 6, 1, tracks, TICKS_PER_QUARTER)
+
+
+def events_to_midi(events: List[Tuple[tuple, int]], offset: int = 0, step_duration: float = 0.25,
+                   velocity: int = VELOCITY) -> bytes:
+    """
+    Serializes the events as a format 1 midi file: a conductor track with the tempo and time signature and one
+    track with the notes on the first channel
+
+    :param events (List[Tuple[tuple, int]]): The output of melody_to_events
+    :param offset (int): Semitones added to every pitch
+    :param step_duration (float): The quarter length of a single step
+    :param velocity (int): The velocity of every note
+    :return (bytes): A standard midi file
+    """
+    ticks_per_step = int(round(TICKS_PER_QUARTER * step_duration))
+    return _header(2) + _conductor_track() + _notes_track(events, offset, ticks_per_step, velocity)
+
+
+def melody_events(melody: List[str], emotion: str, step_duration: float = 0.25) -> Tuple[List[Tuple[tuple, int]], int]:
+    """
+    The events of the melody and the offset that transposes them to the key of its emotion
+
+    :return (Tuple[List[Tuple[tuple, int]], int]): The output of melody_to_events and the offset in semitones
+    """
+    events = melody_to_events(melody)
+    offset = transposition_offset(events, emotion, step_duration)
+
+    # a transposition that leaves the midi range is skipped, like a failed transposition in the music21 path
+    if offset and any(not 0 <= p + offset <= 127 for pitches, _ in events for p in pitches):
+        offset = 0
+    return events, offset
+
+
+def melody_to_midi(melody: List[str], emotion: str, step_duration: float = 0.25) -> bytes:
+    """
+    Transposes the melody to the key of its emotion and writes it as a midi file
+
+    :param melody (List[str]): The symbols produced by MelodyGenerator.generate_melody
+    :param emotion (str): Picks the key the melody is transposed to
+    :param step_duration (float): Music theory stuff, the smallest note used, make sure this matches what you trained the model with
+    :return (bytes): A standard midi file
+    """
+    events, offset = melody_events(melody, emotion, step_duration)
+    return events_to_midi(events, offset, step_duration)
+
+
+def arrangement_channels(model_infos: List[dict]) -> List[Tuple[int, int]]:
+    """
+    The (channel, program) of every track of an arrangement. model_info.json entries can set "midi_channel" (i.e: 9
+    for drums) and "midi_program", the other tracks get the free channels in order, skipping the drum channel
+
+    :param model_infos (List[dict]): The model_info.json entry of every track
+    :return (List[Tuple[int, int]]): i.e: [(0, 0), (9, 0), (1, 0)]
+    """
+    taken = {info['midi_channel'] for info in model_infos if 'midi_channel' in info}
+    free = iter([channel for channel in range(16) if channel != DRUM_CHANNEL and channel not in taken])
+    return [(info['midi_channel'] if 'midi_channel' in info else next(free, 0), info.get('midi_program', 0)) for info in model_infos]
+
+
+def arrangement_to_midi(tracks: List[Tuple[List[str], int, int]], emotion: str, step_duration: float = 0.25,
+                        velocity: int = VELOCITY) -> bytes:
+    """
+    Writes several melodies as the tracks of one midi file, every melody is transposed on its own like in
+    melody_to_midi and gets its own channel and program
+
+    :param tracks (List[Tuple[List[str], int, int]]): (melody, channel, program) triples, i.e: [(melody, 0, 0), (drums, 9, 0)]
+    :param emotion (str): Picks the key every melody is transposed to
+    :param step_duration (float): The quarter length of a single step
+    :param velocity (int): The velocity of every note
+    :return (bytes): A standard midi file with a conductor track and one track per melody
+    """
+    ticks_per_step = int(round(TICKS_PER_QUARTER * step_duration))
+    data = _header(len(tracks) + 1) + _conductor_track()
+    for melody, channel, program in tracks:
+        events, offset = melody_events(melody, emotion, step_duration)
+        data += _notes_track(events, offset, ticks_per_step, velocity, channel, program)
+    return data
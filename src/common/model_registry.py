@@ -0,0 +1,303 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, List
+from file_helper import FileHelper
+
+if TYPE_CHECKING:
+    from melody_generator import MelodyGenerator
+
+
+class _RegistryEntry:
+    def __init__(self, generator, model_path: str, mapping_path: str, load_time: float):
+        self.generator = generator
+        self.model_path = model_path
+        self.mapping_path = mapping_path
+        self.load_time = load_time
+        self.loaded_at = time.time()
+        self.last_checked = self.loaded_at
+        self.signature = _file_signature(model_path, mapping_path)
+        self.size_bytes = _file_size(model_path)
+        self.hits = 0
+        # requests currently generating with this entry, a retired entry is only closed once the last one is done
+        self.leases = 0
+        self.retired = False
+
+
+def _file_signature(*paths):
+    """ The mtime/size of every file backing a model, used to detect changes on disk """
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_mtime, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def _close(generator) -> None:
+    """ Generators built by a custom loader don't have to support close """
+    if hasattr(generator, "close"):
+        generator.close()
+
+
+def _close_all(generators: list) -> None:
+    """ Closes the generators _retire handed back, the None entries are still leased and close later """
+    for generator in generators:
+        if generator is not None:
+            _close(generator)
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class ModelRegistry:
+    def __init__(self, model_info: dict, file_helper: FileHelper, sequence_length: int = 64, max_models: int = 4,
+                 max_bytes: int = 0, hot_reload: bool = False, reload_check_interval: float = 5.0, loader: Callable = None,
+                 max_batch_size: int = 1, max_batch_wait: float = 0.002):
+        """
+        A process-wide cache of MelodyGenerators keyed by the entries of model_info.json. Models are loaded once
+        (at startup through preload or on first use) and stay resident until evicted in least-recently-used order
+
+        :param model_info (dict): The contents of model_info.json
+        :param file_helper (FileHelper): Passed down to every MelodyGenerator that gets created
+        :param sequence_length (int): The amount of start symbols every generator prepends to a seed
+        :param max_models (int): How many models can be resident at once, 0 means unbounded
+        :param max_bytes (int): Upper bound on the summed size of the resident model files, 0 means unbounded
+        :param hot_reload (bool): Reload a model when its .h5 or mapping file changes on disk
+        :param reload_check_interval (float): Minimum seconds between two checks of the same model's files
+        :param loader (Callable): Builds a generator from a model_info entry, defaults to creating a MelodyGenerator
+        :param max_batch_size (int): Generation steps from concurrent requests merged into one call, 1 disables batching
+        :param max_batch_wait (float): How long in seconds a generation step waits for others to join its batch
+        """
+        self._model_info = model_info
+        self._file_helper = file_helper
+        self._sequence_length = sequence_length
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.hot_reload = hot_reload
+        self.reload_check_interval = reload_check_interval
+        self._loader = loader if loader is not None else self._load_generator
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in model_info}
+
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+        self.load_times = {}
+
+    def _load_generator(self, info: dict) -> "MelodyGenerator":
+        # tensorflow is only imported once the first model is loaded, importing the API stays fast
+        from melody_generator import MelodyGenerator
+
+        generator = MelodyGenerator(
+            info['model_path'],
+            self._file_helper,
+            info['mapping_path'],
+            self._sequence_length,
+            inference_backend=info.get('inference_backend', "function"),
+            name=info.get('name')
+        )
+        if self.max_batch_size > 1:
+            generator.enable_batching(self.max_batch_size, self.max_batch_wait)
+        return generator
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._model_info
+
+    @contextmanager
+    def lease(self, name: str):
+        """
+        Lends out the resident generator for a model, loading it if this is the first time it is asked for.
+        A generator that gets evicted or reloaded while lent out is only closed once every lease has been returned,
+        so a request never loses its generator (and its batching scheduler) halfway through a melody
+
+        :param name (str): A key of model_info.json, i.e: "FolkLSTM"
+        :return (MelodyGenerator): Through with, i.e: with registry.lease("FolkLSTM") as generator: ...
+        """
+        entry = self._acquire(name)
+        try:
+            yield entry.generator
+        finally:
+            self._release(entry)
+
+    def get(self, name: str) -> "MelodyGenerator":
+        """
+        Returns the resident generator for a model without leasing it, so it can be closed at any time by an
+        eviction. Only meant for inspecting a model, anything that generates should use lease
+        """
+        entry = self._acquire(name)
+        self._release(entry)
+        return entry.generator
+
+    def _acquire(self, name: str) -> _RegistryEntry:
+        """ The resident entry of a model with one more lease on it, loaded (or reloaded) first when needed """
+        if name not in self._model_info:
+            raise KeyError(f"No model named {name} in the model info")
+
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and not self._is_stale(entry):
+                self._entries.move_to_end(name)
+                entry.hits += 1
+                entry.leases += 1
+                self.hits += 1
+                return entry
+
+        # only one thread loads a given model, everyone else waits on it and then reuses the result
+        with self._load_locks[name]:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None and not self._is_stale(entry):
+                    self._entries.move_to_end(name)
+                    entry.hits += 1
+                    entry.leases += 1
+                    self.hits += 1
+                    return entry
+                reloading = entry is not None
+                self.misses += 1
+
+            entry = self._load(name)
+
+            retired = []
+            with self._lock:
+                if reloading:
+                    self.reloads += 1
+                # the stale entry may have been evicted while we were loading, there is nothing to retire then
+                old = self._entries.pop(name, None)
+                if old is not None:
+                    retired.append(self._retire(old))
+                entry.leases += 1
+                self._entries[name] = entry
+                self._entries.move_to_end(name)
+                retired += self._evict_if_needed()
+            _close_all(retired)
+            return entry
+
+    def _release(self, entry: _RegistryEntry) -> None:
+        with self._lock:
+            entry.leases -= 1
+            closing = entry.retired and entry.leases == 0
+        if closing:
+            _close(entry.generator)
+
+    def _retire(self, entry: _RegistryEntry):
+        """
+        Only called while holding the registry lock, for an entry that was just taken out of the registry.
+        Returns its generator when nobody has it leased and it can be closed right away, None otherwise
+        """
+        entry.retired = True
+        return entry.generator if entry.leases == 0 else None
+
+    def _load(self, name: str) -> _RegistryEntry:
+        # the loader also gets the model's name, generators use it to label their metrics
+        info = dict(self._model_info[name], name=name)
+        start = time.perf_counter()
+        generator = self._loader(info)
+        load_time = time.perf_counter() - start
+
+        self.load_times.setdefault(name, []).append(load_time)
+        print(f"Loaded model {name} in {load_time:.3f}s")
+        return _RegistryEntry(generator, info['model_path'], info['mapping_path'], load_time)
+
+    def _is_stale(self, entry: _RegistryEntry) -> bool:
+        """ Only called while holding the registry lock """
+        if not self.hot_reload:
+            return False
+
+        now = time.time()
+        if now - entry.last_checked < self.reload_check_interval:
+            return False
+        entry.last_checked = now
+        return _file_signature(entry.model_path, entry.mapping_path) != entry.signature
+
+    def _evict_if_needed(self) -> list:
+        """
+        Drops least recently used models until we are back under the limits, the newest model always stays.
+        Only called while holding the registry lock, returns the generators to close once it is released
+        """
+        retired = []
+        while len(self._entries) > 1:
+            too_many = self.max_models > 0 and len(self._entries) > self.max_models
+            too_big = self.max_bytes > 0 and sum(e.size_bytes for e in self._entries.values()) > self.max_bytes
+            if not (too_many or too_big):
+                break
+            name, entry = self._entries.popitem(last=False)
+            retired.append(self._retire(entry))
+            self.evictions += 1
+            print(f"Evicted model {name} from the registry")
+        return retired
+
+    def preload(self, names: List[str], warm_up_steps: int = 0) -> dict:
+        """
+        Loads models ahead of time so the first request for them does not pay for it
+
+        :param names (List[str]): Keys of model_info.json, unknown names are skipped
+        :param warm_up_steps (int): Also run a dummy generation of this many steps (see MelodyGenerator.warm_up) so
+            the graphs are traced too, 0 only loads the models
+        :return (dict): The error of every model that failed to load or warm up, keyed by name
+        """
+        errors = {}
+        for name in names:
+            if name not in self._model_info:
+                print(f"Cannot preload unknown model: {name}")
+                errors[name] = "Unknown model"
+                continue
+            try:
+                with self.lease(name) as generator:
+                    if warm_up_steps > 0 and hasattr(generator, "warm_up"):
+                        start = time.perf_counter()
+                        generator.warm_up(warm_up_steps)
+                        print(f"Warmed up model {name} in {time.perf_counter() - start:.3f}s")
+            except Exception as e:
+                print(f"Failed to preload model {name} with error: {e}")
+                errors[name] = str(e)
+        return errors
+
+    def evict(self, name: str) -> None:
+        """ Takes a model out of the registry, it is closed once the requests still using it are done """
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is None:
+                return
+            generator = self._retire(entry)
+            self.evictions += 1
+        _close_all([generator])
+
+    def stats(self) -> dict:
+        """ Hit/miss counters plus the load time and hit count of every model that has been loaded """
+        with self._lock:
+            resident = {
+                name: {
+                    "hits": entry.hits,
+                    "load_time": round(entry.load_time, 4),
+                    "loaded_at": entry.loaded_at,
+                    "size_bytes": entry.size_bytes,
+                    "leases": entry.leases,
+                    "inference_backend": getattr(entry.generator, "active_backend", None),
+                    "batching": entry.generator.batching_stats() if hasattr(entry.generator, "batching_stats") else {}
+                }
+                for name, entry in self._entries.items()
+            }
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+                "resident": resident,
+                "load_times": {name: [round(t, 4) for t in times] for name, times in self.load_times.items()}
+            }
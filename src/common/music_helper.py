@@ -1,10 +1,17 @@
 import os
-import json
+import time
+import multiprocessing
 import music21 as m21
-import tensorflow.keras as keras
 import numpy as np
-from typing import List
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import TYPE_CHECKING, List
 from file_helper import FileHelper
+import song_preprocessing
+from preprocessing_manifest import PreprocessingManifest, manifest_song_paths
+from corpus import CORPUS_DTYPE, corpus_path_for, load_corpus, write_corpus
+
+if TYPE_CHECKING:
+    from training_data import CorpusSequence
 
 # durations are expressed in quarter length
 ACCEPTABLE_DURATIONS = [
@@ -57,10 +64,7 @@ class MusicHelper:
         :param song (m21 stream):
         :return (bool):
         """
-        for note in song.flat.notesAndRests:
-            if note.duration.quarterLength not in self.acceptable_durations:
-                return False
-        return True
+        return song_preprocessing.has_acceptable_durations(song, self.acceptable_durations)
 
     def transpose_song(self, song, major_key: str, minor_key: str):
         """
@@ -74,21 +78,7 @@ class MusicHelper:
         :param minor_key (str): The musical minor key you want to transpose to
         :return transposed_song (m21 stream):
         """
-
-        # get key from the song
-        parts = song.getElementsByClass(m21.stream.Part)
-        measures_part0 = parts[0].getElementsByClass(m21.stream.Measure)
-        key = song.analyze("key")
-
-        # get interval for transposition. E.g., Bmaj -> Cmaj
-        if key.mode == "major":
-            interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch("C"))
-        elif key.mode == "minor":
-            interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch("A"))
-
-        # transpose song by calculated interval
-        tranposed_song = song.transpose(interval)
-        return tranposed_song
+        return song_preprocessing.transpose_song(song, major_key, minor_key)
 
     def encode_song(self, song, time_step=0.25):
         """
@@ -98,37 +88,16 @@ class MusicHelper:
 
             ["r", "_", "60", "_", "_", "_", "72" "_"]
 
+        Chords, and notes of several parts sounding together, are their pitch classes in normal order joined by dots,
+        the same symbols the Guitar/Drums/KKSlider mappings use:
+
+            ["0.4.7", "_", "5.8.10", "_"]
+
         :param song (m21 stream): Piece to encode
         :param time_step (float): Duration of each time step in quarter length
         :return:
         """
-
-        encoded_song = []
-
-        for event in song.flat.notesAndRests:
-
-            # handle notes
-            if isinstance(event, m21.note.Note):
-                symbol = event.pitch.midi # 60
-            # handle rests
-            elif isinstance(event, m21.note.Rest):
-                symbol = "r"
-
-            # convert the note/rest into time series notation
-            steps = int(event.duration.quarterLength / time_step)
-            for step in range(steps):
-
-                # if it's the first time we see a note/rest, let's encode it. Otherwise, it means we're carrying the same
-                # symbol in a new time step
-                if step == 0:
-                    encoded_song.append(symbol)
-                else:
-                    encoded_song.append("_")
-
-        # cast encoded song to str
-        encoded_song = " ".join(map(str, encoded_song))
-
-        return encoded_song
+        return song_preprocessing.encode_song(song, time_step)
 
     def convert_songs_to_int(self, songs: str, mapping_path:str):
         """ 
@@ -155,23 +124,28 @@ class MusicHelper:
 
         return int_songs
 
-    def create_mapping(self, songs: str, mapping_path: str) -> None:
+    def create_mapping(self, songs: str, mapping_path: str, extend_mapping: bool = False) -> None:
         """
-        Creates a json file that maps the symbols in the song dataset onto integers
+        Creates a json file that maps the symbols in the song dataset onto integers, in sorted order
         This mappins file is EXTREMELY important for further training, dont lose it!
+        By default the mapping is rebuilt from the songs, so symbols of songs that were removed or encoded differently
+        since don't linger as dead output classes. extend_mapping is for fine-tuning a model trained on an existing
+        mapping: known symbols keep their integer and new ones are added after them (the model's output layer has to
+        grow with them)
 
         :param songs (str): String with all songs
         :param mapping_path (str): Path where to save mapping
+        :param extend_mapping (bool): Keep the existing mapping and only add the new symbols
         :return:
         """
-        mappings = {}
+        mappings = self._file_helper.loadJSON(mapping_path) if extend_mapping and os.path.exists(mapping_path) else {}
 
         # identify the vocabulary
         songs = songs.split()
-        vocabulary = list(set(songs))
+        vocabulary = sorted(set(songs) - set(mappings.keys()))
 
         # create mappings
-        for i, symbol in enumerate(vocabulary):
+        for i, symbol in enumerate(vocabulary, start=len(mappings)):
             mappings[symbol] = i
 
         # save voabulary to a json file
@@ -189,95 +163,246 @@ class MusicHelper:
         # What this is trying to create in the model:
         # [11, 12, 13, 14, ...] -> inputs:[11, 12],  target:[13]
 
-        # load songs and map them to int
-        songs = self._file_helper.load_file_as_str(single_file_dataset_path)
-        int_songs = self.convert_songs_to_int(songs, mapping_path)
+        int_songs = self.load_int_corpus(single_file_dataset_path, mapping_path)
 
         # generate the training sequences
         # 100 symbols, seq_len = 64, 100 - 64 = 36 sequences we can generate
-        inputs = []
-        targets = []
-        num_sequences = len(int_songs) - sequence_length
-
-        # This loops generates the training slices plus the target to predict
-        for i in range(num_sequences):
-            inputs.append(int_songs[i:i+sequence_length])
-            targets.append(int_songs[i+sequence_length])
+        # every window is a view into the corpus, nothing is copied until the one-hot encoding
+        num_sequences = max(len(int_songs) - sequence_length, 0)
+        if num_sequences > 0:
+            inputs = np.lib.stride_tricks.sliding_window_view(int_songs, sequence_length)[:num_sequences]
+        else:
+            inputs = np.zeros((0, sequence_length), dtype=np.int64)
+        targets = np.array(int_songs[sequence_length:sequence_length + num_sequences])
 
         # one-hot encode the sequences
         # inputs: (# of sequences, sequence length, vocabulary size)
-        vocabulary_size = len(set(int_songs))
-        inputs = keras.utils.to_categorical(inputs, num_classes=vocabulary_size, dtype=np.uint8)
-        targets = np.array(targets)
+        # sized by the mapping, it can hold symbols this corpus doesn't use
+        vocabulary_size = len(self._file_helper.loadJSON(mapping_path))
+        inputs = np.eye(vocabulary_size, dtype=np.uint8)[inputs]
 
         # Inputs will be a 3D Numpy array as demonstrated above
         return inputs, targets
 
+    def load_int_corpus(self, single_file_dataset_path: str, mapping_path: str, corpus_path: str = None) -> np.ndarray:
+        """
+        Memory maps the int corpus create_corpus wrote next to the dataset. Datasets made before it existed (or
+        changed since) are mapped to int once and saved as the corpus
+
+        :param single_file_dataset_path (str): The file generated by create_single_file_dataset
+        :param mapping_path (str): The mapping file that maps symbols to ints
+        :param corpus_path (str): Where the int corpus is, defaults to the dataset path with a .npy extension
+        :return (np.ndarray): The corpus as ints
+        """
+        corpus_path = corpus_path if corpus_path is not None else corpus_path_for(single_file_dataset_path)
+        if not os.path.exists(corpus_path) or os.path.getmtime(corpus_path) < os.path.getmtime(single_file_dataset_path):
+            songs = self._file_helper.load_file_as_str(single_file_dataset_path)
+            np.save(corpus_path, np.array(self.convert_songs_to_int(songs, mapping_path), dtype=CORPUS_DTYPE))
+        return load_corpus(corpus_path)
+
+    def create_training_sequence(self, sequence_length: int, single_file_dataset_path: str, mapping_path: str,
+                                 batch_size: int, one_hot: bool = True, shuffle: bool = True,
+                                 corpus_path: str = None) -> "CorpusSequence":
+        """
+        The same windows as generate_training_sequences, but handed to model.fit one batch at a time so the corpus
+        can be bigger than memory
+
+        :param sequence_length (int): The length of the "sliding window" we're using to refeed samples
+        :param single_file_dataset_path (str): The file generated by create_single_file_dataset
+        :param mapping_path (str): The mapping file that maps symbols to ints
+        :param batch_size (int): Windows per batch
+        :param one_hot (bool): One-hot encode the inputs, False hands out the ints
+        :param shuffle (bool): Visit the windows in a new random order every epoch
+        :param corpus_path (str): Where the int corpus is, defaults to the dataset path with a .npy extension
+        :return (CorpusSequence): Pass it to model.fit in place of inputs, targets
+        """
+        # keras is only imported by the training path, the API and the CLI tools use this module without it
+        from training_data import CorpusSequence
+
+        return CorpusSequence(
+            self.load_int_corpus(single_file_dataset_path, mapping_path, corpus_path),
+            sequence_length,
+            len(self._file_helper.loadJSON(mapping_path)),
+            batch_size=batch_size,
+            one_hot=one_hot,
+            shuffle=shuffle
+        )
+
+
+    def _encoded_song_paths(self, encoded_song_path: str) -> List[str]:
+        """ The manifest lists the encoded songs in a stable order, older runs without one just have the files """
+        song_paths = manifest_song_paths(encoded_song_path)
+        if song_paths is None:
+            song_paths = [os.path.join(path, file) for path, _, files in os.walk(encoded_song_path) for file in files]
+        return song_paths
 
     def create_single_file_dataset(self, encoded_song_path: str, file_dataset_path: str, sequence_length: int) -> str:
         """
-        Generates a file collating all the encoded songs and adding new piece delimiters. It then saves that to disc and returns the song
+        Generates a file collating all the encoded songs and adding new piece delimiters. It then saves that to disc and returns the song.
+        The songs are written to the file one at a time, the pipeline itself uses create_corpus which also skips
+        reading the result back
 
         :param dataset_path (str): Path to folder containing the encoded songs
         :param file_dataset_path (str): Path to file for saving songs in single txt file
         :param sequence_length (int): # of time steps to be considered for training
         :return songs (str): String containing all songs in dataset + delimiters
         """
-        new_song_delimiter = "/ " * sequence_length
-        songs = ""
+        new_song_delimiter = " ".join(["/"] * sequence_length)
 
         # load encoded songs and add delimiters
-        for path, _, files in os.walk(encoded_song_path):
-            for file in files:
-                file_path = os.path.join(path, file)
-                song = self._file_helper.load_file_as_str(file_path)
-                songs = songs + song + " " + new_song_delimiter
+        with open(file_dataset_path, "w") as dataset_file:
+            for i, file_path in enumerate(self._encoded_song_paths(encoded_song_path)):
+                if i > 0:
+                    dataset_file.write(" ")
+                song = self._file_helper.load_file_as_str(file_path).strip()
+                dataset_file.write(f"{song} {new_song_delimiter}" if sequence_length > 0 else song)
 
-        # remove empty space from last character of string
-        songs = songs[:-1]
+        return self._file_helper.load_file_as_str(file_dataset_path)
 
-        # save string that contains all the dataset
-        self._file_helper.saveFile(songs, file_dataset_path)
-        return songs
+    def create_corpus(self, encoded_song_path: str, file_dataset_path: str, mapping_path: str, sequence_length: int,
+                      corpus_path: str = None, extend_mapping: bool = False) -> str:
+        """
+        create_single_file_dataset, create_mapping and convert_songs_to_int in a single streaming pass: writes the
+        text dataset, the mapping and the int corpus as a uint16 .npy (see corpus.write_corpus)
+
+        :param encoded_song_path (str): Path to folder containing the encoded songs
+        :param file_dataset_path (str): Path to file for saving songs in single txt file
+        :param mapping_path (str): Path of the mapping to create (or extend)
+        :param sequence_length (int): # of time steps to be considered for training
+        :param corpus_path (str): Where the int corpus goes, defaults to the dataset path with a .npy extension
+        :param extend_mapping (bool): Add to the existing mapping instead of rebuilding it, see create_mapping
+        :return (str): The path of the int corpus
+        """
+        corpus_path = corpus_path if corpus_path is not None else corpus_path_for(file_dataset_path)
+        mappings = write_corpus(
+            self._encoded_song_paths(encoded_song_path),
+            file_dataset_path,
+            corpus_path,
+            mapping_path,
+            sequence_length,
+            extend_mapping=extend_mapping
+        )
+        print(f"Wrote the corpus to {corpus_path} with a vocabulary of {len(mappings)} symbols")
+        return corpus_path
 
-    def preprocess_songs(self, dataset_path: str, song_txt_path: str, major_key: str, minor_key: str, file_type: str) -> None:
+    def preprocess_songs(self, dataset_path: str, song_txt_path: str, major_key: str, minor_key: str, file_type: str,
+                         workers: int = 0, time_step: float = 0.25, progress_interval: float = 10.0,
+                         use_cache: bool = True) -> None:
         """
         A method that encompasses many of the preprocessing operations needed for converting
-        the songs to a helpful representation for our RNN/LSTM/Time Series centric models
+        the songs to a helpful representation for our RNN/LSTM/Time Series centric models.
+        Files are streamed from disk into a process pool that parses, filters, transposes and encodes them, every
+        encoded song is written as soon as it is done. Only a few files per worker are in flight at once, so memory
+        stays flat however big the dataset is.
+        A manifest in song_txt_path remembers the content hash and parameters every file was encoded with, files
+        that haven't changed since the last run are skipped (see PreprocessingManifest)
 
         :param dataset_path (str): The complete path to the dataset you want to load
         :param song_text_path (str): The complete path where the song_txt file will be saved
         :param major_key (str): What major key we transpose songs to
         :param minor_key (str): What minor key we transpose songs to
+        :param file_type (str): The file type you want to load
+        :param workers (int): Processes used for the songs, 0 uses one per core and 1 runs everything in this process
+        :param time_step (float): Duration of each time step in quarter length
+        :param progress_interval (float): Seconds between two progress reports
+        :param use_cache (bool): False re-encodes every file even when the manifest has it
         :return None: This method returns nothing
         """
+        workers = workers if workers > 0 else (os.cpu_count() or 1)
+        os.makedirs(song_txt_path, exist_ok=True)
+        manifest = PreprocessingManifest(song_txt_path, dataset_path, {
+            "major_key": major_key,
+            "minor_key": minor_key,
+            "time_step": time_step,
+            "acceptable_durations": [float(duration) for duration in self.acceptable_durations],
+            "encoding_version": song_preprocessing.ENCODING_VERSION
+        })
+        total = sum(1 for _ in song_preprocessing.iter_song_files(dataset_path, file_type))
+        print(f"Preprocessing {total} songs with {workers} worker(s)...")
+
+        counts = {"done": 0, "cached": 0, "kept": 0, "filtered": 0, "failed": 0}
+        start = time.perf_counter()
+        last_report = start
+
+        def handle(file_path: str, content_hash: str, encoded_song: str = None, error: Exception = None) -> None:
+            nonlocal last_report
+            counts["done"] += 1
+            if error is not None:
+                # not recorded, so the file is tried again next run
+                print(f"Failed to preprocess {file_path} with error: {error}")
+                counts["failed"] += 1
+            else:
+                # a None song was filtered out for having non-acceptable durations
+                manifest.record(file_path, content_hash, encoded_song)
+                counts["kept" if encoded_song is not None else "filtered"] += 1
+                if (counts["kept"] + counts["filtered"]) % 100 == 0:
+                    manifest.save()
+
+            now = time.perf_counter()
+            if now - last_report >= progress_interval or counts["done"] == total:
+                last_report = now
+                rate = counts["done"] / max(now - start, 1e-9)
+                print(f"Preprocessed {counts['done']}/{total} songs ({rate:.1f} songs/s): {counts['cached']} cached, "
+                      f"{counts['kept']} kept, {counts['filtered']} filtered, {counts['failed']} failed")
+
+        def stale_songs():
+            """ Only the files the manifest doesn't have an up to date entry for """
+            for file_path in song_preprocessing.iter_song_files(dataset_path, file_type):
+                up_to_date, content_hash = manifest.lookup(file_path)
+                if up_to_date and use_cache:
+                    counts["cached"] += 1
+                    counts["done"] += 1
+                    continue
+                yield file_path, content_hash
+
+        arguments = (major_key, minor_key, self.acceptable_durations, time_step)
+
+        if workers == 1:
+            for file_path, content_hash in stale_songs():
+                try:
+                    handle(file_path, content_hash, song_preprocessing.process_song_file(file_path, *arguments))
+                except Exception as e:
+                    handle(file_path, content_hash, error=e)
+        else:
+            # fork where we can, the training scripts that call this have no __main__ guard for spawn to re-import
+            method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+            max_in_flight = workers * 4
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as executor:
+                in_flight = {}
+                for file_path, content_hash in stale_songs():
+                    future = executor.submit(song_preprocessing.process_song_file, file_path, *arguments)
+                    in_flight[future] = (file_path, content_hash)
+
+                    # keep the number of songs in flight bounded instead of queueing the whole dataset
+                    if len(in_flight) >= max_in_flight:
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self._handle_future(future, in_flight.pop(future), handle)
+
+                for future in list(in_flight):
+                    self._handle_future(future, in_flight.pop(future), handle)
+
+        removed = manifest.prune()
+        manifest.save()
+        print(f"Preprocessing done: {counts['cached']} songs reused from the cache, {counts['kept'] + counts['filtered']} "
+              f"processed, {removed} removed from the dataset. {manifest.counts()['kept']} encoded songs in total")
+
+    @staticmethod
+    def _handle_future(future, song: tuple, handle) -> None:
+        file_path, content_hash = song
+        try:
+            encoded_song = future.result()
+        except Exception as e:
+            handle(file_path, content_hash, error=e)
+            return
+        handle(file_path, content_hash, encoded_song)
+
+    def song_corpus_pipeline(self, pipeline_config: dict) -> None:
+        """
+        The preprocessing half of song_data_pipeline: encodes the songs and writes the corpus and mapping. The mapping
+        is rebuilt from the current songs unless 'EXTEND_MAPPING' is True (when fine-tuning, see create_mapping)
 
-        # load folk songs
-        print("Loading songs...")
-        songs = self.load_songs(dataset_path, file_type)
-        print(f"Loaded {len(songs)} songs.")
-
-        for i, song in enumerate(songs):
-
-            # filter out songs that have non-acceptable durations
-            if not self.has_acceptable_durations(song):
-                continue
-
-            # transpose songs to the major/minor key we want
-            song = self.transpose_song(song, major_key, minor_key)
-
-            # encode songs with music time series representation
-            encoded_song = self.encode_song(song)
-
-            # save songs to text file
-            save_path = os.path.join(song_txt_path, str(i))
-            self._file_helper.saveFile(encoded_song, save_path)
-
-    def song_data_pipeline(self, pipeline_config: dict) -> None:
-        """ 
-        A single method that encapsulates the entire preprocessing pipeline for files. 
-
-        :param pipeline_config (dict): A dict containing all the parameters and arguments for the methods being called.
+        :param pipeline_config (dict): See song_data_pipeline
         :return None: This method returns nothing
         """
         if (len(pipeline_config.keys()) < 6):
@@ -289,18 +414,30 @@ class MusicHelper:
             pipeline_config['ENCODED_SONG_PATH'],
             pipeline_config['MAJOR_KEY'],
             pipeline_config['MINOR_KEY'],
-            pipeline_config['FILE_TYPE']
+            pipeline_config['FILE_TYPE'],
+            workers=pipeline_config.get('WORKERS', 0),
+            time_step=pipeline_config.get('TIME_STEP', 0.25)
         )
         
-        songs = self.create_single_file_dataset(
+        self.create_corpus(
             pipeline_config['ENCODED_SONG_PATH'],
             pipeline_config['SINGLE_FILE_DATASET_PATH'],
-            pipeline_config['SEQUENCE_LENGTH']
+            pipeline_config['MAPPING_PATH'],
+            pipeline_config['SEQUENCE_LENGTH'],
+            corpus_path=pipeline_config.get('CORPUS_PATH'),
+            extend_mapping=pipeline_config.get('EXTEND_MAPPING', False)
         )
-
-        self.create_mapping(songs, pipeline_config['MAPPING_PATH'])
         print("Finished preprocessing songs!")
 
+    def song_data_pipeline(self, pipeline_config: dict) -> None:
+        """ 
+        A single method that encapsulates the entire preprocessing pipeline for files. 
+
+        :param pipeline_config (dict): A dict containing all the parameters and arguments for the methods being called.
+        :return None: This method returns nothing
+        """
+        self.song_corpus_pipeline(pipeline_config)
+
         print("Generating training data...")
         inputs, targets = self.generate_training_sequences(
             pipeline_config['SEQUENCE_LENGTH'],
@@ -311,3 +448,22 @@ class MusicHelper:
         print("Finishing creating training data. Now returning....")
         return inputs, targets
 
+    def song_sequence_pipeline(self, pipeline_config: dict) -> "CorpusSequence":
+        """
+        song_data_pipeline for corpora that don't fit in memory, returns batches instead of the full inputs, targets.
+        Needs a 'BATCH_SIZE' key, 'ONE_HOT': False hands out int batches for models with an embedding
+
+        :param pipeline_config (dict): See song_data_pipeline
+        :return (CorpusSequence): Pass it to model.fit
+        """
+        self.song_corpus_pipeline(pipeline_config)
+
+        print("Generating training batches...")
+        return self.create_training_sequence(
+            pipeline_config['SEQUENCE_LENGTH'],
+            pipeline_config['SINGLE_FILE_DATASET_PATH'],
+            pipeline_config['MAPPING_PATH'],
+            pipeline_config['BATCH_SIZE'],
+            one_hot=pipeline_config.get('ONE_HOT', True),
+            corpus_path=pipeline_config.get('CORPUS_PATH')
+        )
@@ -0,0 +1,132 @@
+import os
+import json
+import hashlib
+from typing import Iterator, List, Tuple
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parameters_hash(parameters: dict) -> str:
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def manifest_song_paths(encoded_song_path: str) -> List[str]:
+    """ The encoded songs a manifest lists, in the order PreprocessingManifest.encoded_songs gives them. None without a manifest """
+    path = os.path.join(encoded_song_path, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        entries = json.load(f).get("entries", {})
+    return [
+        os.path.join(encoded_song_path, entries[key]["output"])
+        for key in sorted(entries) if entries[key]["output"] is not None
+    ]
+
+
+class PreprocessingManifest:
+    def __init__(self, encoded_song_path: str, dataset_path: str, parameters: dict):
+        """
+        Remembers which source file produced which encoded song, so a preprocessing run only has to parse the files
+        that are new or changed. Every source file is recorded with its content hash and the hash of the pipeline
+        parameters it was encoded with (keys, time step, acceptable durations...). The encoded songs are named after
+        both hashes, so a change to either one gives a new file instead of overwriting the old one
+
+        :param encoded_song_path (str): Where the encoded songs and manifest.json live
+        :param dataset_path (str): The source files are recorded relative to this folder
+        :param parameters (dict): Everything besides the file contents that changes the encoded output
+        """
+        self.encoded_song_path = encoded_song_path
+        self.dataset_path = dataset_path
+        self.parameters = parameters
+        self.parameters_hash = parameters_hash(parameters)
+        self.path = os.path.join(encoded_song_path, MANIFEST_NAME)
+
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.entries = manifest.get("entries", {})
+
+        self._seen = set()
+
+    def _key(self, file_path: str) -> str:
+        return os.path.relpath(file_path, self.dataset_path)
+
+    def output_name(self, content_hash: str) -> str:
+        return hashlib.sha256((content_hash + self.parameters_hash).encode("utf-8")).hexdigest()[:32] + ".txt"
+
+    def lookup(self, file_path: str) -> Tuple[bool, str]:
+        """
+        :param file_path (str): A source file of the dataset
+        :return (bool, str): Whether the file is up to date in the manifest, and its content hash
+        """
+        key = self._key(file_path)
+        self._seen.add(key)
+        content_hash = file_hash(file_path)
+
+        entry = self.entries.get(key)
+        if entry is None or entry["hash"] != content_hash or entry["parameters"] != self.parameters_hash:
+            return False, content_hash
+        if entry["output"] is not None and not os.path.exists(os.path.join(self.encoded_song_path, entry["output"])):
+            return False, content_hash
+        return True, content_hash
+
+    def record(self, file_path: str, content_hash: str, encoded_song: str = None) -> None:
+        """ Stores the encoded song (None when the song was filtered out) and points the source file at it """
+        output = None
+        if encoded_song is not None:
+            output = self.output_name(content_hash)
+            with open(os.path.join(self.encoded_song_path, output), "w") as f:
+                f.write(encoded_song)
+
+        self.entries[self._key(file_path)] = {
+            "hash": content_hash,
+            "parameters": self.parameters_hash,
+            "output": output
+        }
+
+    def prune(self) -> int:
+        """
+        Drops the entries of source files that were not seen during this run and deletes the encoded songs nothing
+        points to anymore
+
+        :return (int): How many source files were dropped
+        """
+        removed = [key for key in self.entries if key not in self._seen]
+        for key in removed:
+            del self.entries[key]
+
+        referenced = {entry["output"] for entry in self.entries.values() if entry["output"] is not None}
+        for name in os.listdir(self.encoded_song_path):
+            if name != MANIFEST_NAME and name.endswith(".txt") and name not in referenced:
+                os.remove(os.path.join(self.encoded_song_path, name))
+        return len(removed)
+
+    def save(self) -> None:
+        """ Written to a temporary file first, an interrupted run keeps the previous manifest """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "parameters": self.parameters, "entries": self.entries}, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def encoded_songs(self) -> Iterator[str]:
+        """ The paths of the encoded songs in a stable order (sorted by source file) """
+        for key in sorted(self.entries):
+            output = self.entries[key]["output"]
+            if output is not None:
+                yield os.path.join(self.encoded_song_path, output)
+
+    def counts(self) -> dict:
+        kept = sum(1 for entry in self.entries.values() if entry["output"] is not None)
+        return {"sources": len(self.entries), "kept": kept, "filtered": len(self.entries) - kept}
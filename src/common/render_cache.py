@@ -0,0 +1,200 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterator, List
+
+
+class RenderCache:
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        A content addressed cache of rendered audio on disk. Every entry is keyed by a hash of what produced it
+        (the instrument, the model and soundfont file contents and the generation parameters), so a deterministic
+        request that was rendered before is served straight from disk. Entries are evicted in least-recently-used
+        order once the files add up to more than max_bytes
+
+        :param directory (str): Where the cached files go, created if needed
+        :param max_bytes (int): Upper bound on the summed size of the cached files
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()  # key -> (path, size), oldest first
+        self._size = 0
+        self._lock = threading.Lock()
+        self._digests = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self) -> None:
+        """ Picks up the files a previous run left behind, oldest access first """
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith("."):
+                    # an unfinished write
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                found.append((stat.st_mtime, name.split(".")[0], path, stat.st_size))
+
+        for _, key, path, size in sorted(found):
+            self._entries[key] = (path, size)
+            self._size += size
+        self._evict_if_needed()
+
+    def file_digest(self, path: str) -> str:
+        """
+        The sha256 of a file, only recomputed when its mtime or size changes. Hashing a soundfont takes a while, so
+        this is meant to run on a thread (and at startup through preload_digests), never on the event loop
+        """
+        stat = os.stat(path)
+        signature = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            cached = self._digests.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        # hashed outside the lock so lookups don't wait on it, two threads hashing the same file agree anyway
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        with self._lock:
+            self._digests[path] = (signature, digest.hexdigest())
+        return digest.hexdigest()
+
+    def preload_digests(self, paths: List[str]) -> None:
+        """ Hashes the model and soundfont files ahead of the first request, files that can't be read are skipped """
+        for path in paths:
+            try:
+                self.file_digest(path)
+            except OSError as e:
+                print(f"Could not hash {path} for the render cache: {e}")
+
+    def key(self, instrument_name: str, model_path: str, soundfont: str, parameters: dict) -> str:
+        """
+        :param instrument_name (str): A key of model_info.json
+        :param model_path (str): The model file, its contents are part of the key
+        :param soundfont (str): The .sf2 file, its contents are part of the key
+        :param parameters (dict): Everything else that decides the output, i.e: seed, temperature, format...
+        :return (str): The hex digest used as the entry's name
+        """
+        description = {
+            "instrument": instrument_name,
+            "model": self.file_digest(model_path),
+            "soundfont": self.file_digest(soundfont),
+            "parameters": parameters
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.{extension}")
+
+    def get(self, key: str) -> bytes:
+        """ The cached bytes or None, a hit makes the entry the most recently used """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+
+        try:
+            with open(entry[0], "rb") as f:
+                data = f.read()
+            # the mtime is what orders the entries after a restart
+            os.utime(entry[0])
+        except OSError:
+            # removed from under us, treat it as a miss
+            with self._lock:
+                if self._entries.pop(key, None) is not None:
+                    self._size -= entry[1]
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes, extension: str) -> None:
+        """ Stores the bytes under the key, written to a temporary file first so readers never see half a file """
+        if len(data) > self.max_bytes:
+            return
+
+        path = self._path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write {path} to the render cache: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (path, len(data))
+            self._size += len(data)
+            self._evict_if_needed()
+
+    def tee(self, chunks: Iterator[bytes], key: str, extension: str, finalize: Callable = None) -> Iterator[bytes]:
+        """
+        Passes a response stream through untouched and caches it once it has been fully sent. Only a stream that runs
+        to its end is cached, one the client leaves early or that raises is thrown away. The renderers and the encoder
+        raise when FluidSynth or ffmpeg fail, so a stream that ended is a complete file
+
+        :param chunks (Iterator[bytes]): The response body
+        :param key (str): See key
+        :param extension (str): The file extension of the cached entry
+        :param finalize (Callable): Turns the streamed bytes into the file to cache, i.e: fixing a streaming wav header
+        :return (Iterator[bytes]):
+        """
+        parts = []
+        try:
+            for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+        except BaseException:
+            # a failed render or a client that left, whatever was sent so far isn't the file
+            parts.clear()
+            raise
+
+        data = b"".join(parts)
+        self.put(key, finalize(data) if finalize is not None else data, extension)
+
+    def _evict_if_needed(self) -> None:
+        """ Only called while holding the lock """
+        while self._size > self.max_bytes and self._entries:
+            key, (path, size) = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes
+            }
@@ -0,0 +1,411 @@
+import os
+import struct
+import tempfile
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List
+from audio_encoder import encode_pcm, encode_pcm_stream
+from synth_pool import SynthPool
+import midi_writer
+
+# Everything in here runs in the render worker processes (see ExecutionLayer), so this module
+# must stay importable without tensorflow and only use plain picklable arguments. music21 is only imported by the
+# functions that still go through a stream, the direct midi writer doesn't need it
+
+# the FluidSynth synths of this process, see configure_synth_pool
+_synth_pool = None
+_synth_pool_settings = None
+_synth_pool_lock = threading.Lock()
+
+
+def transpose_song(song, emotion: str):
+    """ Transposes the song to the key we use for an emotion, major and minor songs get different keys """
+    import music21 as m21
+
+    key = song.analyze("key")
+    major_key, minor_key = midi_writer.EMOTION_KEYS.get(emotion, midi_writer.DEFAULT_KEYS)
+
+    # get interval for transposition. E.g., Bmaj -> Cmaj
+    if key.mode == "major":
+        interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch(major_key))
+    elif key.mode == "minor":
+        interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch(minor_key))
+
+    # transpose song by calculated interval
+    return song.transpose(interval)
+
+
+def melody_to_stream(melody: List[str], step_duration=0.25):
+    """
+    Converts our list of symbols to a m21 stream of notes, chords and rests
+
+    :param melody (List[str]): i.e: ["60", "_", "_", "r", "5.8.10", "_"]
+    :param step_duration (float): Music theory stuff, the smallest note used, make sure this matches what you trained the model with
+    :return (m21 stream):
+    """
+    import music21 as m21
+
+    # create a music21 stream
+    stream = m21.stream.Stream()
+
+    # parse all the symbols in the melody and create note/rest objects
+    # i.e: 60 _ _ _ r _ 62 _ ....
+    start_symbol = None
+    step_counter = 1
+
+    for i, symbol in enumerate(melody):
+        # handle case in which we have a note/rest
+        # else handle case in which we have a prolongation sign "_"
+        if symbol != "_" or (i + 1) == len(melody):
+            # ensure we're dealing with notes/rests beyond the first symbol
+            if start_symbol is not None:
+                quarter_length_duration = step_duration * step_counter # converts to the time scale of a note
+
+                # Handle rest
+                # Else Handle note
+                if start_symbol == "r":
+                    m21_event = m21.note.Rest(quarterLength=quarter_length_duration)
+                elif '.' in start_symbol:
+                    notes_in_chord = start_symbol.split('.')
+                    notes = []
+                    for current_note in notes_in_chord:
+                        new_note = m21.note.Note(int(current_note))
+                        notes.append(new_note)
+                    m21_event = m21.chord.Chord(notes, quarterLength=quarter_length_duration)
+                else:
+                    m21_event = m21.note.Note(int(start_symbol), quarterLength=quarter_length_duration)
+                stream.append(m21_event)
+
+                # reset to the other note
+                step_counter = 1
+            start_symbol = symbol
+        else:
+            step_counter += 1
+
+    return stream
+
+
+def save_melody(melody: List[str], file_name: str, emotion: str, format="mid", step_duration=0.25, writer="direct"):
+    """ 
+    Saves the melody to the desired file format, midi is written directly and anything else goes through a m21 stream
+
+    :param melody (List[str]): Our melody list to be saved on disk
+    :param file_name (str): The name of the file we want to save including model path
+    :param format (str): The music file format you want to save to, music21 supports very little so this should always be midi
+    :param step_duration (float): Music theory stuff, the smallest note used, make sure this matches what you trained the model with
+    :param writer (str): "direct" writes midi without music21 (see midi_writer), "music21" always goes through a stream
+    :return (None): This function returns nothing, it saves to disk
+    """
+    if format in ("mid", "midi"):
+        try:
+            with open(file_name, "wb") as midi_file:
+                midi_file.write(melody_to_midi(melody, emotion, step_duration, writer))
+        except Exception as e:
+            print(f"Exception when trying to write file: {file_name} with error: {e}")
+        return
+
+    stream = melody_to_stream(melody, step_duration)
+
+    # We first try to transpose the song according to its emotion
+    # if that fails we just save the original song/stream to disk
+    try:
+        new_stream = transpose_song(stream, emotion)
+        new_stream.write(format, file_name)
+    except Exception as e:
+        print(f"Exception when trying to write transposed song: {file_name} with error: {e}")
+        try:
+            print("Attempting to write original m21 stream instead")
+            stream.write(format, file_name)
+        except Exception as e:
+            print(f"Exception when trying to write file: {file_name} with error: {e}")
+
+
+def melody_to_midi(melody: List[str], emotion: str, step_duration=0.25, writer="direct") -> bytes:
+    """
+    Same as save_melody but returns the midi file's bytes instead of writing it to disk
+
+    :param melody (List[str]): The symbols produced by MelodyGenerator.generate_melody
+    :param emotion (str): Picks the key the melody is transposed to
+    :param step_duration (float): Music theory stuff, the smallest note used, make sure this matches what you trained the model with
+    :param writer (str): "direct" writes midi without music21 (see midi_writer), "music21" always goes through a stream
+    :return (bytes): A standard midi file
+    """
+    if writer == "direct":
+        try:
+            return midi_writer.melody_to_midi(melody, emotion, step_duration)
+        except Exception as e:
+            print(f"Exception when writing midi directly, falling back to music21: {e}")
+    return melody_to_midi_music21(melody, emotion, step_duration)
+
+
+def melody_to_midi_music21(melody: List[str], emotion: str, step_duration=0.25) -> bytes:
+    """ The music21 version of melody_to_midi: builds a stream, transposes it and serializes it """
+    import music21 as m21
+
+    stream = melody_to_stream(melody, step_duration)
+
+    # We first try to transpose the song according to its emotion
+    # if that fails we use the original stream
+    try:
+        stream = transpose_song(stream, emotion)
+    except Exception as e:
+        print(f"Exception when trying to transpose song, using the original stream instead: {e}")
+
+    midi_file = m21.midi.translate.streamToMidiFile(stream)
+    return midi_file.writestr()
+
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2 # FluidSynth's raw output is 16 bit signed PCM
+
+
+def wav_header(sample_rate: int = SAMPLE_RATE, channels: int = CHANNELS, data_size: int = None) -> bytes:
+    """
+    The 44 byte RIFF header for 16 bit PCM audio. When streaming we don't know the size yet, so both size fields
+    are set to their maximum which browsers and decoders treat as "read until the end"
+
+    :param sample_rate (int):
+    :param channels (int):
+    :param data_size (int): The number of PCM bytes following the header, None when unknown
+    :return (bytes):
+    """
+    data_size = 0xFFFFFFFF - 36 if data_size is None else data_size
+    byte_rate = sample_rate * channels * SAMPLE_WIDTH
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", data_size + 36, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate, byte_rate, channels * SAMPLE_WIDTH, SAMPLE_WIDTH * 8,
+        b"data", data_size
+    )
+
+
+def complete_wav_header(wav: bytes) -> bytes:
+    """ Swaps the placeholder sizes of a streamed wav for the real ones once the whole file is known """
+    return wav_header(data_size=len(wav) - 44) + wav[44:]
+
+
+def default_tmp_dir() -> str:
+    """ Prefer shared memory for the short lived midi files FluidSynth reads, so they never touch the disk """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def validate_soundfont(soundfont: str) -> int:
+    """
+    Checks the file is a SoundFont 2 (a RIFF file of the "sfbk" form) before FluidSynth is ever pointed at it,
+    FluidSynth itself only complains on stderr and renders silence. Reading the whole file also pulls it into
+    the page cache, so the first render doesn't wait on the disk
+
+    :param soundfont (str): The path to the .sf2 file
+    :return (int): The size of the soundfont in bytes
+    """
+    with open(soundfont, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"sfbk":
+            raise ValueError(f"{soundfont} is not a SoundFont 2 file")
+        declared_size = struct.unpack("<I", header[4:8])[0] + 8
+        size = len(header)
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            size += len(chunk)
+    if size < declared_size:
+        raise ValueError(f"{soundfont} is truncated, {size} of {declared_size} bytes")
+    return size
+
+
+def configure_synth_pool(backend: str = "binding", instances_per_soundfont: int = 1, acquire_timeout: float = 0.0,
+                         health_check_interval: float = 60.0) -> None:
+    """
+    Sets up the synth pool of this process (see SynthPool), it is also the initializer of the render workers.
+    Calling it again with the same settings keeps the running synths
+    """
+    global _synth_pool, _synth_pool_settings
+    settings = (backend, instances_per_soundfont, acquire_timeout, health_check_interval)
+    with _synth_pool_lock:
+        if _synth_pool is not None and _synth_pool_settings == settings:
+            return
+        if _synth_pool is not None:
+            _synth_pool.close()
+        _synth_pool = SynthPool(*settings)
+        _synth_pool_settings = settings
+
+
+def get_synth_pool() -> SynthPool:
+    """ The synth pool of this process, one with the default settings when configure_synth_pool was never called """
+    global _synth_pool, _synth_pool_settings
+    with _synth_pool_lock:
+        if _synth_pool is None:
+            _synth_pool = SynthPool()
+        return _synth_pool
+
+
+def synth_available(soundfont: str) -> bool:
+    """ Checked before a response starts streaming, a render that can't start would otherwise send an empty 200 """
+    return get_synth_pool().available(soundfont)
+
+
+def preload_synths(soundfonts: List[str], sample_rate: int = SAMPLE_RATE) -> None:
+    """ Starts this process's synths for the soundfonts, used to warm up the render workers """
+    get_synth_pool().preload(soundfonts, sample_rate)
+
+
+def stream_pcm(midi_bytes: bytes, soundfont, sample_rate: int = SAMPLE_RATE, chunk_size: int = 64 * 1024,
+               tmp_dir: str = None, midi_path: str = None, programs: dict = None) -> Iterator[bytes]:
+    """
+    Renders midi with FluidSynth and yields the raw PCM as it is synthesized, on an idle synth of the synth pool that
+    already has the soundfont loaded (or the fluidsynth command line when there is none, see SynthPool).
+    FluidSynth only reads midi from a file, so the bytes go to a temporary file (in shared memory when possible)
+    that is removed once rendering is done or the consumer stops early. Raises when FluidSynth fails or renders nothing
+
+    :param midi_bytes (bytes): A standard midi file
+    :param soundfont (str): The path to the .sf2 file used to synthesize the midi
+    :param sample_rate (int):
+    :param chunk_size (int): How many bytes are read from FluidSynth at a time
+    :param tmp_dir (str): Where the temporary midi file goes, see default_tmp_dir
+    :param midi_path (str): The midi is already in this file (i.e: an ArtifactStore artifact), no temporary file is
+        made and the caller stays in charge of removing it
+    :param programs (dict): Binds channels to the soundfonts of a tuple of them, see SynthPool.render
+    :return (Iterator[bytes]): 16 bit stereo PCM chunks
+    """
+    midi_file = None
+    if midi_path is None:
+        midi_file = tempfile.NamedTemporaryFile(suffix=".mid", dir=tmp_dir or default_tmp_dir(), delete=False)
+        midi_path = midi_file.name
+    try:
+        if midi_file is not None:
+            midi_file.write(midi_bytes)
+            midi_file.close()
+        rendered = 0
+        for chunk in get_synth_pool().render(midi_path, soundfont, sample_rate, chunk_size, programs=programs):
+            rendered += len(chunk)
+            yield chunk
+        # FluidSynth can exit cleanly without having rendered anything, that is no audio file either
+        if rendered == 0:
+            raise RuntimeError(f"FluidSynth rendered no audio with {soundfont}")
+    finally:
+        if midi_file is not None:
+            os.remove(midi_file.name)
+
+
+def stream_wav(midi_bytes: bytes, soundfont: str, sample_rate: int = SAMPLE_RATE, tmp_dir: str = None,
+               midi_path: str = None) -> Iterator[bytes]:
+    """ stream_pcm with a streaming wav header in front, ready to be sent as a response body """
+    yield wav_header(sample_rate)
+    yield from stream_pcm(midi_bytes, soundfont, sample_rate, tmp_dir=tmp_dir, midi_path=midi_path)
+
+
+def render_wav(midi_bytes: bytes, soundfont: str, sample_rate: int = SAMPLE_RATE, tmp_dir: str = None) -> bytes:
+    """ Renders the whole midi to a complete wav file in memory """
+    pcm = b"".join(stream_pcm(midi_bytes, soundfont, sample_rate, tmp_dir=tmp_dir))
+    return wav_header(sample_rate, data_size=len(pcm)) + pcm
+
+
+def stream_audio(midi_bytes: bytes, soundfont: str, audio_format: str = "wav", bitrate: str = None,
+                 sample_rate: int = SAMPLE_RATE, tmp_dir: str = None, midi_path: str = None) -> Iterator[bytes]:
+    """
+    Streams the rendered midi in the requested format, anything but wav is encoded on the fly by ffmpeg
+
+    :param midi_bytes (bytes): A standard midi file
+    :param soundfont (str): The path to the .sf2 file used to synthesize the midi
+    :param audio_format (str): One of audio_encoder.AUDIO_FORMATS, midi is returned as is
+    :param bitrate (str): i.e: "96k", ignored by wav/flac/midi
+    :param sample_rate (int):
+    :param tmp_dir (str): Where the temporary midi file goes, see default_tmp_dir
+    :param midi_path (str): A file already holding the midi, see stream_pcm
+    :return (Iterator[bytes]):
+    """
+    if audio_format == "midi":
+        yield midi_bytes
+    elif audio_format == "wav":
+        yield from stream_wav(midi_bytes, soundfont, sample_rate, tmp_dir=tmp_dir, midi_path=midi_path)
+    else:
+        pcm = stream_pcm(midi_bytes, soundfont, sample_rate, tmp_dir=tmp_dir, midi_path=midi_path)
+        yield from encode_pcm_stream(pcm, audio_format, bitrate, sample_rate, CHANNELS)
+
+
+def render_melody_audio(melody: List[str], emotion: str, soundfont: str, audio_format: str = "wav", bitrate: str = None,
+                        tmp_dir: str = None, writer: str = "direct") -> bytes:
+    """
+    Converts the melody to midi and renders it in the requested format in one go, so a single worker task covers it all
+
+    :param melody (List[str]): The symbols produced by MelodyGenerator.generate_melody
+    :param emotion (str): Picks the key the melody is transposed to
+    :param soundfont (str): The path to the .sf2 file used to synthesize the midi
+    :param audio_format (str): One of audio_encoder.AUDIO_FORMATS
+    :param bitrate (str): i.e: "96k", ignored by wav/flac/midi
+    :param tmp_dir (str): Where the temporary midi file goes, see default_tmp_dir
+    :param writer (str): See melody_to_midi
+    :return (bytes): The complete audio file
+    """
+    midi_bytes = melody_to_midi(melody, emotion, writer=writer)
+    if audio_format == "midi":
+        return midi_bytes
+    if audio_format == "wav":
+        return render_wav(midi_bytes, soundfont, tmp_dir=tmp_dir)
+
+    pcm = b"".join(stream_pcm(midi_bytes, soundfont, tmp_dir=tmp_dir))
+    return encode_pcm(pcm, audio_format, bitrate, SAMPLE_RATE, CHANNELS)
+
+
+def mix_pcm(tracks: List[bytes]) -> bytes:
+    """
+    Mixes 16 bit PCM tracks into one by summing them, shorter tracks are padded with silence. The mix is only
+    scaled down when the sum would clip, so a single track comes out unchanged
+
+    :param tracks (List[bytes]): 16 bit PCM with the same sample rate and channels
+    :return (bytes): 16 bit PCM as long as the longest track
+    """
+    arrays = [np.frombuffer(track, dtype=np.int16) for track in tracks]
+    mixed = np.zeros(max((len(array) for array in arrays), default=0), dtype=np.int32)
+    for array in arrays:
+        mixed[:len(array)] += array
+
+    peak = int(np.abs(mixed).max()) if len(mixed) else 0
+    if peak > 32767:
+        mixed = mixed * (32767 / peak)
+    return mixed.astype(np.int16).tobytes()
+
+
+def render_arrangement_audio(melodies: List[List[str]], emotion: str, soundfonts: List[str], audio_format: str = "wav",
+                             bitrate: str = None, tmp_dir: str = None, writer: str = "direct", channels: List[tuple] = None) -> bytes:
+    """
+    Renders the melodies into a single audio file. With the FluidSynth binding the arrangement's midi is played once
+    on a synth that has every soundfont loaded, each track's channel bound to its own soundfont and program. The
+    command line only takes one soundfont, so without the binding every melody is rendered on its own (at the same
+    time) and the tracks are mixed, the channels and programs then make no difference to the audio
+
+    :param melodies (List[List[str]]): One melody per track
+    :param emotion (str): Picks the key every melody is transposed to
+    :param soundfonts (List[str]): The .sf2 file of every track
+    :param audio_format (str): One of audio_encoder.AUDIO_FORMATS except midi, see midi_writer.arrangement_to_midi
+    :param bitrate (str): i.e: "96k", ignored by wav/flac
+    :param tmp_dir (str): Where the temporary midi files go, see default_tmp_dir
+    :param writer (str): See melody_to_midi, only used when the tracks are rendered on their own
+    :param channels (List[tuple]): The (channel, program) of every track, tracks sharing a channel share its soundfont
+    :return (bytes): The complete audio file
+    """
+    if channels is not None and get_synth_pool().persistent():
+        # the programs are bound to the channels up front, program changes in the midi would pick any soundfont's preset
+        midi_bytes = midi_writer.arrangement_to_midi(
+            [(melody, channel, None) for melody, (channel, _) in zip(melodies, channels)],
+            emotion
+        )
+        programs = {channel: (soundfont, program) for (channel, program), soundfont in zip(channels, soundfonts)}
+        pcm = b"".join(stream_pcm(midi_bytes, tuple(sorted(set(soundfonts))), tmp_dir=tmp_dir, programs=programs))
+    else:
+        def render_track(melody: List[str], soundfont: str) -> bytes:
+            midi_bytes = melody_to_midi(melody, emotion, writer=writer)
+            return b"".join(stream_pcm(midi_bytes, soundfont, tmp_dir=tmp_dir))
+
+        with ThreadPoolExecutor(max_workers=max(len(melodies), 1)) as executor:
+            tracks = list(executor.map(render_track, melodies, soundfonts))
+        pcm = mix_pcm(tracks)
+
+    if audio_format == "wav":
+        return wav_header(data_size=len(pcm)) + pcm
+    return encode_pcm(pcm, audio_format, bitrate, SAMPLE_RATE, CHANNELS)
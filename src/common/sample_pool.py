@@ -0,0 +1,167 @@
+import time
+import threading
+from collections import deque
+from typing import Callable, List, Tuple
+
+
+class _PoolSlot:
+    def __init__(self):
+        self.clips = deque()
+        self.in_flight = 0
+        self.refilling = False
+        self.produced = 0
+        self.served = 0
+        self.empty = 0
+        self.failures = 0
+        self.deferred = 0
+        self.produce_times = deque(maxlen=32)
+
+
+class SamplePool:
+    def __init__(self, produce: Callable, keys: List[Tuple[str, str]], high_watermark: int = 4, low_watermark: int = 2,
+                 workers: int = 1, rate_window: float = 60.0, retry_delay: float = 1.0):
+        """
+        Keeps a few ready-rendered clips for every (instrument, emotion) pair so requests don't wait on generation
+        and rendering. Background workers refill a pair once it drops below the low watermark and keep going until
+        it is back at the high watermark, the emptiest pair always goes first
+
+        :param produce (Callable): Takes an instrument and an emotion and returns one clip, runs on the worker threads.
+            It returns None when there is no capacity to make a clip right now, the worker tries again after retry_delay
+        :param keys (List[Tuple[str, str]]): The (instrument, emotion) pairs to keep clips for
+        :param high_watermark (int): How many clips a pair is refilled up to
+        :param low_watermark (int): A pair with fewer clips than this (counting the ones being made) gets refilled
+        :param workers (int): How many clips are produced at once
+        :param rate_window (float): Seconds of history used for the refill rate
+        :param retry_delay (float): How long a worker waits after a failed or deferred clip before trying again
+        """
+        self._produce = produce
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.rate_window = rate_window
+        self.retry_delay = retry_delay
+
+        self._slots = {key: _PoolSlot() for key in keys}
+        self._condition = threading.Condition()
+        self._produced_at = deque()
+        self._stopped = False
+        self._workers = [
+            threading.Thread(target=self._work, name=f"sample-pool-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self) -> None:
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self) -> None:
+        """ The workers exit once they finish the clip they are making """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def take(self, instrument_name: str, emotion: str):
+        """
+        :return: A ready clip, or None when the pair is not pooled or has run dry
+        """
+        slot = self._slots.get((instrument_name, emotion))
+        if slot is None:
+            return None
+
+        with self._condition:
+            if not slot.clips:
+                slot.empty += 1
+                self._condition.notify()
+                return None
+            slot.served += 1
+            clip = slot.clips.popleft()
+            self._condition.notify()
+            return clip
+
+    def _next_key(self):
+        """ Only called while holding the lock. Applies the watermarks and picks the emptiest pair that needs clips """
+        chosen = None
+        chosen_level = None
+        for key, slot in self._slots.items():
+            level = len(slot.clips) + slot.in_flight
+            if level < self.low_watermark:
+                slot.refilling = True
+            elif level >= self.high_watermark:
+                slot.refilling = False
+
+            if slot.refilling and level < self.high_watermark and (chosen is None or level < chosen_level):
+                chosen = key
+                chosen_level = level
+        return chosen
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                key = self._next_key()
+                while key is None and not self._stopped:
+                    self._condition.wait()
+                    key = self._next_key()
+                if self._stopped:
+                    return
+                slot = self._slots[key]
+                slot.in_flight += 1
+
+            start = time.perf_counter()
+            try:
+                clip = self._produce(*key)
+            except Exception as e:
+                print(f"Failed to make a pooled sample for {key[0]}/{key[1]} with error: {e}")
+                with self._condition:
+                    slot.in_flight -= 1
+                    slot.failures += 1
+                time.sleep(self.retry_delay)
+                continue
+
+            if clip is None:
+                with self._condition:
+                    slot.in_flight -= 1
+                    slot.deferred += 1
+                time.sleep(self.retry_delay)
+                continue
+
+            with self._condition:
+                slot.in_flight -= 1
+                slot.clips.append(clip)
+                slot.produced += 1
+                slot.produce_times.append(time.perf_counter() - start)
+                self._produced_at.append(time.time())
+
+    def depth(self, instrument_name: str, emotion: str) -> int:
+        slot = self._slots.get((instrument_name, emotion))
+        return len(slot.clips) if slot is not None else 0
+
+    def refill_rate(self) -> float:
+        """ Clips produced per second over the last rate_window seconds """
+        with self._condition:
+            cutoff = time.time() - self.rate_window
+            while self._produced_at and self._produced_at[0] < cutoff:
+                self._produced_at.popleft()
+            return len(self._produced_at) / self.rate_window
+
+    def stats(self) -> dict:
+        refill_rate = self.refill_rate()
+        with self._condition:
+            pairs = {}
+            for (instrument_name, emotion), slot in self._slots.items():
+                pairs.setdefault(instrument_name, {})[emotion] = {
+                    "depth": len(slot.clips),
+                    "in_flight": slot.in_flight,
+                    "refilling": slot.refilling,
+                    "produced": slot.produced,
+                    "served": slot.served,
+                    "empty": slot.empty,
+                    "failures": slot.failures,
+                    "deferred": slot.deferred,
+                    "average_produce_time": round(sum(slot.produce_times) / len(slot.produce_times), 4) if slot.produce_times else 0.0
+                }
+            return {
+                "high_watermark": self.high_watermark,
+                "low_watermark": self.low_watermark,
+                "total_depth": sum(len(slot.clips) for slot in self._slots.values()),
+                "refill_rate": round(refill_rate, 4),
+                "pairs": pairs
+            }
@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class Sampler:
+    def __init__(self, vocabulary_size: int, seed: int = None, top_k: int = 0, top_p: float = 1.0):
+        """
+        Picks the next symbol from the model's output distribution. One sampler is made per generation and reused for
+        every step, it owns its random generator and the buffers the math runs in so a step allocates nothing
+
+        :param vocabulary_size (int): The length of the probability vectors the model outputs
+        :param seed (int): Seeds the random generator, None draws fresh entropy
+        :param top_k (int): Only sample from the k most likely symbols, 0 keeps them all
+        :param top_p (float): Only sample from the smallest set of symbols whose probability adds up to top_p (nucleus sampling)
+        """
+        self.top_k = top_k
+        self.top_p = top_p
+        self._rng = np.random.default_rng(seed)
+        self._weights = np.empty(vocabulary_size, dtype=np.float64)
+        self._cumulative = np.empty(vocabulary_size, dtype=np.float64)
+
+    def sample(self, probabilities: np.ndarray, temperature: float) -> int:
+        """
+        Samples from softmax(log(probabilities) / temperature), the same distribution the old
+        _sample_with_temperature used, with a single exp and a binary search over the cumulative sum
+
+        :param probabilities (np.ndarray): The output of the model for one step
+        :param temperature (float): How creative we want our model to be
+        :return (int): The sampled symbol
+        """
+        weights = self._weights
+
+        # log-softmax with temperature, shifted by the max so the exp can't overflow
+        with np.errstate(divide="ignore"):
+            np.log(probabilities, out=weights)
+        weights /= temperature
+        weights -= weights.max()
+        np.exp(weights, out=weights)
+
+        size = len(weights)
+        if 0 < self.top_k < size:
+            # everything below the k-th largest weight gets no chance
+            threshold = np.partition(weights, size - self.top_k)[size - self.top_k]
+            weights[weights < threshold] = 0.0
+
+        if self.top_p < 1.0:
+            order = np.argsort(weights)[::-1]
+            cumulative = np.cumsum(weights[order])
+            cutoff = np.searchsorted(cumulative, self.top_p * cumulative[-1]) + 1
+            weights[order[cutoff:]] = 0.0
+
+        np.cumsum(weights, out=self._cumulative)
+        target = self._rng.random() * self._cumulative[-1]
+        index = int(np.searchsorted(self._cumulative, target, side="right"))
+
+        # floating point error can push the target onto the very end of the cumulative sum
+        return min(index, size - 1)
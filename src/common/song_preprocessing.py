@@ -0,0 +1,160 @@
+import os
+import functools
+import numpy as np
+import music21 as m21
+from typing import Iterator, List, Tuple
+
+# The per song steps of MusicHelper's preprocessing. They live here, away from MusicHelper and its tensorflow
+# import, so the preprocessing worker processes only have to load music21
+
+# Part of the preprocessing cache key, bump it whenever a change here changes the encoded songs
+ENCODING_VERSION = 2
+
+
+def iter_song_files(dataset_path: str, file_type: str) -> Iterator[str]:
+    """
+    Walks the dataset lazily and yields the path of every file of the target type, in a stable order
+
+    :param dataset_path (str): Path to dataset
+    :param file_type (str): The file type you want to load, i.e: "krn"
+    :return (Iterator[str]):
+    """
+    for path, directories, files in os.walk(dataset_path):
+        directories.sort()
+        for file in sorted(files):
+            if file.endswith(file_type):
+                yield os.path.join(path, file)
+
+
+def has_acceptable_durations(song, acceptable_durations: List[float]) -> bool:
+    for note in song.flatten().notesAndRests:
+        if note.duration.quarterLength not in acceptable_durations:
+            return False
+    return True
+
+
+def transpose_song(song, major_key: str, minor_key: str):
+    """ Transposes a major song to major_key and a minor song to minor_key """
+    key = song.analyze("key")
+
+    # get interval for transposition. E.g., Bmaj -> Cmaj
+    if key.mode == "major":
+        interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch(major_key))
+    elif key.mode == "minor":
+        interval = m21.interval.Interval(key.tonic, m21.pitch.Pitch(minor_key))
+
+    return song.transpose(interval)
+
+
+def chord_symbol(pitches: Tuple[int, ...]) -> str:
+    """ The dotted normal order the chord models' mappings use, i.e: (65, 68, 70) -> "5.8.10" """
+    return _normal_order_symbol(tuple(sorted({pitch % 12 for pitch in pitches})))
+
+
+@functools.lru_cache(maxsize=4096)
+def _normal_order_symbol(pitch_classes: Tuple[int, ...]) -> str:
+    # the normal order only depends on the pitch classes, and Pitch objects skip the enharmonic spelling search
+    # music21 runs on chords made from plain ints
+    chord = m21.chord.Chord([m21.pitch.Pitch(midi=60 + pitch_class) for pitch_class in pitch_classes])
+    return ".".join(str(pitch_class) for pitch_class in chord.normalOrder)
+
+
+def event_pitches(event) -> List[int]:
+    """ The midi pitches an event sounds, unpitched percussion goes by where it is displayed. Empty for rests """
+    if isinstance(event, m21.note.Rest):
+        return []
+    if isinstance(event, m21.note.Unpitched):
+        return [event.displayPitch().midi]
+    if isinstance(event, m21.percussion.PercussionChord):
+        return [pitch for note in event.notes for pitch in event_pitches(note)]
+    return [pitch.midi for pitch in event.pitches]
+
+
+def song_events(song, time_step: float = 0.25):
+    """
+    Flattens every part of the song into compact arrays, one row per sounding pitch and one per rest, with offsets
+    and durations already counted in time steps. Events shorter than a time step don't take up a step and are dropped
+
+    :param song (m21 stream): Piece to read
+    :param time_step (float): Duration of each time step in quarter length
+    :return starts, lengths, pitches, rest_starts, rest_lengths (np.ndarray):
+    """
+    starts, lengths, pitches, rest_starts, rest_lengths = [], [], [], [], []
+    parts = song.parts if isinstance(song, m21.stream.Score) and song.parts else [song]
+    for part in parts:
+        for event in part.flatten().notesAndRests:
+            steps = int(event.duration.quarterLength / time_step)
+            if steps == 0:
+                continue
+            start = int(round(float(event.offset) / time_step))
+
+            event_pitch_list = event_pitches(event)
+            if not event_pitch_list:
+                rest_starts.append(start)
+                rest_lengths.append(steps)
+            for pitch in event_pitch_list:
+                starts.append(start)
+                lengths.append(steps)
+                pitches.append(pitch)
+
+    return tuple(np.array(values, dtype=np.int64) for values in (starts, lengths, pitches, rest_starts, rest_lengths))
+
+
+def encode_song(song, time_step: float = 0.25) -> str:
+    """
+    See MusicHelper.encode_song. All parts are laid on one time grid. A step where something starts is the midi number
+    of the pitch sounding there, or the dotted normal order when several pitches sound (a chord, or notes of different
+    parts). A step where nothing sounds is "r" when a rest or a silence starts there, every other step is "_".
+    For a single voice this is the same as writing every note/rest out one after the other
+    """
+    starts, lengths, pitches, rest_starts, rest_lengths = song_events(song, time_step)
+    total_steps = int(max((starts + lengths).max(initial=0), (rest_starts + rest_lengths).max(initial=0)))
+    if total_steps == 0:
+        return ""
+
+    # how many pitches sound at every step
+    changes = np.zeros(total_steps + 1, dtype=np.int64)
+    np.add.at(changes, starts, 1)
+    np.add.at(changes, starts + lengths, -1)
+    sounding = np.cumsum(changes[:-1]) > 0
+
+    encoded_song = np.full(total_steps, "_", dtype=object)
+
+    # silences start with a rest symbol, be it a written rest or a gap between notes
+    silence_start = np.concatenate(([True], sounding[:-1]))
+    silence_start[rest_starts] = True
+    encoded_song[~sounding & silence_start] = "r"
+
+    # one symbol per onset step, made of everything sounding at that step (held notes of other parts included).
+    # Every event sounds at the onsets from its start up to its end, so the (onset, pitch) pairs come out of two
+    # searchsorted calls instead of masking all the events at every onset
+    if len(starts) > 0:
+        onsets = np.unique(starts)
+        first = np.searchsorted(onsets, starts)
+        counts = np.searchsorted(onsets, starts + lengths) - first
+        covered = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        # sorted by onset then pitch and deduplicated in one go, every onset has at least the event starting there
+        base = int(pitches.max()) + 1
+        pairs = np.unique(covered * base + np.repeat(pitches, counts))
+        groups = np.split(pairs % base, np.flatnonzero(np.diff(pairs // base)) + 1)
+        for step, group in zip(onsets.tolist(), groups):
+            encoded_song[step] = str(group[0]) if len(group) == 1 else chord_symbol(tuple(group.tolist()))
+
+    # cast encoded song to str
+    return " ".join(encoded_song)
+
+
+def process_song_file(file_path: str, major_key: str, minor_key: str, acceptable_durations: List[float],
+                      time_step: float = 0.25) -> str:
+    """
+    parse -> duration filter -> transpose -> encode for a single file, this is what the worker processes run
+
+    :return (str): The encoded song, None when the song has durations we don't accept
+    """
+    song = m21.converter.parse(file_path)
+    if not has_acceptable_durations(song, acceptable_durations):
+        return None
+
+    song = transpose_song(song, major_key, minor_key)
+    return encode_song(song, time_step)
@@ -0,0 +1,385 @@
+import os
+import time
+import shutil
+import threading
+import subprocess
+from collections import deque
+from typing import Iterator, List
+from midi_writer import DRUM_CHANNEL
+
+# FluidSynth instances that stay alive between renders, so a soundfont is parsed once instead of on every request.
+# With pyfluidsynth (and libfluidsynth) installed a synth lives in this process and renders a midi file by driving its
+# player on the sample clock, which is what fluidsynth -F does. Without it every render runs the fluidsynth command
+# line, which loads the soundfont again each time. Like render_helper this must stay importable without tensorflow
+
+SYNTH_BACKENDS = ["binding", "process"]
+
+_binding = None
+_binding_checked = False
+_binding_lock = threading.Lock()
+
+
+def load_binding():
+    """ The pyfluidsynth module when it and libfluidsynth can be loaded, None otherwise. Only tried once per process """
+    global _binding, _binding_checked
+    with _binding_lock:
+        if not _binding_checked:
+            _binding_checked = True
+            try:
+                import fluidsynth
+                if getattr(fluidsynth, "fluid_player_get_status", None) is None:
+                    raise ImportError("the FluidSynth library is too old to report the player status")
+                _binding = fluidsynth
+            except (ImportError, OSError) as e:
+                print(f"The FluidSynth binding is not available, rendering with the fluidsynth command line: {e}")
+        return _binding
+
+
+class BindingSynth:
+    kind = "binding"
+
+    def __init__(self, soundfont, sample_rate: int, gain: float = 0.2):
+        """
+        A FluidSynth synthesizer in this process that keeps its soundfont loaded for as long as it lives.
+        Only one render can use it at a time, SynthPool makes sure of that
+
+        :param soundfont (str): The path to the .sf2 file, or a tuple of them for a synth whose channels are bound
+            to different soundfonts (see render)
+        :param sample_rate (int):
+        :param gain (float): The fluidsynth command line's default, so both backends sound the same
+        """
+        fluidsynth = load_binding()
+        if fluidsynth is None:
+            raise RuntimeError("The FluidSynth binding is not available")
+        self._fluidsynth = fluidsynth
+        self.soundfont = soundfont
+        self.sample_rate = sample_rate
+
+        # the player follows the samples we pull instead of the wall clock, so a render runs as fast as the CPU allows.
+        # render resets the synth itself, the player doing it too would undo the channels render binds
+        self._synth = fluidsynth.Synth(gain=gain, samplerate=float(sample_rate),
+                                       **{"player.timing-source": "sample", "player.reset-synth": 0})
+        self._soundfont_ids = {}
+        for path in ((soundfont,) if isinstance(soundfont, str) else soundfont):
+            soundfont_id = self._synth.sfload(path)
+            if soundfont_id == fluidsynth.FLUID_FAILED:
+                self._synth.delete()
+                raise RuntimeError(f"FluidSynth could not load {path}")
+            self._soundfont_ids[path] = soundfont_id
+        self.renders = 0
+        self.created_at = time.time()
+
+    def _bind(self, channel: int, soundfont: str, program: int) -> None:
+        """
+        Plays the channel with a preset of the soundfont, its first preset when it has no such program. The drum
+        channel looks in the percussion bank (128) first, drum kit soundfonts keep their kits there or in bank 0
+        """
+        soundfont_id = self._soundfont_ids[soundfont]
+        banks = (128, 0) if channel == DRUM_CHANNEL else (0,)
+        presets = (program, 0) if program != 0 else (0,)
+        for preset in presets:
+            for bank in banks:
+                if self._synth.program_select(channel, soundfont_id, bank, preset) != self._fluidsynth.FLUID_FAILED:
+                    return
+
+    def render(self, midi_path: str, chunk_size: int = 64 * 1024, frames_per_block: int = 1024,
+               programs: dict = None) -> Iterator[bytes]:
+        """
+        Plays the midi file through the synth and yields 16 bit stereo PCM until the player is done
+
+        :param programs (dict): {channel: (soundfont, program)}, binds every channel to a preset of one of the
+            synth's soundfonts. The midi should not change programs itself, that would pick presets from any of them
+        """
+        fluidsynth = self._fluidsynth
+
+        # whatever the previous render left sounding (i.e: it was cut short) is silenced first
+        self._synth.system_reset()
+        for channel, (soundfont, program) in (programs or {}).items():
+            self._bind(channel, soundfont, program)
+        player = fluidsynth.new_fluid_player(self._synth.synth)
+        if not player:
+            raise RuntimeError("FluidSynth could not create a player")
+        try:
+            if fluidsynth.fluid_player_add(player, midi_path.encode()) == fluidsynth.FLUID_FAILED \
+                    or fluidsynth.fluid_player_play(player) == fluidsynth.FLUID_FAILED:
+                raise RuntimeError(f"FluidSynth could not play {midi_path}")
+
+            buffer = bytearray()
+            while fluidsynth.fluid_player_get_status(player) == fluidsynth.FLUID_PLAYER_PLAYING:
+                buffer += self._synth.get_samples(frames_per_block).tobytes()
+                if len(buffer) >= chunk_size:
+                    yield bytes(buffer)
+                    buffer.clear()
+            if buffer:
+                yield bytes(buffer)
+        finally:
+            fluidsynth.fluid_player_stop(player)
+            fluidsynth.delete_fluid_player(player)
+        self.renders += 1
+
+    def healthy(self) -> bool:
+        """ The synth still produces samples """
+        try:
+            return len(self._synth.get_samples(64)) == 128
+        except Exception:
+            return False
+
+    def close(self) -> None:
+        self._synth.delete()
+
+
+class ProcessSynth:
+    kind = "process"
+
+    def __init__(self, soundfont: str, sample_rate: int):
+        """ The fluidsynth command line, started for every render so nothing stays loaded. The fallback backend """
+        self.soundfont = soundfont
+        self.sample_rate = sample_rate
+        self.renders = 0
+
+    def render(self, midi_path: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        """ Yields FluidSynth's raw PCM as it is synthesized, read from its stdout """
+        process = None
+        try:
+            process = subprocess.Popen(
+                ["fluidsynth", "-ni", "-q", "-T", "raw", "-O", "s16", "-F", "-", "-r", str(self.sample_rate), self.soundfont, midi_path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+            while True:
+                chunk = process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+            if process.wait() != 0:
+                raise RuntimeError(f"FluidSynth exited with code {process.returncode} while rendering with {self.soundfont}")
+        finally:
+            # the consumer can stop early (i.e: the client disconnected), don't leave FluidSynth running
+            if process is not None and process.poll() is None:
+                process.kill()
+                process.wait()
+            if process is not None:
+                process.stdout.close()
+        self.renders += 1
+
+    def healthy(self) -> bool:
+        return shutil.which("fluidsynth") is not None and os.path.exists(self.soundfont)
+
+    def close(self) -> None:
+        pass
+
+
+class SynthPool:
+    def __init__(self, backend: str = "binding", instances_per_soundfont: int = 1, acquire_timeout: float = 0.0,
+                 health_check_interval: float = 60.0):
+        """
+        Hands renders to idle long-lived synths, up to instances_per_soundfont of them per soundfont and sample rate.
+        A synth that fails a render or a health check is closed and replaced in the background. When every synth of
+        a soundfont stays busy for acquire_timeout seconds the render runs on the command line instead of waiting.
+        Every process has its own pool, see render_helper.configure_synth_pool
+
+        :param backend (str): One of SYNTH_BACKENDS, "binding" keeps synths alive when pyfluidsynth can be loaded
+            (and falls back to the command line when it can't), "process" always runs the command line
+        :param instances_per_soundfont (int): How many synths of the same soundfont can render at once
+        :param acquire_timeout (float): Seconds a render waits for a busy synth, None waits as long as it takes
+        :param health_check_interval (float): Seconds between two checks of the idle synths, 0 turns the checks off
+        """
+        if backend not in SYNTH_BACKENDS:
+            raise ValueError(f"Unknown synth backend: {backend}, expected one of {SYNTH_BACKENDS}")
+        self.backend = backend
+        self.instances_per_soundfont = max(instances_per_soundfont, 1)
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = {}
+        self._counts = {}
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._health_thread = None
+
+        self.renders = 0
+        self.fallbacks = 0
+        self.failures = 0
+        self.restarts = 0
+
+    def persistent(self) -> bool:
+        """ Whether synths are kept alive, False when the backend is "process" or the binding is missing """
+        return self.backend != "process" and load_binding() is not None
+
+    def available(self, soundfont: str) -> bool:
+        """ Whether a render with the soundfont can start at all: the file is there and so is a synth to play it """
+        return os.path.isfile(soundfont) and (self.persistent() or shutil.which("fluidsynth") is not None)
+
+    def _create(self, key: tuple) -> BindingSynth:
+        """ Only called after reserving the synth in _counts, the reservation is undone when it fails to start """
+        try:
+            return BindingSynth(*key)
+        except Exception:
+            with self._condition:
+                self._counts[key] -= 1
+                self._condition.notify_all()
+            raise
+
+    def _acquire(self, key: tuple, wait: bool = False):
+        """ An idle synth, a new one while under the limit, or None once acquire_timeout runs out (unless told to wait) """
+        deadline = None if wait or self.acquire_timeout is None else time.monotonic() + self.acquire_timeout
+        with self._condition:
+            while True:
+                idle = self._idle.setdefault(key, deque())
+                if idle:
+                    return idle.pop()
+                if self._counts.get(key, 0) < self.instances_per_soundfont:
+                    self._counts[key] = self._counts.get(key, 0) + 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+        self._start_health_checks()
+        return self._create(key)
+
+    def _release(self, key: tuple, synth, failed: bool) -> None:
+        if failed:
+            self._replace(key, synth)
+            return
+        if self._stopped.is_set():
+            synth.close()
+            return
+        with self._condition:
+            self._idle.setdefault(key, deque()).append(synth)
+            self._condition.notify()
+
+    def _replace(self, key: tuple, synth) -> None:
+        """ Closes a broken synth and starts its replacement on a thread, so no request waits on the soundfont load """
+        try:
+            synth.close()
+        except Exception as e:
+            print(f"Failed to close a synth of {key[0]} with error: {e}")
+        with self._condition:
+            self._counts[key] -= 1
+            self.restarts += 1
+            self._condition.notify_all()
+        if not self._stopped.is_set():
+            threading.Thread(target=self.preload, args=([key[0]], key[1]), name="synth-restart", daemon=True).start()
+
+    def preload(self, soundfonts: List[str], sample_rate: int = 44100) -> None:
+        """ Starts every synth the soundfonts can have ahead of time, so no render pays for loading one """
+        if not self.persistent():
+            return
+        for soundfont in soundfonts:
+            key = (soundfont, sample_rate)
+            while True:
+                with self._condition:
+                    if self._counts.get(key, 0) >= self.instances_per_soundfont:
+                        break
+                    self._counts[key] = self._counts.get(key, 0) + 1
+                try:
+                    synth = self._create(key)
+                except Exception as e:
+                    self.failures += 1
+                    print(f"Failed to start a synth for {soundfont} with error: {e}")
+                    break
+                self._release(key, synth, failed=False)
+        self._start_health_checks()
+
+    def render(self, midi_path: str, soundfont, sample_rate: int = 44100, chunk_size: int = 64 * 1024,
+               programs: dict = None) -> Iterator[bytes]:
+        """
+        Renders the midi file with the soundfont on an idle synth and yields 16 bit stereo PCM chunks
+
+        :param midi_path (str): The midi file to render
+        :param soundfont (str): The path to the .sf2 file, or a tuple of them when programs binds channels to them
+        :param sample_rate (int):
+        :param chunk_size (int): Roughly how many bytes are yielded at a time
+        :param programs (dict): {channel: (soundfont, program)}, see BindingSynth.render. Only the binding can do this,
+            so such a render waits for a synth instead of falling back to the command line
+        :return (Iterator[bytes]):
+        """
+        key = (soundfont, sample_rate)
+        synth = None
+        if programs is not None:
+            if not self.persistent():
+                raise RuntimeError("Binding soundfonts to channels needs the FluidSynth binding")
+            try:
+                synth = self._acquire(key, wait=True)
+            except Exception:
+                self.failures += 1
+                raise
+        elif self.persistent():
+            try:
+                synth = self._acquire(key)
+            except Exception as e:
+                self.failures += 1
+                print(f"Could not start a synth for {soundfont}, rendering with the command line instead: {e}")
+            if synth is None:
+                self.fallbacks += 1
+
+        if synth is None:
+            yield from ProcessSynth(soundfont, sample_rate).render(midi_path, chunk_size)
+            self.renders += 1
+            return
+
+        failed = True
+        try:
+            yield from synth.render(midi_path, chunk_size, programs=programs)
+            failed = False
+        except GeneratorExit:
+            # the consumer stopped early, the synth itself is fine and gets reset by its next render
+            failed = False
+            raise
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self._release(key, synth, failed)
+        self.renders += 1
+
+    def _start_health_checks(self) -> None:
+        with self._condition:
+            if self._health_thread is not None or self.health_check_interval <= 0:
+                return
+            self._health_thread = threading.Thread(target=self._check_health, name="synth-health", daemon=True)
+        self._health_thread.start()
+
+    def _check_health(self) -> None:
+        """ Takes the idle synths out one soundfont at a time, so no render gets one while it is being checked """
+        while not self._stopped.wait(self.health_check_interval):
+            with self._condition:
+                keys = list(self._idle.keys())
+            for key in keys:
+                with self._condition:
+                    synths = list(self._idle[key])
+                    self._idle[key].clear()
+                for synth in synths:
+                    if synth.healthy():
+                        self._release(key, synth, failed=False)
+                    else:
+                        print(f"A synth of {key[0]} failed its health check, restarting it")
+                        self._replace(key, synth)
+
+    def stats(self) -> dict:
+        with self._condition:
+            synths = {
+                f"{soundfont if isinstance(soundfont, str) else '+'.join(soundfont)}@{sample_rate}": {
+                    "instances": count, "idle": len(self._idle.get((soundfont, sample_rate), ()))
+                }
+                for (soundfont, sample_rate), count in self._counts.items()
+            }
+        return {
+            "backend": "binding" if self.persistent() else "process",
+            "synths": synths,
+            "renders": self.renders,
+            "fallbacks": self.fallbacks,
+            "failures": self.failures,
+            "restarts": self.restarts
+        }
+
+    def close(self) -> None:
+        self._stopped.set()
+        with self._condition:
+            synths = [synth for idle in self._idle.values() for synth in idle]
+            self._idle.clear()
+            self._counts.clear()
+        for synth in synths:
+            synth.close()
@@ -0,0 +1,64 @@
+import math
+import numpy as np
+import tensorflow.keras as keras
+
+
+class CorpusSequence(keras.utils.Sequence):
+    def __init__(self, corpus: np.ndarray, sequence_length: int, vocabulary_size: int, batch_size: int = 64,
+                 one_hot: bool = True, shuffle: bool = True, seed: int = None):
+        """
+        Feeds training batches straight from the int corpus (usually memory mapped, see corpus.load_corpus) instead
+        of materializing every window up front. A window is just its start offset into the corpus, a batch gathers
+        its windows and one-hot encodes them on the spot, so memory is O(batch_size) no matter how big the corpus is
+
+        :param corpus (np.ndarray): The int corpus, songs separated by delimiters like the single file dataset
+        :param sequence_length (int): The length of the "sliding window" the model sees
+        :param vocabulary_size (int): The size of the mapping, the width of the one-hot encoding
+        :param batch_size (int): Windows per batch
+        :param one_hot (bool): One-hot encode the inputs, False hands out the ints (for models with an embedding)
+        :param shuffle (bool): Visit the windows in a new random order every epoch, like model.fit does on arrays. The
+            order is a random stride through the windows rather than a full permutation, so it needs no index array
+        :param seed (int): Seeds the shuffling
+        """
+        super().__init__()
+        self.corpus = corpus
+        self.sequence_length = sequence_length
+        self.vocabulary_size = vocabulary_size
+        self.batch_size = batch_size
+        self.one_hot = one_hot
+        self.shuffle = shuffle
+
+        self.num_sequences = max(len(corpus) - sequence_length, 0)
+        self._offsets = np.arange(sequence_length, dtype=np.int64)
+        self._rng = np.random.default_rng(seed)
+        # the epoch's order is the permutation i -> (i * stride + shift) % num_sequences, a stride coprime with
+        # num_sequences visits every window once and a batch works its starts out on its own, nothing O(corpus) is kept
+        self._stride = 1
+        self._shift = 0
+        self.on_epoch_end()
+
+    def __len__(self) -> int:
+        return math.ceil(self.num_sequences / self.batch_size)
+
+    def __getitem__(self, index: int):
+        positions = np.arange(index * self.batch_size, min((index + 1) * self.batch_size, self.num_sequences), dtype=np.int64)
+        # sorted reads walk the memory map forwards, the order within a batch doesn't matter for training
+        starts = np.sort((positions * self._stride + self._shift) % max(self.num_sequences, 1))
+
+        inputs = np.asarray(self.corpus[starts[:, None] + self._offsets], dtype=np.int64)
+        targets = np.asarray(self.corpus[starts + self.sequence_length], dtype=np.int64)
+        if self.one_hot:
+            encoded = np.zeros(inputs.shape + (self.vocabulary_size,), dtype=np.float32)
+            np.put_along_axis(encoded, inputs[..., None], 1.0, axis=-1)
+            inputs = encoded
+        return inputs, targets
+
+    def on_epoch_end(self) -> None:
+        """ Draws the next epoch's order, a new random stride and shift """
+        if not self.shuffle or self.num_sequences < 2:
+            return
+        stride = int(self._rng.integers(1, self.num_sequences))
+        while math.gcd(stride, self.num_sequences) != 1:
+            stride = int(self._rng.integers(1, self.num_sequences))
+        self._stride = stride
+        self._shift = int(self._rng.integers(0, self.num_sequences))
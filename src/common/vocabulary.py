@@ -0,0 +1,71 @@
+import numpy as np
+from typing import List
+from file_helper import FileHelper
+
+
+class Vocabulary:
+    def __init__(self, mappings: dict):
+        """
+        A compact two way view of a song_mappings.json file, built once per model.
+        Symbols are looked up through a dict and ints through an array, so neither direction has to scan the mappings
+
+        :param mappings (dict): symbol -> int, i.e: {"60": 0, "_": 1, "/": 2}
+        """
+        self.symbol_to_int = dict(mappings)
+
+        size = max(self.symbol_to_int.values()) + 1 if self.symbol_to_int else 0
+        self.int_to_symbol = np.empty(size, dtype=object)
+        for symbol, index in self.symbol_to_int.items():
+            self.int_to_symbol[index] = symbol
+
+        # one-hot vectors are rows of this matrix, so encoding a sequence is a single fancy index
+        self._identity = np.eye(size, dtype=np.float32)
+
+    @classmethod
+    def from_json(cls, mapping_path: str, file_helper: FileHelper):
+        return cls(file_helper.loadJSON(mapping_path))
+
+    def __len__(self) -> int:
+        return len(self.int_to_symbol)
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self.symbol_to_int
+
+    def symbols(self) -> List[str]:
+        return list(self.symbol_to_int.keys())
+
+    def encode(self, symbols: List[str]) -> List[int]:
+        return [self.symbol_to_int[symbol] for symbol in symbols]
+
+    def decode(self, index: int) -> str:
+        return self.int_to_symbol[index]
+
+    def one_hot(self, ints: List[int]) -> np.ndarray:
+        """
+        :param ints (List[int]): A sequence of mapped symbols
+        :return (np.ndarray): float32 array of shape (1, len(ints), vocabulary size), ready to feed to the model
+        """
+        return self._identity[ints][np.newaxis, ...]
+
+    def ids(self, ints: List[int]) -> np.ndarray:
+        """
+        The input of models that embed the symbols themselves, see MelodyGenerator.token_input
+
+        :param ints (List[int]): A sequence of mapped symbols
+        :return (np.ndarray): int32 array of shape (1, len(ints))
+        """
+        return np.asarray(ints, dtype=np.int32)[np.newaxis, ...]
+
+    def ids_batch(self, rows: List[List[int]]) -> np.ndarray:
+        """
+        :param rows (List[List[int]]): Sequences of mapped symbols that all have the same length
+        :return (np.ndarray): int32 array of shape (len(rows), sequence length)
+        """
+        return np.asarray(rows, dtype=np.int32)
+
+    def one_hot_batch(self, rows: List[List[int]]) -> np.ndarray:
+        """
+        :param rows (List[List[int]]): Sequences of mapped symbols that all have the same length
+        :return (np.ndarray): float32 array of shape (len(rows), sequence length, vocabulary size)
+        """
+        return self._identity[np.asarray(rows)]
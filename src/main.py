@@ -1,26 +1,133 @@
 import sys
 sys.path.insert(0, "./common/")
 
-import os
+import io
 import uuid
-from typing import Optional
-from fastapi import Body, Request, FastAPI, HTTPException
+import time
+import random
+import asyncio
+import zipfile
+import threading
+from typing import List, Optional
+from fastapi import Request, FastAPI, HTTPException
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from melody_generator import MelodyGenerator
+from model_registry import ModelRegistry
+from execution_layer import ExecutionLayer, ExecutorSaturatedError
+from render_helper import melody_to_midi, stream_audio, render_melody_audio, render_wav, complete_wav_header, validate_soundfont
+from render_helper import render_arrangement_audio, configure_synth_pool, get_synth_pool, preload_synths, synth_available
+from midi_writer import arrangement_to_midi, arrangement_channels
+from render_cache import RenderCache
+from sample_pool import SamplePool
+from artifact_store import create_artifact_store
+from audio_encoder import encode_pcm
+from audio_encoder import AUDIO_FORMATS, instrument_formats, is_format_available
+from metrics import REGISTRY, CONTENT_TYPE
 from file_helper import FileHelper
-from api_helper import determine_seed, delete_files, determine_metaparameters
-from music_helper import MusicHelper
-from fastapi.responses import FileResponse
-from midi2audio import FluidSynth
+from api_helper import EMOTIONS, determine_seed, determine_metaparameters, load_seed_symbols
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask, BackgroundTasks
 from decouple import config
 
 # init our API, helpers, and constants
+# tensorflow is only imported when the first model loads (see ModelRegistry), music21 only by the training tools
 app = FastAPI()
 file_helper = FileHelper()
-music_helper = MusicHelper(file_helper)
 model_paths = file_helper.loadJSON("./model_info.json")
 debug_mode = int(config('SYMPHONY_DEBUG'))
+max_samples_per_request = config('SYMPHONY_MAX_SAMPLES', default=8, cast=int)
+# an arrangement gets a midi channel per track, channel 10 (9 counting from 0) is left to the drum tracks
+max_tracks_per_arrangement = min(config('SYMPHONY_MAX_TRACKS', default=8, cast=int), 15)
+tmp_dir = config('SYMPHONY_TMP_DIR', default="") or None
+midi_writer = config('SYMPHONY_MIDI_WRITER', default="direct")
+# /getSample reports how long each stage took in a Server-Timing header, see benchmarks/serving.py
+server_timing = bool(config('SYMPHONY_SERVER_TIMING', default=1, cast=int))
+
+# requests with an rng_seed are deterministic, their audio is cached on disk and replayed without TF or FluidSynth
+render_cache_mb = config('SYMPHONY_RENDER_CACHE_MB', default=512, cast=int)
+render_cache = RenderCache(
+    config('SYMPHONY_RENDER_CACHE_DIR', default="./cache/renders"),
+    max_bytes=render_cache_mb * 1024 * 1024
+) if render_cache_mb > 0 else None
+
+# models stay loaded between requests, see ModelRegistry for the eviction/reload rules
+model_registry = ModelRegistry(
+    model_paths,
+    file_helper,
+    sequence_length=64,
+    max_models=config('SYMPHONY_MAX_MODELS', default=4, cast=int),
+    max_bytes=config('SYMPHONY_MAX_MODEL_MB', default=0, cast=int) * 1024 * 1024,
+    hot_reload=bool(config('SYMPHONY_HOT_RELOAD', default=0, cast=int)),
+    max_batch_size=config('SYMPHONY_BATCH_MAX_SIZE', default=16, cast=int),
+    max_batch_wait=config('SYMPHONY_BATCH_MAX_WAIT_MS', default=2, cast=float) / 1000
+)
+
+# FluidSynth instances stay alive with their soundfont loaded, every process (this one streams /getSample, the render
+# workers do the rest) gets its own synths, see SynthPool
+synth_settings = (
+    config('SYMPHONY_SYNTH_BACKEND', default="binding"),
+    config('SYMPHONY_SYNTH_INSTANCES', default=1, cast=int),
+    config('SYMPHONY_SYNTH_WAIT_MS', default=0, cast=float) / 1000,
+    config('SYMPHONY_SYNTH_HEALTH_CHECK', default=60, cast=float)
+)
+configure_synth_pool(*synth_settings)
+
+# generation runs on a thread pool and midi/audio rendering on a process pool, so the event loop stays free
+execution_layer = ExecutionLayer(
+    inference_workers=config('SYMPHONY_INFERENCE_WORKERS', default=16, cast=int),
+    render_workers=config('SYMPHONY_RENDER_WORKERS', default=0, cast=int),
+    inference_queue=config('SYMPHONY_INFERENCE_QUEUE', default=32, cast=int),
+    render_queue=config('SYMPHONY_RENDER_QUEUE', default=32, cast=int),
+    render_processes=bool(config('SYMPHONY_RENDER_PROCESSES', default=1, cast=int)),
+    render_initializer=configure_synth_pool,
+    render_initargs=synth_settings
+)
+
+# the files a request hands to FluidSynth live here until its response has been sent
+artifact_backend = config('SYMPHONY_ARTIFACT_STORE', default="disk")
+artifact_options = {
+    "ttl": config('SYMPHONY_ARTIFACT_TTL', default=600, cast=float),
+    "max_bytes": config('SYMPHONY_ARTIFACT_MAX_MB', default=256, cast=int) * 1024 * 1024
+}
+if artifact_backend == "disk":
+    artifact_options["directory"] = config('SYMPHONY_ARTIFACT_DIR', default="") or None
+artifact_store = create_artifact_store(artifact_backend, **artifact_options)
+
+# what the startup warm-up found, /ready answers 503 until it is done and when anything it checked failed
+warmup_steps = config('SYMPHONY_WARMUP_STEPS', default=8, cast=int)
+readiness = {"ready": False, "done": False, "seconds": None, "instruments": {}, "failed": []}
+
+# optionally keep a few ready clips per instrument/emotion so /getSample doesn't have to generate inline
+pool_size = config('SYMPHONY_POOL_SIZE', default=0, cast=int)
+sample_pool = None
+
+# what /metrics reports, the gauges and totals other components already track are read when scraped (see collect_metrics)
+REQUESTS = REGISTRY.counter("symphony_requests_total", "Sample requests by how they were served",
+                            ["endpoint", "instrument", "emotion", "format", "outcome"])
+STAGE_SECONDS = REGISTRY.histogram("symphony_stage_seconds", "Duration of every stage of a sample", ["stage", "instrument", "emotion"])
+SAMPLE_STEPS = REGISTRY.histogram("symphony_sample_steps", "Symbols generated per sample", ["instrument", "emotion"],
+                                  buckets=(8, 16, 32, 64, 128, 256, 512, 1024))
+SAMPLE_TEMPERATURE = REGISTRY.histogram("symphony_sample_temperature", "Temperature every sample was generated with",
+                                        ["instrument", "emotion"], buckets=(0.25, 0.5, 0.75, 1.0, 1.25, 1.5, 2.0))
+QUEUE_DEPTH = REGISTRY.gauge("symphony_queue_depth", "Tasks running or waiting on a pool", ["pool"])
+REJECTED = REGISTRY.counter("symphony_rejected_total", "Tasks turned away because a pool was saturated", ["pool"])
+BATCH_QUEUE_DEPTH = REGISTRY.gauge("symphony_batch_queue_depth", "Generation steps waiting to be batched", ["model"])
+MODEL_LOOKUPS = REGISTRY.counter("symphony_model_lookups_total", "Model registry lookups", ["result"])
+RENDER_CACHE_LOOKUPS = REGISTRY.counter("symphony_render_cache_lookups_total", "Render cache lookups", ["result"])
+RENDER_CACHE_BYTES = REGISTRY.gauge("symphony_render_cache_bytes", "Size of the render cache")
+SAMPLE_POOL_DEPTH = REGISTRY.gauge("symphony_sample_pool_depth", "Ready clips in the sample pool", ["instrument", "emotion"])
+SAMPLE_POOL_REFILLS = REGISTRY.counter("symphony_sample_pool_refills_total",
+                                       "Clips the sample pool made, failed to make or put off while the pools were busy", ["result"])
+SAMPLE_POOL_REFILL_RATE = REGISTRY.gauge("symphony_sample_pool_refill_rate", "Clips the sample pool made per second lately")
+DEFERRED = REGISTRY.counter("symphony_deferred_total", "Background tasks put off because a pool was busy", ["pool"])
+ARTIFACTS = REGISTRY.gauge("symphony_artifacts", "Request artifacts alive in the artifact store")
+SYNTHS = REGISTRY.gauge("symphony_synths", "FluidSynth instances of the API process", ["state"])
+SYNTH_EVENTS = REGISTRY.counter("symphony_synth_events_total", "Renders, fallbacks, failures and restarts of the API process's synths",
+                                ["event"])
+
+def emotion_label(emotion: str) -> str:
+    """ The emotion label of a metric, anything outside EMOTIONS shares "other" so a label can't grow without bound """
+    return emotion if emotion in EMOTIONS else "other"
 
 # add our app middleware
 origins = [
@@ -43,12 +150,355 @@ app.add_middleware(
 class SampleRequest(BaseModel):
     instrument_name: str
     emotion: str
+    format: str = "wav"
+    rng_seed: Optional[int] = None
+
+class SamplesRequest(BaseModel):
+    instrument_name: str
+    emotion: str
+    count: int = 4
+    format: str = "wav"
+    rng_seed: Optional[int] = None
+
+class ArrangementRequest(BaseModel):
+    instruments: List[str]
+    emotion: str
+    format: str = "wav"
+    rng_seed: Optional[int] = None
+
+def warm_up():
+    """
+    Runs on a thread at startup: parses every mapping, checks every soundfont, then for the instruments listed in
+    SYMPHONY_PRELOAD_MODELS (comma separated or "all") starts the synths of their soundfonts in every process, loads
+    their models and warms each one up with a dummy generation of SYMPHONY_WARMUP_STEPS steps. The outcome for every instrument is what /ready reports
+    """
+    start = time.perf_counter()
+    instruments = {}
+    workers = "ok"
+    for name, info in model_paths.items():
+        status = instruments[name] = {}
+        try:
+            load_seed_symbols(info['mapping_path'], file_helper)
+            status["mapping"] = "ok"
+        except Exception as e:
+            status["mapping"] = str(e)
+        try:
+            validate_soundfont(info['soundfont'])
+            status["soundfont"] = "ok"
+        except (OSError, ValueError) as e:
+            status["soundfont"] = str(e)
+        if status["soundfont"] != "ok":
+            print(f"Soundfont of {name} failed validation: {status['soundfont']}")
+
+    preload = config('SYMPHONY_PRELOAD_MODELS', default="")
+    if preload.strip() == "all":
+        names = list(model_paths.keys())
+    else:
+        names = [name.strip() for name in preload.split(",") if name.strip()]
+    # spawned render workers start on their first task, start them all now instead of during the first requests and
+    # have every process load the synths of the preloaded instruments
+    soundfonts = sorted({model_paths[name]['soundfont'] for name in names
+                         if name in instruments and instruments[name]["soundfont"] == "ok"})
+    get_synth_pool().preload(soundfonts)
+    try:
+        execution_layer.render.warm_up(preload_synths, soundfonts, count=execution_layer.render_workers)
+    except Exception as e:
+        workers = str(e)
+        print(f"Failed to warm up the render workers with error: {e}")
+
+    # the render cache keys include the hashes of the model and soundfont files, hash them before the first request
+    if render_cache is not None:
+        render_cache.preload_digests(sorted({path for info in model_paths.values() for path in (info['model_path'], info['soundfont'])}))
+
+    errors = model_registry.preload(names, warm_up_steps=warmup_steps)
+    for name in names:
+        if name in instruments:
+            instruments[name]["model"] = errors.get(name, "ok")
+
+    # every component that did not come up, i.e: "FolkLSTM.soundfont"
+    failed = [f"{name}.{component}" for name, status in instruments.items()
+              for component, outcome in status.items() if outcome != "ok"]
+    if workers != "ok":
+        failed.append("render_workers")
+
+    readiness["instruments"] = instruments
+    readiness["render_workers"] = workers
+    readiness["failed"] = failed
+    readiness["seconds"] = round(time.perf_counter() - start, 3)
+    readiness["done"] = True
+    readiness["ready"] = not failed
+    if failed:
+        print(f"Warm-up finished in {readiness['seconds']}s, not ready because of: {', '.join(failed)}")
+    else:
+        print(f"Warm-up finished in {readiness['seconds']}s")
+
+@app.on_event("startup")
+def start_warm_up():
+    """ The warm-up runs in the background, /ping answers right away and /ready once the models are warm """
+    threading.Thread(target=warm_up, name="symphony-warmup", daemon=True).start()
+
+@app.on_event("startup")
+def start_sample_pool():
+    """ Starts refilling the sample pool for the instruments in SYMPHONY_POOL_INSTRUMENTS (comma separated or "all") """
+    global sample_pool
+    if pool_size <= 0:
+        return
+
+    instruments = config('SYMPHONY_POOL_INSTRUMENTS', default="all")
+    if instruments.strip() == "all":
+        names = list(model_paths.keys())
+    else:
+        names = [name.strip() for name in instruments.split(",") if name.strip() in model_paths]
+
+    sample_pool = SamplePool(
+        produce_pooled_sample,
+        [(name, emotion) for name in names for emotion in EMOTIONS],
+        high_watermark=pool_size,
+        low_watermark=config('SYMPHONY_POOL_LOW_WATERMARK', default=max(1, pool_size // 2), cast=int),
+        workers=config('SYMPHONY_POOL_WORKERS', default=1, cast=int)
+    )
+    sample_pool.start()
+
+@app.on_event("shutdown")
+def shutdown_workers():
+    if sample_pool is not None:
+        sample_pool.stop()
+    execution_layer.shutdown()
+    artifact_store.close()
+    get_synth_pool().close()
+
+def resolve_format(instrument_name: str, audio_format: str) -> dict:
+    """ Checks the instrument can be served in the requested format and returns that format's settings """
+    formats = instrument_formats(model_paths[instrument_name])
+    if audio_format not in formats:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(formats)}")
+    if not is_format_available(audio_format):
+        raise HTTPException(status_code=400, detail=f"The {audio_format} encoder is not available on this server")
+    return formats[audio_format]
+
+def sample_parameters(instrument_name: str, emotion: str, rng_seed: int = None):
+    """ The seed and metaparameters of one sample, the same rng_seed always gives the same ones """
+    rng = random.Random(rng_seed) if rng_seed is not None else random
+    seed = determine_seed(model_paths[instrument_name]['mapping_path'], file_helper, rng)
+    num_steps, max_seq_len, temperature = determine_metaparameters(emotion, rng)
+    return seed, num_steps, max_seq_len, temperature
+
+def render_cache_key(instrument_name: str, emotion: str, parameters: tuple, rng_seed: int, audio_format: str, bitrate: str):
+    """ The render cache entry of a seeded sample, None when the cache is off or the model files can't be read """
+    if render_cache is None:
+        return None
+
+    info = model_paths[instrument_name]
+    seed, num_steps, max_seq_len, temperature = parameters
+    try:
+        return render_cache.key(instrument_name, info['model_path'], info['soundfont'], {
+            "emotion": emotion,
+            "seed": seed,
+            "num_steps": num_steps,
+            "max_seq_len": max_seq_len,
+            "temperature": temperature,
+            "rng_seed": rng_seed,
+            "inference_backend": info.get('inference_backend', "function"),
+            "format": audio_format,
+            "bitrate": bitrate
+        })
+    except OSError as e:
+        print(f"Not caching {instrument_name}: {e}")
+        return None
+
+def generate_sample_melody(instrument_name: str, emotion: str, rng_seed: int = None, parameters: tuple = None,
+                           timings: dict = None):
+    """
+    Runs on the inference pool: grabs the model, creates the seed and generates the melody.
+    When given, timings gets the duration of every stage in ms and the number of generated steps
+    """
+    start = time.perf_counter()
+
+    # Grab our model, it is only loaded from disk the first time it is used. The lease keeps it open until the melody is
+    # done, even when another request evicts it meanwhile
+    with model_registry.lease(instrument_name) as melody_generator:
+        model_done = time.perf_counter()
+
+        if parameters is None:
+            parameters = sample_parameters(instrument_name, emotion, rng_seed)
+        seed, num_steps, max_seq_len, temperature = parameters
+        seed_done = time.perf_counter()
+
+        if debug_mode != 0:
+            print(f"The seed is: {seed}")
+
+        # Generate our melody from a seed
+        melody = melody_generator.generate_melody(
+            list(seed),
+            num_steps,
+            max_seq_len,
+            temperature,
+            rng_seed=rng_seed
+        )
+
+        generate_done = time.perf_counter()
+    steps = len(melody) - len(seed)
+    STAGE_SECONDS.observe(model_done - start, stage="model", instrument=instrument_name, emotion=emotion_label(emotion))
+    STAGE_SECONDS.observe(seed_done - model_done, stage="seed", instrument=instrument_name, emotion=emotion_label(emotion))
+    STAGE_SECONDS.observe(generate_done - seed_done, stage="generate", instrument=instrument_name, emotion=emotion_label(emotion))
+    SAMPLE_STEPS.observe(steps, instrument=instrument_name, emotion=emotion_label(emotion))
+    SAMPLE_TEMPERATURE.observe(temperature, instrument=instrument_name, emotion=emotion_label(emotion))
+
+    if timings is not None:
+        timings["model"] = (model_done - start) * 1000
+        timings["seed"] = (seed_done - model_done) * 1000
+        timings["generate"] = (generate_done - seed_done) * 1000
+        timings["steps"] = steps
+    return melody
+
+def generate_sample_midi(instrument_name: str, emotion: str, rng_seed: int = None, parameters: tuple = None,
+                         timings: dict = None) -> bytes:
+    """
+    Runs on the inference pool: generate_sample_melody followed by its midi, writing it takes about a millisecond
+    so it is not worth a trip to the render pool
+    """
+    melody = generate_sample_melody(instrument_name, emotion, rng_seed, parameters, timings)
+
+    midi_start = time.perf_counter()
+    midi_bytes = melody_to_midi(melody, emotion, writer=midi_writer)
+    midi_time = time.perf_counter() - midi_start
+    STAGE_SECONDS.observe(midi_time, stage="midi", instrument=instrument_name, emotion=emotion_label(emotion))
+    if timings is not None:
+        timings["midi"] = midi_time * 1000
+    return midi_bytes
+
+def held_stream(chunks, reservation):
+    """ Passes the audio through, giving back the render pool slot it was counted against once it is done or cut short """
+    try:
+        yield from chunks
+    finally:
+        reservation.release(completed=True)
+
+def timed_stream(chunks, instrument_name: str, emotion: str, request_start: float):
+    """ Passes the audio through, recording how long rendering/sending it took and the request's total time """
+    start = time.perf_counter()
+    try:
+        yield from chunks
+    finally:
+        end = time.perf_counter()
+        STAGE_SECONDS.observe(end - start, stage="render", instrument=instrument_name, emotion=emotion_label(emotion))
+        STAGE_SECONDS.observe(end - request_start, stage="request", instrument=instrument_name, emotion=emotion_label(emotion))
+
+def collect_metrics() -> None:
+    """ Copies the queue depths and the totals the pools, caches and registry keep themselves into the metrics """
+    for pool_name, pool_stats in execution_layer.stats().items():
+        QUEUE_DEPTH.set(pool_stats["pending"], pool=pool_name)
+        REJECTED.set_total(pool_stats["rejected"], pool=pool_name)
+        DEFERRED.set_total(pool_stats["deferred"], pool=pool_name)
+
+    registry_stats = model_registry.stats()
+    MODEL_LOOKUPS.set_total(registry_stats["hits"], result="hit")
+    MODEL_LOOKUPS.set_total(registry_stats["misses"], result="miss")
+    for name, model_stats in registry_stats["resident"].items():
+        BATCH_QUEUE_DEPTH.set(model_stats["batching"].get("queue_depth", 0), model=name)
+
+    if render_cache is not None:
+        cache_stats = render_cache.stats()
+        RENDER_CACHE_LOOKUPS.set_total(cache_stats["hits"], result="hit")
+        RENDER_CACHE_LOOKUPS.set_total(cache_stats["misses"], result="miss")
+        RENDER_CACHE_BYTES.set(cache_stats["size_bytes"])
+
+    if sample_pool is not None:
+        pool_stats = sample_pool.stats()
+        refills = {"produced": 0, "failed": 0, "deferred": 0}
+        for instrument_name, emotions in pool_stats["pairs"].items():
+            for emotion, pair_stats in emotions.items():
+                SAMPLE_POOL_DEPTH.set(pair_stats["depth"], instrument=instrument_name, emotion=emotion_label(emotion))
+                refills["produced"] += pair_stats["produced"]
+                refills["failed"] += pair_stats["failures"]
+                refills["deferred"] += pair_stats["deferred"]
+        for result, total in refills.items():
+            SAMPLE_POOL_REFILLS.set_total(total, result=result)
+        SAMPLE_POOL_REFILL_RATE.set(pool_stats["refill_rate"])
+
+    ARTIFACTS.set(artifact_store.stats()["artifacts"])
+
+    synth_stats = get_synth_pool().stats()
+    SYNTHS.set(sum(synth["instances"] for synth in synth_stats["synths"].values()), state="running")
+    SYNTHS.set(sum(synth["idle"] for synth in synth_stats["synths"].values()), state="idle")
+    for event in ["renders", "fallbacks", "failures", "restarts"]:
+        SYNTH_EVENTS.set_total(synth_stats[event], event=event)
+
+REGISTRY.add_collector(collect_metrics)
+
+def server_timing_header(timings: dict, headers: dict = None) -> dict:
+    """ Adds the stage durations to the response headers, i.e: Server-Timing: model;dur=0.1, generate;dur=84.2, steps;desc="57" """
+    headers = dict(headers or {})
+    if server_timing and timings:
+        headers["Server-Timing"] = ", ".join(
+            f'{name};desc="{value}"' if name == "steps" else f"{name};dur={value:.3f}"
+            for name, value in timings.items()
+        )
+    return headers
+
+def generate_sample_melodies(instrument_name: str, emotion: str, count: int, rng_seeds: list = None, parameters: list = None):
+    """ Runs on the inference pool: like generate_sample_melody but every melody is generated in the same batch """
+    if rng_seeds is not None:
+        # seeded melodies are generated one at a time, so a melody never depends on what it was batched with
+        return [
+            generate_sample_melody(instrument_name, emotion, rng_seed, sample)
+            for rng_seed, sample in zip(rng_seeds, parameters or [None] * len(rng_seeds))
+        ]
+
+    seeds = []
+    num_steps = []
+    max_seq_len = []
+    temperature = []
+    for _ in range(count):
+        seed, steps, seq_len, temp = sample_parameters(instrument_name, emotion)
+        seeds.append(seed)
+        num_steps.append(steps)
+        max_seq_len.append(seq_len)
+        temperature.append(temp)
+
+    if debug_mode != 0:
+        print(f"The seeds are: {seeds}")
+
+    start = time.perf_counter()
+    with model_registry.lease(instrument_name) as melody_generator:
+        melodies = melody_generator.generate_melodies(seeds, num_steps, max_seq_len, temperature)
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage="generate", instrument=instrument_name, emotion=emotion_label(emotion))
+    for seed, melody, temp in zip(seeds, melodies, temperature):
+        SAMPLE_STEPS.observe(len(melody) - len(seed), instrument=instrument_name, emotion=emotion_label(emotion))
+        SAMPLE_TEMPERATURE.observe(temp, instrument=instrument_name, emotion=emotion_label(emotion))
+    return melodies
+
+def produce_pooled_sample(instrument_name: str, emotion: str):
+    """
+    Runs on the sample pool's threads: one clip kept as both its midi and its rendered wav. The generation and the
+    render go through the execution layer like a request's, but only onto idle workers (see BoundedExecutor.call),
+    while the pools are busy with requests the clip is put off by returning None
+    """
+    try:
+        melody = execution_layer.inference.call(generate_sample_melody, instrument_name, emotion,
+                                                limit=execution_layer.inference_workers)
+        midi_bytes = melody_to_midi(melody, emotion, writer=midi_writer)
+        wav = execution_layer.render.call(render_wav, midi_bytes, model_paths[instrument_name]['soundfont'], tmp_dir=tmp_dir,
+                                          limit=execution_layer.render_workers)
+    except ExecutorSaturatedError:
+        return None
+    return midi_bytes, wav
 
 @app.get("/ping")
 def pong():
     """ Used to test if the API is alive """
     return {"Hello": "World"}
 
+@app.get("/ready")
+def ready():
+    """
+    Readiness probe: what the startup warm-up found for every instrument. 503 until it is done, and after that as long
+    as any mapping, soundfont, preloaded model or the render workers failed (those are listed under "failed")
+    """
+    if not readiness["ready"]:
+        return JSONResponse(status_code=503, content=readiness)
+    return readiness
+
 @app.post("/request")
 async def testRequest(req: Request):
     """ You can use this to test what the body of the request looks like """
@@ -56,62 +506,324 @@ async def testRequest(req: Request):
     return {"Hello": "World"}
 
 
+@app.get("/modelStats")
+def modelStats():
+    """ Reports the model registry's hit/miss counts and load times """
+    return model_registry.stats()
+
+@app.get("/executionStats")
+def executionStats():
+    """ Reports how busy the inference and render pools are """
+    return execution_layer.stats()
+
+@app.get("/cacheStats")
+def cacheStats():
+    """ Reports the render cache's hit/miss counts and size """
+    return render_cache.stats() if render_cache is not None else {}
+
+@app.get("/poolStats")
+def poolStats():
+    """ Reports the depth of every pooled instrument/emotion pair and how fast the pool refills """
+    return sample_pool.stats() if sample_pool is not None else {}
+
+@app.get("/artifactStats")
+def artifactStats():
+    """ Reports how many request artifacts are alive and how many the janitor had to clean up """
+    return artifact_store.stats()
+
+@app.get("/synthStats")
+def synthStats():
+    """ Reports the FluidSynth instances of the API process and how many renders had to fall back to the command line """
+    return get_synth_pool().stats()
+
+@app.get("/metrics")
+def metrics():
+    """ Every metric in the Prometheus text format """
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
 @app.post("/getSample")
 async def getSample(sampleRequest: SampleRequest):
+    request_start = time.perf_counter()
     if sampleRequest.instrument_name not in model_paths:
         raise HTTPException(status_code=404, detail="Instrument not found")
+    if sampleRequest.emotion not in EMOTIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown emotion, expected one of {', '.join(EMOTIONS)}")
+    format_settings = resolve_format(sampleRequest.instrument_name, sampleRequest.format)
+    bitrate = format_settings.get("bitrate")
+    media_type = AUDIO_FORMATS[sampleRequest.format]["media_type"]
+    extension = AUDIO_FORMATS[sampleRequest.format]["extension"]
+    labels = {"endpoint": "getSample", "instrument": sampleRequest.instrument_name, "emotion": emotion_label(sampleRequest.emotion),
+              "format": sampleRequest.format}
 
-    # Delete any previous midi/wav files still present locally
-    if debug_mode == 0:
+    # A seeded request always produces the same audio, so it may already be in the render cache
+    parameters = None
+    cache_key = None
+    if sampleRequest.rng_seed is not None:
+        parameters = sample_parameters(sampleRequest.instrument_name, sampleRequest.emotion, sampleRequest.rng_seed)
+        # the key hashes the model and soundfont files whenever they change, that stays off the event loop
+        cache_key = await asyncio.get_event_loop().run_in_executor(
+            None,
+            render_cache_key,
+            sampleRequest.instrument_name,
+            sampleRequest.emotion,
+            parameters,
+            sampleRequest.rng_seed,
+            sampleRequest.format,
+            bitrate
+        )
+        cached = render_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            REQUESTS.inc(outcome="cache_hit", **labels)
+            return Response(content=cached, media_type=media_type, headers={"X-Render-Cache": "hit"})
+    cache_headers = {"X-Render-Cache": "miss"} if cache_key is not None else None
+
+    # Unseeded requests can take a ready clip from the pool, when it has run dry we generate inline below
+    clip = sample_pool.take(sampleRequest.instrument_name, sampleRequest.emotion) \
+        if sample_pool is not None and sampleRequest.rng_seed is None else None
+    if clip is not None:
+        midi_bytes, wav = clip
+        if sampleRequest.format == "midi":
+            content = midi_bytes
+        elif sampleRequest.format == "wav":
+            content = wav
+        else:
+            try:
+                content = await execution_layer.render.run(encode_pcm, wav[44:], sampleRequest.format, bitrate)
+            except ExecutorSaturatedError as e:
+                REQUESTS.inc(outcome="rejected", **labels)
+                raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+        REQUESTS.inc(outcome="pool_hit", **labels)
+        return Response(content=content, media_type=media_type, headers={"X-Sample-Pool": "hit"})
+
+    # A render that can't start would only be noticed once the 200 has been sent, so check for the synth first
+    soundfont = model_paths[sampleRequest.instrument_name]['soundfont']
+    if sampleRequest.format != "midi" and not synth_available(soundfont):
+        REQUESTS.inc(outcome="unavailable", **labels)
+        raise HTTPException(status_code=503, detail="No synth is available to render this instrument", headers={"Retry-After": "1"})
+
+    # When either pool is full we turn the request away instead of letting work pile up. The audio is synthesized
+    # while it streams from this process, it still holds a render pool slot for as long as that takes
+    try:
+        reservation = execution_layer.reserve(render_tasks=0 if sampleRequest.format == "midi" else 1)
+    except ExecutorSaturatedError as e:
+        REQUESTS.inc(outcome="rejected", **labels)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+    # the render slot is handed to the stream, anything that fails before it starts gives it back here
+    try:
+        timings = {}
+        midi_bytes = await reservation.inference.run(
+            generate_sample_midi,
+            sampleRequest.instrument_name,
+            sampleRequest.emotion,
+            sampleRequest.rng_seed,
+            parameters,
+            timings
+        )
+        REQUESTS.inc(outcome="generated", **labels)
+        headers = server_timing_header(timings, cache_headers)
+
+        if debug_mode != 0:
+            file_helper.saveBytes(midi_bytes, f"./output/{uuid.uuid4()}.mid")
+
+        if sampleRequest.format == "midi":
+            reservation.release()
+            if cache_key is not None:
+                render_cache.put(cache_key, midi_bytes, extension)
+            return Response(content=midi_bytes, media_type=media_type, headers=headers)
+
+        # Stream the audio back as FluidSynth synthesizes it, compressed formats are encoded along the way.
+        # The midi stays in the artifact store until the response has been sent, the memory store has no path
+        # to give FluidSynth so stream_audio writes its own temp file then
+        artifact = artifact_store.put(midi_bytes, ".mid")
+        body = stream_audio(
+            midi_bytes,
+            soundfont,
+            sampleRequest.format,
+            bitrate,
+            tmp_dir=tmp_dir,
+            midi_path=artifact.path
+        )
+        if cache_key is not None:
+            # the streamed wav header has placeholder sizes, the cached file gets the real ones
+            body = render_cache.tee(body, cache_key, extension, complete_wav_header if sampleRequest.format == "wav" else None)
+        body = timed_stream(body, sampleRequest.instrument_name, sampleRequest.emotion, request_start)
+        body = held_stream(body, reservation.render)
+        return StreamingResponse(
+            body,
+            media_type=media_type,
+            headers=headers,
+            background=BackgroundTasks([
+                BackgroundTask(artifact_store.release, artifact),
+                BackgroundTask(reservation.render.release, completed=True)
+            ])
+        )
+    except BaseException:
+        reservation.release()
+        raise
+
+@app.post("/getSamples")
+async def getSamples(samplesRequest: SamplesRequest):
+    """ Generates several samples for the same instrument/emotion in one go and returns them as a zip of audio files """
+    if samplesRequest.instrument_name not in model_paths:
+        raise HTTPException(status_code=404, detail="Instrument not found")
+    if samplesRequest.emotion not in EMOTIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown emotion, expected one of {', '.join(EMOTIONS)}")
+    if samplesRequest.count < 1 or samplesRequest.count > max_samples_per_request:
+        raise HTTPException(status_code=400, detail=f"count must be between 1 and {max_samples_per_request}")
+    format_settings = resolve_format(samplesRequest.instrument_name, samplesRequest.format)
+    bitrate = format_settings.get("bitrate")
+    extension = AUDIO_FORMATS[samplesRequest.format]["extension"]
+
+    soundfont = model_paths[samplesRequest.instrument_name]['soundfont']
+    count = samplesRequest.count
+    labels = {"endpoint": "getSamples", "instrument": samplesRequest.instrument_name, "emotion": emotion_label(samplesRequest.emotion),
+              "format": samplesRequest.format}
+
+    # With an rng_seed sample i is seeded with rng_seed + i, so each one can be looked up in the render cache
+    clips = [None] * count
+    rng_seeds = None
+    parameters = None
+    cache_keys = [None] * count
+    if samplesRequest.rng_seed is not None:
+        rng_seeds = [samplesRequest.rng_seed + i for i in range(count)]
+        parameters = [sample_parameters(samplesRequest.instrument_name, samplesRequest.emotion, rng_seed) for rng_seed in rng_seeds]
+        cache_keys = await asyncio.get_event_loop().run_in_executor(None, lambda: [
+            render_cache_key(
+                samplesRequest.instrument_name,
+                samplesRequest.emotion,
+                parameters[i],
+                rng_seeds[i],
+                samplesRequest.format,
+                bitrate
+            )
+            for i in range(count)
+        ])
+        for i in range(count):
+            if cache_keys[i] is not None:
+                clips[i] = render_cache.get(cache_keys[i])
+    missing = [i for i in range(count) if clips[i] is None]
+
+    if missing:
         try:
-            directory = "./output"
-            files_in_directory = os.listdir(directory)
-            files_to_delete = [file for file in files_in_directory if delete_files(file)]
-            for file in files_to_delete:
-                path_to_file = os.path.join(directory, file)
-                os.remove(path_to_file)
-        except Exception as e:
-            print(f"Something went wrong with deleting thge old files: {e}")
-    else:
-        print("In debug mode, not deleting old output")
-    
-    # Init our model
-    melody_generator = MelodyGenerator(
-        model_paths[sampleRequest.instrument_name]['model_path'],
-        file_helper,
-        model_paths[sampleRequest.instrument_name]['mapping_path'],
-        64
-    )
+            reservation = execution_layer.reserve(render_tasks=len(missing))
+        except ExecutorSaturatedError as e:
+            REQUESTS.inc(outcome="rejected", **labels)
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
 
-    seed = determine_seed(model_paths[sampleRequest.instrument_name]['mapping_path'], file_helper)
-    num_steps, max_seq_len, temperature = determine_metaparameters(sampleRequest.emotion)
+        with reservation:
+            melodies = await reservation.inference.run(
+                generate_sample_melodies,
+                samplesRequest.instrument_name,
+                samplesRequest.emotion,
+                len(missing),
+                [rng_seeds[i] for i in missing] if rng_seeds is not None else None,
+                [parameters[i] for i in missing] if parameters is not None else None
+            )
 
-    if debug_mode != 0:
-        print(f"The seed is: {seed}")
-
-    # Generate our melody from a seed
-    melody = melody_generator.generate_melody(
-        seed,
-        num_steps,
-        max_seq_len,
-        temperature
-    )
+            # every melody is rendered on its own worker at the same time
+            render_start = time.perf_counter()
+            rendered = await asyncio.gather(*[
+                reservation.render.run(
+                    render_melody_audio,
+                    melody,
+                    samplesRequest.emotion,
+                    soundfont,
+                    samplesRequest.format,
+                    bitrate,
+                    tmp_dir,
+                    midi_writer
+                )
+                for melody in melodies
+            ])
+            STAGE_SECONDS.observe(time.perf_counter() - render_start, stage="render", instrument=samplesRequest.instrument_name,
+                                  emotion=emotion_label(samplesRequest.emotion))
+
+        # render_melody_audio raises when FluidSynth or ffmpeg fail, every clip that made it here is complete
+        for i, clip in zip(missing, rendered):
+            clips[i] = clip
+            if cache_keys[i] is not None:
+                render_cache.put(cache_keys[i], clip, extension)
 
-    # Save the melody to disk
-    unique_id = str(uuid.uuid4())
-    save_file_name = f"./output/{unique_id}.mid"
-    melody_generator.save_melody(
-        melody,
-        save_file_name,
-        sampleRequest.emotion,
-        format="midi"
+    REQUESTS.inc(outcome="generated" if missing else "cache_hit", **labels)
+
+    # the compressed formats don't deflate any further and wav isn't worth the time, so everything is stored
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_STORED) as zip_file:
+        for i, clip in enumerate(clips):
+            zip_file.writestr(f"sample_{i}.{extension}", clip)
+
+    return Response(
+        content=archive.getvalue(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={samplesRequest.instrument_name}_{samplesRequest.emotion}.zip"}
     )
 
-    # Convert the midi to wav
-    wav_file_name = f"./output/{unique_id}.wav"
-    fs = FluidSynth(model_paths[sampleRequest.instrument_name]['soundfont'])
-    fs.midi_to_audio(save_file_name, wav_file_name)
+@app.post("/getArrangement")
+async def getArrangement(arrangementRequest: ArrangementRequest):
+    """
+    Generates one track per instrument at the same time and returns them as a single file: a midi file with a
+    channel and program per track, or the tracks rendered with their own soundfonts and mixed together
+    """
+    request_start = time.perf_counter()
+    instrument_names = arrangementRequest.instruments
+    if len(instrument_names) < 1 or len(instrument_names) > max_tracks_per_arrangement:
+        raise HTTPException(status_code=400, detail=f"instruments must list between 1 and {max_tracks_per_arrangement} instruments")
+    unknown = [name for name in instrument_names if name not in model_paths]
+    if unknown:
+        raise HTTPException(status_code=404, detail=f"Instrument not found: {', '.join(unknown)}")
+    if arrangementRequest.emotion not in EMOTIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown emotion, expected one of {', '.join(EMOTIONS)}")
+    # every instrument has to support the format, the mix is encoded with the first one's settings
+    format_settings = [resolve_format(name, arrangementRequest.format) for name in instrument_names]
+    bitrate = format_settings[0].get("bitrate")
+    media_type = AUDIO_FORMATS[arrangementRequest.format]["media_type"]
+    emotion = arrangementRequest.emotion
+    labels = {"endpoint": "getArrangement", "instrument": "arrangement", "emotion": emotion_label(emotion), "format": arrangementRequest.format}
+
+    # with an rng_seed track i is seeded with rng_seed + i, like the samples of /getSamples
+    rng_seeds = [arrangementRequest.rng_seed + i if arrangementRequest.rng_seed is not None else None
+                 for i in range(len(instrument_names))]
+
+    timings = {}
+    try:
+        reservation = execution_layer.reserve(inference_tasks=len(instrument_names))
+    except ExecutorSaturatedError as e:
+        REQUESTS.inc(outcome="rejected", **labels)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+    with reservation:
+        # every track is generated on its own inference thread, so this takes as long as the slowest one
+        generate_start = time.perf_counter()
+        melodies = await asyncio.gather(*[
+            reservation.inference.run(generate_sample_melody, name, emotion, rng_seed)
+            for name, rng_seed in zip(instrument_names, rng_seeds)
+        ])
+        generate_time = time.perf_counter() - generate_start
+        timings["generate"] = generate_time * 1000
+        STAGE_SECONDS.observe(generate_time, stage="generate", instrument="arrangement", emotion=emotion_label(emotion))
 
-    # Return the audio file
-    return FileResponse(wav_file_name)
+        render_start = time.perf_counter()
+        channels = arrangement_channels([model_paths[name] for name in instrument_names])
+        if arrangementRequest.format == "midi":
+            tracks = [(melody, channel, program) for melody, (channel, program) in zip(melodies, channels)]
+            content = await reservation.render.run(arrangement_to_midi, tracks, emotion)
+        else:
+            content = await reservation.render.run(
+                render_arrangement_audio,
+                melodies,
+                emotion,
+                [model_paths[name]['soundfont'] for name in instrument_names],
+                arrangementRequest.format,
+                bitrate,
+                tmp_dir,
+                midi_writer,
+                channels
+            )
+        render_time = time.perf_counter() - render_start
+        timings["render"] = render_time * 1000
+        STAGE_SECONDS.observe(render_time, stage="render", instrument="arrangement", emotion=emotion_label(emotion))
 
+    REQUESTS.inc(outcome="generated", **labels)
+    STAGE_SECONDS.observe(time.perf_counter() - request_start, stage="request", instrument="arrangement", emotion=emotion_label(emotion))
+    return Response(content=content, media_type=media_type, headers=server_timing_header(timings))
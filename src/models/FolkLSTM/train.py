@@ -17,6 +17,9 @@ EPOCHS = 50
 LEARNING_RATE = 0.001
 BATCH_SIZE = 16
 NUM_NEURONS = [256] # number of neurons in the eternal layers
+# 0 keeps the one-hot input, otherwise the symbols go through an Embedding of this size and the training
+# batches/generation seeds stay ints
+EMBEDDING_SIZE = 0
 ROOT_PATH = Path.cwd()
 SAVE_MODEL_PATH = f"{ROOT_PATH}/FolkLSTM.h5"
 
@@ -30,7 +33,9 @@ pipeline_config = {
     'MAPPING_PATH': f"{ROOT_PATH}/song_mappings.json",
     'SEQUENCE_LENGTH': 64,
     'FILE_TYPE': "krn",
-    'STAGE': 0
+    'STAGE': 0,
+    'BATCH_SIZE': BATCH_SIZE,
+    'ONE_HOT': EMBEDDING_SIZE == 0
 }
 
 def build_model(output_neurons, num_neurons, loss, learning_rate):
@@ -51,14 +56,35 @@ def build_model(output_neurons, num_neurons, loss, learning_rate):
     model.summary()
     return model
 
-# Generate the training sequences
-inputs, targets = music_helper.song_data_pipeline(pipeline_config)
+def build_embedding_model(output_neurons, embedding_size, num_neurons, loss, learning_rate):
+    # Same network as build_model, but it takes the mapped ints and learns a dense vector per symbol
+    # instead of being fed one-hot vectors as wide as the vocabulary
+    input = keras.layers.Input(shape=(None,), dtype="int32")
+    x = keras.layers.Embedding(output_neurons, embedding_size)(input)
+    x = keras.layers.LSTM(num_neurons[0])(x)
+    x = keras.layers.Dropout(0.2)(x)
+
+    output = keras.layers.Dense(output_neurons, activation="softmax")(x)
+
+    # compile the model
+    model = keras.Model(input, output)
+    model.compile(loss=loss,
+                optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
+                metrics=["accuracy"])
+    model.summary()
+    return model
+
+# Generate the training batches, they are read from the corpus one batch at a time
+training_sequence = music_helper.song_sequence_pipeline(pipeline_config)
 
 # build the network
-model = build_model(OUTPUT_NEURONS, NUM_NEURONS, LOSS_FUNC, LEARNING_RATE)
+if EMBEDDING_SIZE > 0:
+    model = build_embedding_model(OUTPUT_NEURONS, EMBEDDING_SIZE, NUM_NEURONS, LOSS_FUNC, LEARNING_RATE)
+else:
+    model = build_model(OUTPUT_NEURONS, NUM_NEURONS, LOSS_FUNC, LEARNING_RATE)
 
 # train the model
-model.fit(inputs, targets, epochs=EPOCHS, batch_size=BATCH_SIZE)
+model.fit(training_sequence, epochs=EPOCHS)
 
 # save the model
 model.save(SAVE_MODEL_PATH)
@@ -1,7 +1,7 @@
 import sys
 sys.path.insert(0, "./common/")
 
-from api_helper import determine_seed, delete_files, determine_metaparameters
+from api_helper import determine_seed, determine_metaparameters
 from melody_generator import MelodyGenerator
 from file_helper import FileHelper
 from music_helper import MusicHelper
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules in common/ import each other flat, like main.py sets up with sys.path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
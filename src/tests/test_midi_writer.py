@@ -0,0 +1,28 @@
+import os
+import json
+import music21 as m21
+from midi_writer import arrangement_channels, arrangement_to_midi
+
+MODEL_INFO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "model_info.json")
+
+
+def note_channels(midi_bytes: bytes) -> list:
+    """ The 1 based channels the note-ons of every track (but the conductor track) play on """
+    midi_file = m21.midi.MidiFile()
+    midi_file.readstr(midi_bytes)
+    return [
+        {event.channel for event in track.events if event.type == m21.midi.ChannelVoiceMessages.NOTE_ON}
+        for track in midi_file.tracks[1:]
+    ]
+
+
+def test_drum_instruments_land_on_channel_10():
+    with open(MODEL_INFO) as f:
+        model_info = json.load(f)
+    instruments = ["Guitar", "Drums", "FolkLSTM", "LatinDrums"]
+    melody = ["60", "_", "62", "r", "64", "_"]
+
+    channels = arrangement_channels([model_info[name] for name in instruments])
+    midi_bytes = arrangement_to_midi([(melody, channel, program) for channel, program in channels], "happy")
+
+    assert note_channels(midi_bytes) == [{1}, {10}, {2}, {10}]
@@ -0,0 +1,47 @@
+from file_helper import FileHelper
+from model_registry import ModelRegistry
+
+
+class FakeGenerator:
+    def __init__(self, version: int):
+        self.version = version
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def touch(path: str, size: int) -> None:
+    with open(path, "wb") as f:
+        f.write(b"0" * size)
+
+
+def test_reload_survives_an_eviction_while_loading(tmp_path):
+    model_path = str(tmp_path / "model.h5")
+    mapping_path = str(tmp_path / "mapping.json")
+    touch(model_path, 10)
+    touch(mapping_path, 10)
+
+    loaded = []
+
+    def loader(info: dict) -> FakeGenerator:
+        if loaded:
+            # a concurrent acquire pushed the stale model out while this reload was loading it
+            registry.evict(info["name"])
+        loaded.append(FakeGenerator(len(loaded)))
+        return loaded[-1]
+
+    registry = ModelRegistry({"A": {"model_path": model_path, "mapping_path": mapping_path}}, FileHelper(),
+                             hot_reload=True, reload_check_interval=0, loader=loader)
+    with registry.lease("A") as first:
+        assert first.version == 0
+
+    # a new size changes the signature, so the next lease reloads the model
+    touch(model_path, 20)
+    with registry.lease("A") as second:
+        assert second.version == 1
+        assert not second.closed
+
+    assert first.closed
+    assert registry.get("A") is second
+    assert registry.stats()["reloads"] == 1
@@ -0,0 +1,68 @@
+import random
+import numpy as np
+import music21 as m21
+import song_preprocessing
+
+
+def reference_encode_song(song, time_step: float = 0.25) -> str:
+    """ encode_song as it was first written, checking every event at every onset step """
+    starts, lengths, pitches, rest_starts, rest_lengths = song_preprocessing.song_events(song, time_step)
+    total_steps = int(max((starts + lengths).max(initial=0), (rest_starts + rest_lengths).max(initial=0)))
+    if total_steps == 0:
+        return ""
+
+    changes = np.zeros(total_steps + 1, dtype=np.int64)
+    np.add.at(changes, starts, 1)
+    np.add.at(changes, starts + lengths, -1)
+    sounding = np.cumsum(changes[:-1]) > 0
+
+    encoded_song = np.full(total_steps, "_", dtype=object)
+    silence_start = np.concatenate(([True], sounding[:-1]))
+    silence_start[rest_starts] = True
+    encoded_song[~sounding & silence_start] = "r"
+
+    ends = starts + lengths
+    for step in np.unique(starts):
+        group = np.unique(pitches[(starts <= step) & (ends > step)])
+        encoded_song[step] = str(group[0]) if len(group) == 1 else song_preprocessing.chord_symbol(tuple(group.tolist()))
+    return " ".join(encoded_song)
+
+
+def random_score(rng: random.Random, parts: int, events: int):
+    score = m21.stream.Score()
+    for _ in range(parts):
+        part = m21.stream.Part()
+        for _ in range(events):
+            quarter_length = rng.choice([0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 4.0])
+            kind = rng.random()
+            if kind < 0.15:
+                part.append(m21.note.Rest(quarterLength=quarter_length))
+            elif kind < 0.35:
+                part.append(m21.chord.Chord(rng.sample(range(48, 84), rng.randint(2, 4)), quarterLength=quarter_length))
+            else:
+                part.append(m21.note.Note(rng.randint(48, 84), quarterLength=quarter_length))
+        score.insert(0, part)
+    return score
+
+
+def test_encode_song_matches_the_reference():
+    rng = random.Random(0)
+    for parts in (1, 2, 3):
+        for _ in range(5):
+            song = random_score(rng, parts, 40)
+            assert song_preprocessing.encode_song(song) == reference_encode_song(song)
+
+
+def test_encode_song_single_voice():
+    song = m21.stream.Stream()
+    song.append(m21.note.Note(60, quarterLength=1.0))
+    song.append(m21.note.Rest(quarterLength=0.5))
+    song.append(m21.chord.Chord([65, 68, 70], quarterLength=0.5))
+    song.append(m21.note.Note(62, quarterLength=0.25))
+    assert song_preprocessing.encode_song(song) == "60 _ _ _ r _ 5.8.10 _ 62"
+
+
+def test_encode_song_only_rests():
+    song = m21.stream.Stream()
+    song.append(m21.note.Rest(quarterLength=1.0))
+    assert song_preprocessing.encode_song(song) == "r _ _ _"